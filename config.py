@@ -141,6 +141,10 @@ BASE_CONFIG: Dict[str, Any] = {
         "image_name": get_env("DOCKER_IMAGE_NAME", "perl-python-sandbox:latest"),
         "memory_limit": get_env("DOCKER_MEMORY_LIMIT", "512m"),
         "cpu_limit": get_float("DOCKER_CPU_LIMIT", 0.5),
+        "pool_size": get_int("DOCKER_POOL_SIZE", 2),
+        # 例: "0-1;2-3" — 指定時は CPU クォータの代わりにコンテナごとに順番に割り当てる
+        "cpusets": get_list("DOCKER_CPUSETS", [], separator=";"),
+        "memory_reservation": get_env("DOCKER_MEMORY_RESERVATION", None),
     },
     "security": {
         "sandbox_enabled": get_bool("USE_DOCKER", True),
@@ -117,7 +117,15 @@ class Agent:
         self.context.add_event({"type": "Message", "content": user_input})
         await self._safe_tool("message_notify_user", {"message": "リクエストを受け付けました。計画を立案します。"})
 
-        plan_text: str = await _to_thread(self.planner.create_plan, user_input)
+        # 計画立案 (LLM 往復) と関連知識の検索 (埋め込み + ANN) は独立しているため並行実行する
+        if getattr(self.memory, "_vector_memory_available", False):
+            plan_text, knowledge = await asyncio.gather(
+                _to_thread(self.planner.create_plan, user_input),
+                _to_thread(self.memory.get_relevant_knowledge, user_input),
+            )
+            self.context.add_event({"type": "Knowledge", "content": knowledge})
+        else:
+            plan_text = await _to_thread(self.planner.create_plan, user_input)
         self.context.add_event({"type": "Plan", "content": plan_text})
         self._plan_hash = self._hash(plan_text)
         await _to_thread(self._write_todo_from_plan, plan_text, preserve_completed=False)
@@ -362,6 +370,8 @@ class Agent:
                 
             elif ev["type"] == "Plan":
                 events_text += f"計画:\n{ev['content']}\n"
+            elif ev["type"] == "Knowledge":
+                events_text += f"関連知識:\n{ev['content']}\n"
             elif ev["type"] == "Action":
                 events_text += f"アクション呼び出し: {json.dumps(ev['content'], ensure_ascii=False)}\n"
                 content = ev.get("content", {})
@@ -7,18 +7,118 @@ import os
 from core.logging_config import logger
 import time
 import json
+import queue
+import threading
+import hashlib
 import pickle
 import numpy as np
-from typing import Dict, List, Any, Optional, Tuple
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, List, Any, Optional, Tuple
 
-from sentence_transformers import SentenceTransformer
+# faiss / sentence_transformers は torch を読み込むため起動が重い。
+# 型ヒント用途のみモジュールレベルで参照し、実体は FAISSMemory 初期化時に読み込む。
+if TYPE_CHECKING:
+    import faiss
+    from sentence_transformers import SentenceTransformer
 
+# 任意依存: 高速 JSON と zstd 圧縮 (無ければ標準 json / 非圧縮にフォールバック)
 try:
-    import faiss
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+# 任意依存: ドキュメント本文を Arrow ファイルに置き、mmap で遅延読み込みする
+try:
+    import pyarrow as pa
 except ImportError:
-    logging.error("FAISSがインストールされていません。'uv add faiss-cpu' を実行してください。")
-    raise
+    pa = None
+
+# structlog の kv 形式で出力する (フィルタされたレコードは文字列整形されない)
+log = logger.bind(component="faiss_memory")
+
+
+def _dumps(obj: Any) -> bytes:
+    """メタデータを (インデントなしの) JSON バイト列に変換"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _loads(data: bytes) -> Any:
+    """JSON バイト列を読み込む"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+@contextmanager
+def _atomic_files():
+    """
+    複数のファイルをそれぞれ一時ファイルに書き込み、全て書き終えてから開いた順にまとめて置き換える。
+    途中で失敗した場合は一時ファイルを削除し、既存のファイルは変更しない。
+    """
+    pending: List[Tuple[str, str]] = []
+    
+    def open_tmp(path: str):
+        tmp_path = f"{path}.tmp"
+        pending.append((tmp_path, path))
+        return open(tmp_path, 'wb')
+    
+    try:
+        yield open_tmp
+    except BaseException:
+        for tmp_path, _ in pending:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        raise
+    for tmp_path, path in pending:
+        os.replace(tmp_path, path)
 
+class _DocumentStore:
+    """
+    読み込み済みドキュメント (Arrow の mmap 列) と追加分 (Python リスト) をまとめたシーケンス。
+    読み込み済み部分は Python 文字列オブジェクトを保持せず、アクセス時にのみ変換する。
+    """
+    
+    def __init__(self, column: "pa.ChunkedArray"):
+        self._column = column
+        self._base_len = len(column)
+        self._tail: List[str] = []
+    
+    def __len__(self) -> int:
+        return self._base_len + len(self._tail)
+    
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if i < self._base_len:
+            return self._column[i].as_py()
+        return self._tail[i - self._base_len]
+    
+    def __iter__(self):
+        for chunk in self._column.iterchunks():
+            yield from chunk.to_pylist()
+        yield from self._tail
+    
+    def append(self, text: str) -> None:
+        self._tail.append(text)
+    
+    def to_arrow(self) -> "pa.ChunkedArray":
+        """読み込み済み部分は Python 文字列に変換せず、追加分だけを変換した Arrow の列を返す"""
+        chunks = list(self._column.chunks)
+        if self._tail:
+            chunks.append(pa.array(self._tail, type=self._column.type))
+        return pa.chunked_array(chunks, type=self._column.type)
+
+
+def _fingerprint(text: str) -> bytes:
+    """重複判定用のテキストハッシュ"""
+    return hashlib.sha1(text.encode("utf-8", "ignore")).digest()
 
 
 class FAISSMemory:
@@ -40,64 +140,195 @@ class FAISSMemory:
         
         self.index_path = os.path.join(self.db_dir, "faiss_index.bin")
         self.metadata_path = os.path.join(self.db_dir, "faiss_metadata.json")
+        self.index_zst_path = self.index_path + ".zst"
+        self.metadata_zst_path = self.metadata_path + ".zst"
+        self.documents_arrow_path = os.path.join(self.db_dir, "faiss_documents.arrow")
+        
+        # 重い依存関係はベクトルメモリを実際に使う時点で読み込む
+        try:
+            import faiss
+        except ImportError:
+            log.error("FAISSがインストールされていません。'uv add faiss-cpu' を実行してください。")
+            raise
+        from sentence_transformers import SentenceTransformer
+        self._faiss = faiss
+        # バッチ検索時にクエリ行をコア数分並列に処理させる
+        faiss.omp_set_num_threads(os.cpu_count() or 1)
         
         # 埋め込みモデルの初期化
-        self.model = SentenceTransformer(embedding_model)
+        self.model: "SentenceTransformer" = SentenceTransformer(embedding_model)
         self.embedding_dim = self.model.get_sentence_embedding_dimension()
         
         # インデックスと関連データの初期化/読み込み
-        self.index = None
+        self.index: Optional["faiss.Index"] = None
         self.documents = []  # テキストドキュメント
         self.metadata = []   # 各ドキュメントに関連するメタデータ
+        # 登録済みテキストの sha1 (重複埋め込みの防止)。メタデータと一緒に保存し、
+        # 保存されていない旧形式では初回の追加時に本文から作る (読み込み時に mmap の本文を文字列化しない)
+        self._seen: Optional[set] = None
+        self._arrow_doc_count: Optional[int] = None  # ディスク上の Arrow ファイルのドキュメント数
+        self._lock = threading.Lock()  # インデックス/リスト更新とスナップショット取得の排他
         self.load_or_create_index()
         
-        logger.info(f"FAISSメモリシステムが初期化されました (埋め込み次元: {self.embedding_dim})")
+        # 定期保存はバックグラウンドスレッドで行い、追加処理をブロックしない
+        self._save_q: "queue.Queue[bool]" = queue.Queue()
+        threading.Thread(target=self._save_worker, name="faiss-save", daemon=True).start()
+        
+        log.info("FAISSメモリシステムが初期化されました", embedding_dim=self.embedding_dim)
     
     def load_or_create_index(self):
         """既存のインデックスを読み込むか、新しいインデックスを作成"""
+        # 本文が Arrow ファイルにある状態で pyarrow が無いと、空の本文で読み込んだ上に保存で上書きしてしまう
+        if pa is None and os.path.exists(self.documents_arrow_path):
+            log.error("ドキュメント本文の Arrow ファイルがありますが pyarrow がインストールされていません",
+                      path=self.documents_arrow_path)
+            raise ImportError("pyarrow が必要です。'uv add pyarrow' を実行してください。")
+        # 同様に zstd 圧縮の保存データがあるのに zstandard が無いと、古い非圧縮データを読むか空で作り直し、
+        # 以後の保存が非圧縮側に行く (zstandard を入れ直すと古い .zst が優先されて保存内容が失われる)
+        if zstd is None and os.path.exists(self.index_zst_path) and os.path.exists(self.metadata_zst_path):
+            log.error("zstd 圧縮のインデックスがありますが zstandard がインストールされていません",
+                      path=self.index_zst_path)
+            raise ImportError("zstandard が必要です。'uv add zstandard' を実行してください。")
         try:
-            if os.path.exists(self.index_path) and os.path.exists(self.metadata_path):
-                # インデックスの読み込み
-                self.index = faiss.read_index(self.index_path)
+            if zstd is not None and os.path.exists(self.index_zst_path) and os.path.exists(self.metadata_zst_path):
+                # zstd 圧縮されたインデックスとメタデータの読み込み
+                dctx = zstd.ZstdDecompressor()
+                with open(self.index_zst_path, 'rb') as f, dctx.stream_reader(f) as r:
+                    index_bytes = r.read()
+                self.index = self._faiss.deserialize_index(np.frombuffer(index_bytes, dtype=np.uint8))
+                
+                with open(self.metadata_zst_path, 'rb') as f, dctx.stream_reader(f) as r:
+                    metadata_dict = _loads(r.read())
+                self.metadata = metadata_dict.get('metadata', [])
+                self.documents = self._load_documents(metadata_dict)
+                self._load_fingerprints(metadata_dict)
+                
+                log.info("既存のFAISSインデックスを読み込みました", n=len(self.documents), compressed=True)
+            elif os.path.exists(self.index_path) and os.path.exists(self.metadata_path):
+                # 非圧縮 (旧形式) のインデックスの読み込み
+                self.index = self._faiss.read_index(self.index_path)
                 
                 # メタデータの読み込み
-                with open(self.metadata_path, 'r', encoding='utf-8') as f:
-                    metadata_dict = json.load(f)
-                    self.documents = metadata_dict.get('documents', [])
+                with open(self.metadata_path, 'rb') as f:
+                    metadata_dict = _loads(f.read())
                     self.metadata = metadata_dict.get('metadata', [])
+                    self.documents = self._load_documents(metadata_dict)
+                    self._load_fingerprints(metadata_dict)
                 
-                logger.info(f"既存のFAISSインデックスを読み込みました (ドキュメント数: {len(self.documents)})")
+                log.info("既存のFAISSインデックスを読み込みました", n=len(self.documents), compressed=False)
             else:
                 # 新しいインデックスの作成
-                self.index = faiss.IndexFlatL2(self.embedding_dim)
+                self.index = self._faiss.IndexFlatL2(self.embedding_dim)
                 self.documents = []
                 self.metadata = []
                 self.save_index()
-                logger.info("新しいFAISSインデックスを作成しました")
+                log.info("新しいFAISSインデックスを作成しました")
         except Exception as e:
-            logger.error(f"インデックス読み込み/作成中にエラー: {str(e)}")
+            log.error("インデックス読み込み/作成中にエラー", error=str(e))
             # フォールバック: 新しいインデックスを作成
-            self.index = faiss.IndexFlatL2(self.embedding_dim)
+            self.index = self._faiss.IndexFlatL2(self.embedding_dim)
             self.documents = []
             self.metadata = []
+            self._seen = None
+    
+    def _load_documents(self, metadata_dict: Dict[str, Any]):
+        """ドキュメント本文を読み込む (Arrow ファイルがあれば mmap、無ければメタデータ JSON から)"""
+        if 'documents' in metadata_dict or pa is None or not os.path.exists(self.documents_arrow_path):
+            return metadata_dict.get('documents', [])
+        # マップはバッファが参照している間は保持される (ここでは閉じない)
+        source = pa.memory_map(self.documents_arrow_path, 'r')
+        column = pa.ipc.open_file(source).read_all().column('text')
+        self._arrow_doc_count = len(column)
+        # 保存は Arrow -> インデックス -> メタデータの順に置き換えるので、
+        # 置き換えの途中で止まった場合は Arrow 側が多くなる。メタデータの件数に合わせる
+        n_docs = len(metadata_dict.get('metadata', []))
+        if len(column) > n_docs:
+            log.warning("Arrow ファイルのドキュメント数がメタデータより多いため切り詰めます",
+                        arrow=len(column), metadata=n_docs)
+            column = column.slice(0, n_docs)
+        return _DocumentStore(column)
+    
+    def _load_fingerprints(self, metadata_dict: Dict[str, Any]):
+        """保存済みの sha1 を読み込む (旧形式で保存されていなければ初回の追加時に作る)"""
+        fingerprints = metadata_dict.get('fingerprints')
+        if fingerprints is not None:
+            self._seen = {bytes.fromhex(fp) for fp in fingerprints}
+    
+    def _fingerprints(self) -> set:
+        """登録済みテキストの sha1 の集合 (未作成なら本文から作る)"""
+        if self._seen is None:
+            with self._lock:
+                if self._seen is None:
+                    self._seen = {_fingerprint(doc) for doc in self.documents}
+        return self._seen
     
     def save_index(self):
         """インデックスとメタデータをディスクに保存"""
         try:
-            # インデックスの保存
-            faiss.write_index(self.index, self.index_path)
+            # 保存中の追加と競合しないよう、インデックスとリストのスナップショットを取る。
+            # 本文は Arrow ファイルの件数から変わった場合だけ取り出す (mmap 済みの部分は文字列化しない)
+            documents = None
+            with self._lock:
+                index = self._faiss.clone_index(self.index)
+                n_docs = len(self.documents)
+                metadata_dict = {'metadata': list(self.metadata)}
+                fingerprints = list(self._seen) if self._seen is not None else None
+                if pa is None:
+                    documents = list(self.documents)
+                elif n_docs != self._arrow_doc_count:
+                    if isinstance(self.documents, _DocumentStore):
+                        documents = self.documents.to_arrow()
+                    else:
+                        documents = list(self.documents)
             
-            # メタデータの保存
-            metadata_dict = {
-                'documents': self.documents,
-                'metadata': self.metadata
-            }
-            with open(self.metadata_path, 'w', encoding='utf-8') as f:
-                json.dump(metadata_dict, f, ensure_ascii=False, indent=2)
+            if fingerprints is not None:
+                metadata_dict['fingerprints'] = [fp.hex() for fp in fingerprints]
+            if pa is None:
+                metadata_dict['documents'] = documents
+            elif documents is not None and not isinstance(documents, pa.ChunkedArray):
+                documents = pa.chunked_array([pa.array(documents, type=pa.large_string())])
+            
+            # 全ファイルを一時ファイルに書き終えてから、Arrow -> インデックス -> メタデータの順に置き換える
+            with _atomic_files() as open_tmp:
+                if pa is not None and documents is not None:
+                    # 本文は非圧縮の Arrow ファイルに分離し、読み込み時に mmap できるようにする
+                    table = pa.table({'text': documents})
+                    with open_tmp(self.documents_arrow_path) as f:
+                        with pa.ipc.new_file(f, table.schema) as writer:
+                            writer.write_table(table, max_chunksize=4096)
+                
+                index_bytes = self._faiss.serialize_index(index).tobytes()
+                if zstd is not None:
+                    # インデックスとメタデータを zstd 圧縮して保存
+                    cctx = zstd.ZstdCompressor(level=3, threads=-1)
+                    with open_tmp(self.index_zst_path) as f, cctx.stream_writer(f) as w:
+                        w.write(index_bytes)
+                    with open_tmp(self.metadata_zst_path) as f, cctx.stream_writer(f) as w:
+                        w.write(_dumps(metadata_dict))
+                else:
+                    # zstandard が無い環境では非圧縮で保存
+                    with open_tmp(self.index_path) as f:
+                        f.write(index_bytes)
+                    with open_tmp(self.metadata_path) as f:
+                        f.write(_dumps(metadata_dict))
             
-            logger.info(f"FAISSインデックスを保存しました (ドキュメント数: {len(self.documents)})")
+            if pa is not None and documents is not None:
+                self._arrow_doc_count = n_docs
+            log.info("FAISSインデックスを保存しました", n=n_docs, compressed=zstd is not None)
         except Exception as e:
-            logger.error(f"インデックス保存中にエラー: {str(e)}")
+            log.error("インデックス保存中にエラー", error=str(e))
+    
+    def _save_worker(self):
+        """保存要求を受けてインデックスを書き出すバックグラウンドスレッド"""
+        while True:
+            self._save_q.get()
+            # 溜まっている保存要求は1回の保存にまとめる
+            try:
+                while True:
+                    self._save_q.get_nowait()
+            except queue.Empty:
+                pass
+            self.save_index()
     
     def add_document(self, text: str, source: str, metadata: Dict[str, Any] = None):
         """
@@ -107,9 +338,17 @@ class FAISSMemory:
             text: ドキュメントテキスト
             source: 情報源の識別子
             metadata: 関連するメタデータ
+            
+        Returns:
+            追加した場合は True。短すぎる・登録済みと同じテキスト・エラーで追加しなかった場合は False
         """
         if not text or len(text.strip()) < 10:
-            return
+            return False
+        
+        # 同一テキストは再埋め込みしない
+        fingerprint = _fingerprint(text)
+        if fingerprint in self._fingerprints():
+            return False
         
         try:
             # メタデータの準備
@@ -124,18 +363,24 @@ class FAISSMemory:
             embedding_np = np.array([embedding]).astype('float32')
             
             # インデックスに追加
-            self.index.add(embedding_np)
-            self.documents.append(text)
-            self.metadata.append(doc_metadata)
+            with self._lock:
+                # 埋め込み中に同じテキストが並行して追加されていれば追加しない
+                if fingerprint in self._seen:
+                    return False
+                self.index.add(embedding_np)
+                self.documents.append(text)
+                self.metadata.append(doc_metadata)
+                self._seen.add(fingerprint)
+                n_docs = len(self.documents)
             
-            # 定期的に保存
-            if len(self.documents) % 10 == 0:
-                self.save_index()
+            # 定期的に保存 (バックグラウンドスレッドに依頼)
+            if n_docs % 10 == 0:
+                self._save_q.put(True)
                 
-            logger.info(f"ドキュメントをFAISSインデックスに追加しました (source: {source})")
+            log.info("ドキュメントをFAISSインデックスに追加しました", source=source, n=n_docs)
             return True
         except Exception as e:
-            logger.error(f"ドキュメント追加中にエラー: {str(e)}")
+            log.error("ドキュメント追加中にエラー", source=source, error=str(e))
             return False
     
     def add_conversation(self, user_message: str, agent_response: str):
@@ -179,21 +424,50 @@ class FAISSMemory:
             limit = min(limit, len(self.documents))  # インデックスサイズより大きくならないように
             distances, indices = self.index.search(query_embedding_np, limit)
             
-            # 結果の整形
-            results = []
-            for i, idx in enumerate(indices[0]):
-                if idx < len(self.documents):  # 安全チェック
-                    results.append((
-                        self.documents[idx],
-                        self.metadata[idx],
-                        float(distances[0][i])
-                    ))
-            
-            return results
+            return self._shape_results(distances[0], indices[0])
         except Exception as e:
-            logger.error(f"検索中にエラー: {str(e)}")
+            log.error("検索中にエラー", error=str(e))
             return []
     
+    def search_many(self, queries: List[str], limit: int = 3) -> List[List[Tuple[str, Dict[str, Any], float]]]:
+        """
+        複数のクエリをまとめて検索 (埋め込みとインデックス検索を1回で行う)
+        
+        Args:
+            queries: 検索クエリのリスト
+            limit: クエリごとに返す結果の最大数
+            
+        Returns:
+            クエリと同じ順序の、search() と同形式の結果リスト
+        """
+        if not queries:
+            return []
+        if len(self.documents) == 0:
+            return [[] for _ in queries]
+        
+        try:
+            query_embeddings = self.model.encode(queries, batch_size=32, convert_to_numpy=True)
+            query_embeddings = query_embeddings.astype('float32', copy=False)
+            
+            limit = min(limit, len(self.documents))
+            distances, indices = self.index.search(query_embeddings, limit)
+            
+            return [self._shape_results(distances[i], indices[i]) for i in range(len(queries))]
+        except Exception as e:
+            log.error("バッチ検索中にエラー", n_queries=len(queries), error=str(e))
+            return [[] for _ in queries]
+    
+    def _shape_results(self, distances: np.ndarray, indices: np.ndarray) -> List[Tuple[str, Dict[str, Any], float]]:
+        """1クエリ分の検索結果を (ドキュメント, メタデータ, スコア) のリストに整形"""
+        # 範囲外インデックスと FAISS の欠損値 -1 を一括で除外
+        docs = self.documents
+        metas = self.metadata
+        mask = (indices >= 0) & (indices < len(docs))
+        idxs = indices[mask]
+        dists = distances[mask]
+        
+        return [(docs[i], metas[i], float(d)) for i, d in zip(idxs.tolist(), dists)]
+    
     def get_relevant_context(self, query: str, limit: int = 3) -> str:
         """
         クエリに関連する文脈情報を取得してフォーマットされたテキストとして返す
@@ -4,9 +4,20 @@
 """
 from core.logging_config import logger
 import os
+import re
 import json
 from typing import Dict, Any, List, Optional
 
+try:
+    import orjson
+    _json_loads = orjson.loads  # orjson.JSONDecodeError は json.JSONDecodeError のサブクラス
+except ImportError:
+    _json_loads = json.loads
+
+# LLM 応答中の ```json ... ``` ブロック
+_JSON_BLOCK = re.compile(r"```json\s*([\s\S]*?)\s*```")
+
+_PLANNER_ROLE = "あなたはManusエージェントのプランニングシステムです。あらゆるタスクを実行可能なステップに分割できます。"
 
 
 class Planner:
@@ -40,6 +51,10 @@ class Planner:
 }
 ```
 """
+        
+        # 固定部分 (役割 + プランニングプロンプト) はシステムメッセージにまとめて一度だけ組み立てる。
+        # 毎回同一のプレフィックスになるため、プロバイダ側のプロンプトキャッシュが効く。
+        self._system_prompt = f"{_PLANNER_ROLE}\n\n{self.planner_prompt}"
     
     def create_plan(self, task_description: str) -> str:
         """
@@ -51,8 +66,8 @@ class Planner:
         Returns:
             計画のテキスト形式
         """
-        # プランニングプロンプトを構築
-        prompt = f"{self.planner_prompt}\n\nタスク: {task_description}\n\nプランを作成してください。"
+        # 可変部分 (タスク) のみをユーザーメッセージにする
+        prompt = f"タスク: {task_description}\n\nプランを作成してください。"
         
         logger.info(f"タスクの計画を作成: {task_description[:80]}...")
         
@@ -62,36 +77,25 @@ class Planner:
             # LLMでプランを生成
             response_text = self.llm_client.call_azure_openai(
                 prompt=prompt,
-                system_prompt="あなたはManusエージェントのプランニングシステムです。あらゆるタスクを実行可能なステップに分割できます。",
+                system_prompt=self._system_prompt,
                 model=CONFIG["llm"]["planning_model"],
                 temperature=0.2,  # プランニングは低温度が適切
                 max_tokens=1500
             )
             try:
-                # plan_data = json.loads(response_text)
+                if isinstance(response_text, dict):
+                    # クライアント側で既にJSONとして解析済み
+                    plan_data = response_text
+                else:
+                    # JSONを抽出 (```json から ``` の間のテキスト、無ければ応答全体)
+                    json_match = _JSON_BLOCK.search(response_text)
+                    plan_data = _json_loads(json_match.group(1) if json_match else response_text)
                 # 計画を人間可読なテキスト形式に変換
-                return self._format_plan_to_text(response_text)
+                return self._format_plan_to_text(plan_data)
             except json.JSONDecodeError:
                 logger.error("計画JSONの解析に失敗しました")
                 # フォールバック: 生のテキストを返す
                 return self._generate_fallback_plan(response_text, task_description)
-            # JSONを抽出 (```json から ``` の間のテキスト)
-            # import re
-            # json_match = re.search(r"```json\s*([\s\S]*?)\s*```", response_text)
-            
-            # if json_match:
-                # json_str = json_match.group(1)
-            #     try:
-            #         plan_data = json.loads(json_str)
-            #         # 計画を人間可読なテキスト形式に変換
-            #         return self._format_plan_to_text(plan_data)
-            #     except json.JSONDecodeError:
-            #         logger.error("計画JSONの解析に失敗しました")
-            #         # フォールバック: 生のテキストを返す
-            #         return self._generate_fallback_plan(response_text, task_description)
-            # else:
-            #     logger.warning("LLMの応答からJSONプランを抽出できませんでした")
-            #     return self._generate_fallback_plan(response_text, task_description)
                 
         except Exception as e:
             import traceback
@@ -6,6 +6,7 @@ OpenAI / LangChain クライアント
 * LangChain を利用した統合もサポート
 * JSON モード対応
 * トークン使用量を含む usage 辞書を返却
+* ストリーミング応答 (chat_completion_stream / on_delta コールバック) 対応
 """
 
 from __future__ import annotations
@@ -13,17 +14,37 @@ import os
 import re
 import json
 import logging
-from typing import Any, Dict, List, Tuple, Optional
+import importlib.util
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Optional
 
+import httpx
 from openai import OpenAI
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
 
 from config import CONFIG
 
+try:
+    import orjson
+    _json_loads = orjson.loads  # orjson.JSONDecodeError は json.JSONDecodeError のサブクラス
+except ImportError:
+    _json_loads = json.loads
+
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
+# ```json ... ``` ブロックの抽出パターン
+_JSON_BLOCK = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
+
+# 全インスタンスで共有する HTTP クライアント (コネクションプール / keep-alive を再利用)
+# HTTP/2 は h2 パッケージがある場合のみ有効化する
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_HTTP = httpx.Client(
+    http2=_HTTP2,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+)
+
 class OpenAIClient:
     """OpenAI および LangChain 対応のクライアント。"""
 
@@ -45,6 +66,9 @@ class OpenAIClient:
         # LangChain 使用フラグの設定
         self.use_langchain = use_langchain
         
+        # 直近のストリーミング呼び出しのトークン使用量
+        self.last_stream_usage: Dict[str, Any] = {}
+        
         # クライアントの初期化
         if use_langchain:
             self._init_langchain_client()
@@ -55,7 +79,7 @@ class OpenAIClient:
 
     def _init_openai_client(self):
         """OpenAI 公式クライアントを初期化"""
-        self._client = OpenAI(api_key=self.api_key)
+        self._client = OpenAI(api_key=self.api_key, http_client=_HTTP)
     
     def _init_langchain_client(self):
         """LangChain クライアントを初期化"""
@@ -63,7 +87,8 @@ class OpenAIClient:
             model_name=self.model_name,
             openai_api_key=self.api_key,
             temperature=CONFIG["llm"]["temperature"],
-            max_tokens=CONFIG["llm"]["max_tokens"]
+            max_tokens=CONFIG["llm"]["max_tokens"],
+            http_client=_HTTP
         )
 
     def chat_completion(
@@ -72,6 +97,7 @@ class OpenAIClient:
         temperature: float = 0.2,
         max_tokens: int = 2048,
         force_json: bool = False,
+        on_delta: Optional[Callable[[str], None]] = None,
     ) -> Tuple[str, Dict[str, Any]]:
         """
         ChatCompletion 呼び出し。
@@ -81,16 +107,92 @@ class OpenAIClient:
             temperature: 温度パラメータ
             max_tokens: 最大トークン数
             force_json: JSON 形式での応答を強制するかどうか
+            on_delta: 指定時はストリーミングで呼び出し、受信したテキスト断片ごとに呼ばれる
             
         Returns:
             content: 生成テキスト
             usage:   {prompt_tokens, completion_tokens, total_tokens}
         """
+        if on_delta is not None:
+            # ストリーミングで受信しながらコールバックし、最後に連結する
+            parts: List[str] = []
+            for delta in self.chat_completion_stream(messages, temperature, max_tokens, force_json):
+                parts.append(delta)
+                on_delta(delta)
+            content = "".join(parts)
+            usage = self.last_stream_usage
+            
+            # JSONモードが強制されていない場合でもJSONを抽出
+            if force_json or self._is_json_content(content):
+                return self._extract_json(content), usage
+            return content, usage
+        
         if self.use_langchain:
             return self._langchain_chat_completion(messages, temperature, max_tokens, force_json)
         else:
             return self._openai_chat_completion(messages, temperature, max_tokens, force_json)
 
+    def chat_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.2,
+        max_tokens: int = 2048,
+        force_json: bool = False,
+    ) -> Iterator[str]:
+        """
+        ストリーミング ChatCompletion 呼び出し。
+        
+        生成されたテキスト断片を到着順に yield する。
+        トークン使用量は完了後に self.last_stream_usage に格納される。
+        
+        Args:
+            messages: ChatCompletion メッセージ
+            temperature: 温度パラメータ
+            max_tokens: 最大トークン数
+            force_json: JSON 形式での応答を強制するかどうか
+        """
+        self.last_stream_usage = {}
+        
+        if self.use_langchain:
+            self._langchain_client.temperature = temperature
+            self._langchain_client.max_tokens = max_tokens
+            try:
+                for chunk in self._langchain_client.stream(self._to_langchain_messages(messages)):
+                    if chunk.content:
+                        yield chunk.content
+            except Exception as exc:
+                logger.error(f"LangChain ストリーミング呼び出し失敗: {exc}")
+                raise
+            return
+        
+        params: Dict[str, Any] = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        if force_json:
+            params["response_format"] = {"type": "json_object"}
+        
+        try:
+            for chunk in self._client.chat.completions.create(**params):
+                # include_usage 指定時は最後のチャンクに usage のみが入る
+                if chunk.usage is not None:
+                    self.last_stream_usage = {
+                        "prompt_tokens": chunk.usage.prompt_tokens,
+                        "completion_tokens": chunk.usage.completion_tokens,
+                        "total_tokens": chunk.usage.total_tokens
+                    }
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+        except Exception as exc:
+            logger.error(f"OpenAI ストリーミング呼び出し失敗: {exc}")
+            raise
+
     def _openai_chat_completion(
         self,
         messages: List[Dict[str, str]],
@@ -141,16 +243,7 @@ class OpenAIClient:
     ) -> Tuple[str, Dict[str, Any]]:
         """LangChain クライアントでの ChatCompletion 呼び出し"""
         # メッセージを LangChain 形式に変換
-        langchain_messages = []
-        for msg in messages:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
-            
-            if role == "system":
-                langchain_messages.append(SystemMessage(content=content))
-            elif role == "user":
-                langchain_messages.append(HumanMessage(content=content))
-            # その他のメッセージタイプは必要に応じて追加
+        langchain_messages = self._to_langchain_messages(messages)
         
         # パラメータを設定
         self._langchain_client.temperature = temperature
@@ -180,22 +273,34 @@ class OpenAIClient:
             logger.error(f"LangChain 呼び出し失敗: {exc}")
             raise
 
+    def _to_langchain_messages(self, messages: List[Dict[str, str]]) -> List[Any]:
+        """ChatCompletion メッセージを LangChain 形式に変換"""
+        langchain_messages = []
+        for msg in messages:
+            role = msg.get("role", "")
+            content = msg.get("content", "")
+            
+            if role == "system":
+                langchain_messages.append(SystemMessage(content=content))
+            elif role == "user":
+                langchain_messages.append(HumanMessage(content=content))
+            # その他のメッセージタイプは必要に応じて追加
+        return langchain_messages
+
     def _is_json_content(self, content: str) -> bool:
         """コンテンツがJSON形式かどうかを判定"""
         if not content:
             return False
         
         # JSONブロックの検索
-        json_pattern = r'```json\s*(.*?)\s*```'
-        json_match = re.search(json_pattern, content, re.DOTALL)
-        if json_match:
+        if _JSON_BLOCK.search(content):
             return True
             
         # 単純なJSON形式かどうか
         try:
             content_stripped = content.strip()
             if content_stripped.startswith('{') and content_stripped.endswith('}'):
-                json.loads(content_stripped)
+                _json_loads(content_stripped)
                 return True
         except json.JSONDecodeError:
             pass
@@ -205,8 +310,7 @@ class OpenAIClient:
     def _extract_json(self, content: str) -> Dict[str, Any]:
         """テキストからJSONを抽出"""
         # JSONブロックの検索
-        json_pattern = r'```json\s*(.*?)\s*```'
-        json_match = re.search(json_pattern, content, re.DOTALL)
+        json_match = _JSON_BLOCK.search(content)
         
         if json_match:
             json_text = json_match.group(1).strip()
@@ -221,7 +325,7 @@ class OpenAIClient:
                     json_text = json_text[brace_start:]
         
         try:
-            return json.loads(json_text)
+            return _json_loads(json_text)
         except json.JSONDecodeError as e:
             logger.error(f"JSON解析エラー: {e}")
             return {"error": "JSONの解析に失敗しました", "content": content}
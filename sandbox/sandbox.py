@@ -8,18 +8,35 @@ Docker サンドボックス管理モジュール（強化版・日本語コメ
 2. **共有メモリ拡張** — Playwright が安定するよう `shm_size` を 1GiB に。
 3. **タスク単位のワークスペース** — 各コンテナは `/home/ubuntu/workspace/<session_id>` を個別マウント。
 4. **イメージ存在チェックと自動ビルド** — 指定イメージが無い場合は `docker build` を試行。
-5. **安全なコマンド実行** — `exec_run` に `stream=True` を使い、長大出力を途中で切り詰め。
+5. **安全なコマンド実行** — 低レベル exec API をストリームで使い、長大出力を途中で切り詰め。
+6. **ウォームプール** — 専用ディレクトリだけをマウントした起動済みコンテナを事前に用意し、
+   割り当て時にそのディレクトリをセッションのワークスペースとしてリンクする。
 """
 
 from __future__ import annotations
 
+import atexit
+import codecs
+import concurrent.futures
+import io
+import itertools
 import os
+import queue
+import shlex
+import tarfile
+import threading
+import time
 import uuid
 from core.logging_config import logger
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
-import docker
+# docker は requests / urllib3 などを読み込みインポートが重いため、
+# DockerSandbox の初回生成時に読み込む (型ヒント用途のみモジュールレベルで参照)
+if TYPE_CHECKING:
+    import docker
+else:
+    docker = None
 
 from config import CONFIG
 
@@ -30,61 +47,263 @@ from config import CONFIG
 # ---------------------------------------------------------------------------
 
 _WORKSPACE_ROOT = Path(CONFIG["system"]["workspace_dir"]).resolve()
+_WORKSPACE_ROOT_STR = str(_WORKSPACE_ROOT)
 _IMAGE_NAME = CONFIG["docker"]["image_name"]
 _MEMORY_LIMIT = CONFIG["docker"].get("memory_limit", "512m")
 _CPU_LIMIT = CONFIG["docker"].get("cpu_limit", 0.5)
 _ALLOW_SUDO = CONFIG["security"].get("allow_sudo", False)
 _ALLOW_NETWORK = CONFIG["security"].get("allow_network", True)
+_POOL_SIZE = CONFIG["docker"].get("pool_size", 2)
+_CPUSETS = CONFIG["docker"].get("cpusets", [])
+_MEMORY_RESERVATION = CONFIG["docker"].get("memory_reservation")
+# Docker API への keep-alive 接続の最大保持数 (並列停止やプール補充スレッドが同時に使う)
+_API_POOL_MAXSIZE = 64
+# この秒数以内に稼働確認済みのコンテナは reload (デーモンへの HTTP 往復) を省略する
+_STATUS_TTL = 30.0
+# stdout / stderr それぞれの保持上限 (超過分は先頭と末尾を残して中間を切り詰める)
+_OUTPUT_LIMIT = 1 << 20
+_TRUNCATED_MARKER = b"\n...[TRUNCATED]...\n"
+_utf8_decoder = codecs.getincrementaldecoder("utf-8")
+# exec_create に毎回渡す不変オプション
+_EXEC_OPTS = {"stdout": True, "stderr": True, "tty": False}
+
+_WORKSPACE = "/home/ubuntu/workspace"
+# プールのコンテナ専用ディレクトリの接頭辞 (ワークスペースルート直下)。
+# コンテナにはこのディレクトリだけをマウントし、割り当て時にホスト側のセッションディレクトリを
+# このディレクトリへのシンボリックリンクにする (バインドは作成後に変更できないため)
+_POOL_DIR_PREFIX = ".pool-"
+# execute_python の一時スクリプト置き場。Docker のアーカイブ API は tmpfs 上に書き込めないため
+# tmpfs の /tmp ではなくコンテナレイヤ上 (ホストのワークスペース外) に置く
+_SCRIPT_DIR = "/home/ubuntu"
+# イメージ存在確認の結果をプロセス間で共有するマーカー (有効期限内は images.get を省略)
+_IMAGE_MARKER = os.path.join(
+    os.path.expanduser("~"), ".cache", "manus", f"image-{_IMAGE_NAME.replace('/', '_').replace(':', '_')}.ok"
+)
+_IMAGE_MARKER_TTL = 24 * 60 * 60
+# コンテナ内の一時領域はメモリ上に置く
+_TMPFS = {"/tmp": "size=128m,mode=1777"}
 
 
 class DockerSandbox:
     """Docker コンテナを使った分離実行環境。"""
 
     def __init__(self) -> None:
-        self._client = docker.from_env()
+        global docker
+        import docker
+        import docker.utils.socket
+
+        # デーモン接続は 1 つのクライアントで使い回し、接続プールを広げて再接続を避ける
+        self._client = docker.from_env(timeout=60, max_pool_size=_API_POOL_MAXSIZE)
         self._containers: Dict[str, docker.models.containers.Container] = {}
+        self._checked_at: Dict[str, float] = {}  # セッションごとの最終稼働確認時刻
+        self._host_configs: Dict[Tuple[str, Optional[str]], Dict] = {}  # (バインド元, cpuset) -> HostConfig
+        self._cpuset_cycle = itertools.cycle(_CPUSETS) if _CPUSETS else None
+        self._tmp_counter = itertools.count()  # 一時スクリプト名の連番
+        self._shells: Dict[str, _ShellSession] = {}  # セッションごとの常駐 bash
         self._ensure_image()
 
+        # 起動済みの待機コンテナとその専用ディレクトリ (セッション未割り当て)
+        self._idle_pool: "queue.Queue[Tuple[docker.models.containers.Container, str]]" = queue.Queue()
+        self._pool_lock = threading.Lock()
+        self._pool_pending = 0  # 起動中のプール用コンテナ数
+        self._refill_pool()
+        atexit.register(self._drain_pool)
+
     # ------------------------------------------------------------------
     # コンテナライフサイクル
     # ------------------------------------------------------------------
     def _ensure_image(self) -> None:
         """指定イメージが存在しない場合はビルドを試みる。"""
+        # 直近で存在確認済みならデーモンへの問い合わせを省略する
+        try:
+            if time.time() - os.path.getmtime(_IMAGE_MARKER) < _IMAGE_MARKER_TTL:
+                return
+        except OSError:
+            pass
+
         try:
-            self._client.images.get(_IMAGE_NAME)
+            image = self._client.images.get(_IMAGE_NAME)
             logger.info(f"Docker イメージ '{_IMAGE_NAME}' は既に存在します")
         except docker.errors.ImageNotFound:
             dockerfile_path = Path(__file__).parent.parent / "Dockerfile"
             if not dockerfile_path.exists():
                 raise RuntimeError(f"イメージ '{_IMAGE_NAME}' が存在せず、Dockerfile も見つかりません: {dockerfile_path}")
             logger.info(f"Docker イメージ '{_IMAGE_NAME}' をビルド中 …")
-            self._client.images.build(path=str(dockerfile_path.parent), tag=_IMAGE_NAME)
+            # レジストリにキャッシュ用タグがあれば取得し、変更の無いレイヤを再利用する
+            repo = _IMAGE_NAME.rsplit(":", 1)[0] if ":" in _IMAGE_NAME.rsplit("/", 1)[-1] else _IMAGE_NAME
+            cache_tag = f"{repo}:cache"
+            try:
+                self._client.images.pull(repo, tag="cache")
+            except docker.errors.APIError:
+                pass
+            for chunk in self._client.api.build(
+                path=str(dockerfile_path.parent),
+                tag=_IMAGE_NAME,
+                cache_from=[cache_tag, _IMAGE_NAME],
+                decode=True,
+            ):
+                if "error" in chunk:
+                    raise RuntimeError(f"イメージ '{_IMAGE_NAME}' のビルドに失敗しました: {chunk['error']}")
             logger.info("ビルド完了")
+            image = self._client.images.get(_IMAGE_NAME)
+
+        try:
+            os.makedirs(os.path.dirname(_IMAGE_MARKER), exist_ok=True)
+            with open(_IMAGE_MARKER, "w", encoding="utf-8") as f:
+                f.write(image.id)
+        except OSError as exc:
+            logger.warning(f"イメージ確認済みマーカーを書き込めませんでした: {exc}")
+
+    def _run_container(self, name: str, volumes: Dict[str, Dict[str, str]], working_dir: str) -> docker.models.containers.Container:
+        """共通設定で待機用コンテナ (sleep infinity) を起動。
+
+        高レベル API の containers.run は呼び出しごとに引数検証・変換と inspect を行うため、
+        低レベル API で作成・起動し、HostConfig はバインド元ごとにキャッシュして使い回す。
+        """
+        api = self._client.api
+        # cpuset 指定時はコア固定 (クォータによるスロットリングが無い) をコンテナごとに順番に割り当てる
+        cpuset = next(self._cpuset_cycle) if self._cpuset_cycle else None
+        key = (next(iter(volumes)), cpuset)
+        host_config = self._host_configs.get(key)
+        if host_config is None:
+            cpu_opts = (
+                {"cpuset_cpus": cpuset}
+                if cpuset
+                else {"cpu_period": 100_000, "cpu_quota": int(_CPU_LIMIT * 100_000)}
+            )
+            host_config = api.create_host_config(
+                binds=volumes,
+                auto_remove=True,
+                network_mode="bridge" if _ALLOW_NETWORK else "none",
+                mem_limit=_MEMORY_LIMIT,
+                mem_reservation=_MEMORY_RESERVATION,
+                shm_size="1g",
+                tmpfs=_TMPFS,
+                privileged=_ALLOW_SUDO,
+                **cpu_opts,
+            )
+            self._host_configs[key] = host_config
+
+        try:
+            container_id = api.create_container(
+                _IMAGE_NAME,
+                command=["sleep", "infinity"],
+                name=name,
+                working_dir=working_dir,
+                volumes=[v["bind"] for v in volumes.values()],
+                host_config=host_config,
+            )["Id"]
+            api.start(container_id)
+        except docker.errors.APIError:
+            # イメージが消えている可能性があるため、次回起動時は存在確認をやり直す
+            try:
+                os.remove(_IMAGE_MARKER)
+            except OSError:
+                pass
+            raise
+        # 追加の inspect を避け、ID と名前だけでモデルを組み立てる (状態は reload 時に取得)
+        return self._client.containers.prepare_model({"Id": container_id, "Name": name})
+
+    def _refill_pool(self) -> None:
+        """待機中と起動中のコンテナが合わせて _POOL_SIZE になるまで補充スレッドを起動。"""
+        with self._pool_lock:
+            missing = _POOL_SIZE - self._idle_pool.qsize() - self._pool_pending
+            if missing <= 0:
+                return
+            self._pool_pending += missing
+        for _ in range(missing):
+            threading.Thread(target=self._fill_pool, daemon=True).start()
+
+    def _fill_pool(self) -> None:
+        """プール用コンテナを 1 つ起動して待機キューに積む (バックグラウンドスレッドで実行)。"""
+        name = f"manus-pool-{uuid.uuid4().hex[:8]}"
+        pool_dir = os.path.join(_WORKSPACE_ROOT_STR, _POOL_DIR_PREFIX + name)
+        try:
+            os.makedirs(pool_dir)
+            container = self._run_container(name, {pool_dir: {"bind": _WORKSPACE, "mode": "rw"}}, _WORKSPACE)
+        except Exception as exc:
+            logger.warning(f"プール用コンテナの起動に失敗しました: {exc}")
+            _remove_empty_dir(pool_dir)
+            container = None
+        # 待機キューへの追加と起動中の数の更新はまとめて行い、補充数の計算とずれないようにする
+        with self._pool_lock:
+            self._pool_pending -= 1
+            if container is not None:
+                self._idle_pool.put((container, pool_dir))
+
+    def _checkout_pooled(self, session_id: str) -> Optional[docker.models.containers.Container]:
+        """プールから起動済みコンテナを取り出し、その専用ディレクトリをセッションのワークスペースにする。"""
+        session_dir = os.path.join(_WORKSPACE_ROOT_STR, session_id)
+        # 既存のワークスペースは中身を持つ可能性があるので、専用コンテナを作る
+        # (空のディレクトリだけは事前に作られたものとみなしてリンクに差し替える)
+        try:
+            if os.path.islink(session_dir) or (os.path.isdir(session_dir) and os.listdir(session_dir)):
+                return None
+        except OSError:
+            return None
+        try:
+            container, pool_dir = self._idle_pool.get_nowait()
+        except queue.Empty:
+            return None
+        self._refill_pool()
+
+        try:
+            _remove_empty_dir(session_dir)
+            os.makedirs(_WORKSPACE_ROOT_STR, exist_ok=True)
+            # ワークスペースルートごと移動しても辿れるよう相対パスでリンクする
+            os.symlink(os.path.basename(pool_dir), session_dir)
+        except OSError as exc:
+            logger.warning(f"プールのコンテナを割り当てられませんでした: {session_id} ({exc})")
+            self._idle_pool.put((container, pool_dir))
+            return None
+        _ensured_dirs.add(session_id)
+
+        self._containers[session_id] = container
+        logger.info(f"プールのコンテナを割り当て: {container.name} -> {session_id}")
+        return container
+
+    def release(self, session_id: str) -> None:
+        """セッションのコンテナを停止・削除する (プロセスや /tmp を次のセッションに持ち越さない)。"""
+        container = self._containers.pop(session_id, None)
+        self._checked_at.pop(session_id, None)
+        self._close_shell(session_id)
+        if container is not None:
+            self._stop_quietly(container)
+
+    def _drain_pool(self) -> None:
+        """プロセス終了時に待機中のコンテナを停止し、未使用の専用ディレクトリを削除。"""
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle_pool.get_nowait())
+            except queue.Empty:
+                break
+        # 未使用のコンテナは正常終了を待つ必要が無いので即 kill する (auto_remove で削除される)
+        _parallel(self._kill_quietly, [container for container, _ in idle])
+        for _, pool_dir in idle:
+            _remove_empty_dir(pool_dir)
+
+    def _kill_quietly(self, container) -> None:
+        try:
+            self._client.api.kill(container.id, signal="SIGKILL")
+        except Exception:
+            pass
+
+    @staticmethod
+    def _stop_quietly(container) -> None:
+        try:
+            container.stop(timeout=2)
+        except Exception:
+            pass
 
     def _create_container(self, session_id: str) -> docker.models.containers.Container:
         """新規コンテナを作成し、永続マッピングを設定。"""
-        workdir_host = _WORKSPACE_ROOT / session_id
-        workdir_host.mkdir(parents=True, exist_ok=True)
-
-        container = self._client.containers.run(
-            _IMAGE_NAME,
-            command="sleep infinity",
-            detach=True,
-            remove=True,
-            name=f"manus-{session_id}",
-            network_mode="bridge" if _ALLOW_NETWORK else "none",
-            mem_limit=_MEMORY_LIMIT,
-            cpu_period=100_000,
-            cpu_quota=int(_CPU_LIMIT * 100_000),
-            volumes={
-                str(workdir_host): {
-                    "bind": "/home/ubuntu/workspace",
-                    "mode": "rw",
-                }
-            },
-            working_dir="/home/ubuntu/workspace",
-            shm_size="1g",
-            privileged=_ALLOW_SUDO,
+        workdir_host = _ensure_session_dir(session_id)
+
+        container = self._run_container(
+            f"manus-{session_id}",
+            {workdir_host: {"bind": _WORKSPACE, "mode": "rw"}},
+            _WORKSPACE,
         )
         self._containers[session_id] = container
         logger.info(f"コンテナ起動: {container.name}")
@@ -93,51 +312,308 @@ class DockerSandbox:
     def _get_container(self, session_id: str):
         if session_id in self._containers:
             cont = self._containers[session_id]
-            cont.reload()
-            if cont.status != "running":
-                cont.start()
+            # 直近で稼働確認済みならキャッシュした状態を信用する (exec 失敗時に無効化)
+            if time.monotonic() - self._checked_at.get(session_id, 0.0) > _STATUS_TTL:
+                cont.reload()
+                if cont.status != "running":
+                    cont.start()
+                self._checked_at[session_id] = time.monotonic()
             return cont
-        return self._create_container(session_id)
+        cont = self._checkout_pooled(session_id) or self._create_container(session_id)
+        self._checked_at[session_id] = time.monotonic()
+        return cont
+
+    def _invalidate(self, session_id: str) -> None:
+        """キャッシュしたコンテナを破棄し、次回取得時に作り直させる。"""
+        self._containers.pop(session_id, None)
+        self._checked_at.pop(session_id, None)
+        self._close_shell(session_id)
+
+    def _close_shell(self, session_id: str) -> None:
+        shell = self._shells.pop(session_id, None)
+        if shell is not None:
+            shell.close()
 
     # ------------------------------------------------------------------
     # コマンド実行 API
     # ------------------------------------------------------------------
-    def execute_command(self, session_id: str, command: str, cwd: str = "/home/ubuntu/workspace") -> Tuple[str, str, int]:
-        cont = self._get_container(session_id)
-        cmd = f"bash -c 'cd {cwd} && {command}'"
-        exec_res = cont.exec_run(cmd, demux=True, stream=False, tty=False)
-        stdout, stderr = exec_res.output if exec_res.output else (b"", b"")
-        return stdout.decode(), stderr.decode(), exec_res.exit_code
+    def execute_command(self, session_id: str, command: str, cwd: str = "/home/ubuntu/workspace",
+                        prepare: Optional[Callable] = None) -> Tuple[str, str, int]:
+        """コマンドを実行する。prepare はコンテナを作り直したときに、実行前に新しいコンテナへ適用する。"""
+        # 常駐 bash があれば exec を作らずにソケット経由で実行する
+        try:
+            cont = self._get_container(session_id)
+            shell = self._shells.get(session_id)
+            if shell is None:
+                shell = _ShellSession(self._client.api, cont.id)
+                self._shells[session_id] = shell
+            return shell.run(command, cwd)
+        except _ShellInterrupted as exc:
+            # 送信済みのコマンドは実行された可能性があるため、再実行せずにエラーとして返す
+            logger.warning(f"常駐シェルとの通信がコマンド送信後に失敗しました: {session_id} ({exc})")
+            self._close_shell(session_id)
+            return "", f"常駐シェルとの通信に失敗しました (コマンドは実行された可能性があります): {exc}", -1
+        except Exception as exc:
+            logger.warning(f"常駐シェルでの実行に失敗したため exec にフォールバックします: {session_id} ({exc})")
+            self._close_shell(session_id)
+
+        # argv 形式で渡し、コマンド中の引用符をシェル側で再解釈させない
+        cmd = ["bash", "-c", f"cd {shlex.quote(cwd)} && {command}"]
+        try:
+            return self._exec_streaming(self._get_container(session_id), cmd)
+        except docker.errors.APIError as exc:
+            # コンテナが消えている/停止している (404/409) 場合は作り直して 1 回だけ再試行
+            if exc.status_code not in (404, 409):
+                raise
+            logger.warning(f"コンテナが利用できないため再作成します: {session_id} ({exc.status_code})")
+            self._invalidate(session_id)
+            cont = self._get_container(session_id)
+            if prepare is not None:
+                prepare(cont)
+            return self._exec_streaming(cont, cmd)
+
+    def _exec_streaming(self, cont, cmd: List[str]) -> Tuple[str, str, int]:
+        """exec の出力をストリームで受け取り、上限付きバッファに溜めながら実行。"""
+        api = self._client.api
+        exec_id = api.exec_create(cont.id, cmd, **_EXEC_OPTS)["Id"]
+        stdout, stderr = _BoundedOutput(), _BoundedOutput()
+        for out, err in api.exec_start(exec_id, stream=True, demux=True):
+            if out:
+                stdout.write(out)
+            if err:
+                stderr.write(err)
+        exit_code = api.exec_inspect(exec_id)["ExitCode"]
+        return stdout.text(), stderr.text(), exit_code
 
     def execute_python(self, session_id: str, code: str, cwd: str = "/home/ubuntu/workspace") -> Tuple[str, str, int]:
-        cont = self._get_container(session_id)
-        tmp_name = f"/home/ubuntu/workspace/__tmp_{uuid.uuid4().hex[:8]}.py"
-        cont.exec_run(f"bash -c 'echo {json_escape(code)} > {tmp_name}'")
-        return self.execute_command(session_id, f"python3 {tmp_name}", cwd)
+        # 同一コンテナを複数プロセスが使う場合に備えて PID を含める
+        tmp_name = f"__tmp_{os.getpid()}_{next(self._tmp_counter)}.py"
+        tmp_path = f"{_SCRIPT_DIR}/{tmp_name}"
+        archive = _tar_single_file(tmp_name, code.encode("utf-8"))
+
+        def upload(cont) -> None:
+            # スクリプトは tar として直接転送する (書き込み用の exec とシェルのエスケープが不要)
+            cont.put_archive(_SCRIPT_DIR, archive)
+
+        try:
+            upload(self._get_container(session_id))
+        except docker.errors.APIError as exc:
+            # 稼働確認をキャッシュしている間にコンテナが消えた/停止した場合は作り直して 1 回だけ再試行
+            if exc.status_code not in (404, 409):
+                raise
+            logger.warning(f"コンテナが利用できないため再作成します: {session_id} ({exc.status_code})")
+            self._invalidate(session_id)
+            upload(self._get_container(session_id))
+        # 実行後はスクリプトを削除し、終了コードはそのまま返す。
+        # 実行時にコンテナを作り直した場合は、新しいコンテナにスクリプトを転送し直す
+        return self.execute_command(
+            session_id, f"python3 {tmp_path}; rc=$?; rm -f {tmp_path}; exit $rc", cwd, prepare=upload
+        )
 
     def cleanup(self):
-        for cid, cont in list(self._containers.items()):
-            try:
-                cont.stop(timeout=2)
-            except Exception:
-                pass
+        # 停止は猶予時間待ちが支配的なので並列に行う (合計時間 ≒ 最大の猶予時間)
+        _parallel(self._stop_quietly, list(self._containers.values()))
         self._containers.clear()
+        self._checked_at.clear()
+        for session_id in list(self._shells):
+            self._close_shell(session_id)
+        self._drain_pool()
 
 
 # シングルトンインスタンス ----------------------------------------------------
 _sandbox_instance: Optional[DockerSandbox] = None
+_sandbox_lock = threading.Lock()
 
 def get_sandbox() -> DockerSandbox:
     global _sandbox_instance
-    if _sandbox_instance is None:
-        _sandbox_instance = DockerSandbox()
+    if _sandbox_instance is not None:
+        return _sandbox_instance
+    # 複数スレッドから同時に初回呼び出しされてもインスタンスは 1 つだけ作る
+    with _sandbox_lock:
+        if _sandbox_instance is None:
+            _sandbox_instance = DockerSandbox()
     return _sandbox_instance
 
+_exit_released_sessions: set = set()
+
+def release_at_exit(session_id: str) -> str:
+    """ツール既定のセッション ID を返す (初回利用時にプロセス終了時の解放を登録する)。
+
+    既定のセッションのコンテナは呼び出し間で使い回すので、終了時にまとめて停止する。
+    """
+    if session_id not in _exit_released_sessions:
+        _exit_released_sessions.add(session_id)
+        atexit.register(get_sandbox().release, session_id)
+    return session_id
+
 # ---------------------------------------------------------------------------
 # ヘルパー関数
 # ---------------------------------------------------------------------------
 
-def json_escape(text: str) -> str:
-    """シングルクォート安全のため JSON エスケープ。"""
-    import json as _json
-    return _json.dumps(text)[1:-1].replace("'", "'\''")
+def _parallel(func, items: List) -> None:
+    """items の各要素に func をスレッドで並列適用。"""
+    if not items:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(items))) as ex:
+        list(ex.map(func, items))
+
+
+_ensured_dirs: set = set()
+
+
+def _remove_empty_dir(path: str) -> None:
+    """空のディレクトリなら削除 (存在しない・空でない場合は何もしない)。"""
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def _ensure_session_dir(session_id: str) -> str:
+    """ホスト側のセッション用ディレクトリを作成してパスを返す (作成済みは syscall を省略)。"""
+    path = os.path.join(_WORKSPACE_ROOT_STR, session_id)
+    if session_id not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(session_id)
+    return path
+
+
+class _ShellInterrupted(RuntimeError):
+    """コマンドの送信後に常駐シェルとの通信が失敗した (コマンドは実行された可能性がある)。"""
+
+
+class _ShellSession:
+    """
+    コンテナ内で常駐させた bash に stdin 経由でコマンドを送る実行セッション。
+    コマンドごとの exec_create / exec_start / exec_inspect の往復とプロセス生成を省く。
+    """
+
+    def __init__(self, api, container_id: str) -> None:
+        exec_id = api.exec_create(container_id, ["bash"], stdin=True, **_EXEC_OPTS)["Id"]
+        self._sock = api.exec_start(exec_id, socket=True)
+        self._lock = threading.Lock()
+
+    def run(self, command: str, cwd: str) -> Tuple[str, str, int]:
+        token = uuid.uuid4().hex
+        out_marker = f"__END_{token}__".encode()
+        err_marker = f"__ERR_{token}__".encode()
+        # サブシェルで実行し、exit や cd が常駐シェルに影響しないようにする。
+        # コマンドは eval に引用済み文字列で渡し、構文エラーで常駐シェルが入力待ちにならないようにする。
+        # stdin は /dev/null にして後続の入力 (終了マーカー) を読まれないようにする。
+        script = (
+            f"( cd {shlex.quote(cwd)} && eval {shlex.quote(command)} ) < /dev/null\n"
+            f"printf '%s%d\\n' {out_marker.decode()} $?\n"
+            f"printf '%s' {err_marker.decode()} >&2\n"
+        )
+        with self._lock:
+            self._write_all(script.encode())
+            try:
+                return self._read_result(out_marker, err_marker)
+            except Exception as exc:
+                raise _ShellInterrupted(str(exc) or type(exc).__name__) from exc
+
+    def _write_all(self, data: bytes) -> None:
+        """exec ソケット (SocketIO) の write は一部しか送らないことがあるので全て送るまで繰り返す。
+
+        1 バイトも送る前の失敗はそのまま送出し (呼び出し側で exec による再実行ができる)、
+        途中まで送った後の失敗は _ShellInterrupted にする。
+        """
+        view = memoryview(data)
+        while view:
+            try:
+                written = self._sock.write(view)
+                if not written:
+                    raise ConnectionError("常駐シェルへの書き込みに失敗しました")
+            except Exception as exc:
+                if len(view) < len(data):
+                    raise _ShellInterrupted(str(exc) or type(exc).__name__) from exc
+                raise
+            view = view[written:]
+
+    def _read_result(self, out_marker: bytes, err_marker: bytes) -> Tuple[str, str, int]:
+        """終了マーカーまでの出力と終了コードを読み取る。"""
+        stdout, stderr = _BoundedOutput(), _BoundedOutput()
+        sock_utils = docker.utils.socket
+        STDOUT, STDERR = sock_utils.STDOUT, sock_utils.STDERR
+        pending = {STDOUT: bytearray(), STDERR: bytearray()}
+        sinks = {STDOUT: stdout, STDERR: stderr}
+        markers = {STDOUT: out_marker, STDERR: err_marker}
+        keep = len(out_marker) + 16
+        exit_code: Optional[int] = None
+        err_done = False
+
+        for stream, data in sock_utils.frames_iter(self._sock, tty=False):
+            buf = pending[stream]
+            buf += data
+            pos = buf.find(markers[stream])
+            if pos >= 0:
+                if stream == STDOUT:
+                    end = buf.find(b"\n", pos)
+                    if end < 0:
+                        continue  # 終了コードの途中まで
+                    exit_code = int(buf[pos + len(out_marker):end])
+                else:
+                    err_done = True
+                sinks[stream].write(buf[:pos])
+                buf.clear()
+                if exit_code is not None and err_done:
+                    break
+            elif len(buf) > keep:
+                # マーカーが分割されて届く場合に備え、末尾だけ残して書き出す
+                sinks[stream].write(buf[:-keep])
+                del buf[:-keep]
+        else:
+            raise ConnectionError("常駐シェルが終了しました")
+
+        return stdout.text(), stderr.text(), exit_code
+
+    def close(self) -> None:
+        try:
+            self._sock.close()
+        except Exception:
+            pass
+
+
+class _BoundedOutput:
+    """先頭と末尾を最大 _OUTPUT_LIMIT/2 バイトずつ保持する出力バッファ。"""
+
+    def __init__(self, limit: int = _OUTPUT_LIMIT) -> None:
+        self._half = limit // 2
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._truncated = False
+
+    def write(self, data: bytes) -> None:
+        room = self._half - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        if data:
+            self._tail += data
+            if len(self._tail) > self._half:
+                del self._tail[:-self._half]
+                self._truncated = True
+
+    def text(self) -> str:
+        # 先頭と末尾を連結せずに順にデコードする (中間コピーを作らない)。
+        # 切り詰めていなければ先頭と末尾は連続しているので、
+        # 境界をまたぐマルチバイト文字はインクリメンタルデコーダが繋げる。
+        decoder = _utf8_decoder(errors="replace")
+        head = decoder.decode(self._head)
+        if not self._truncated:
+            return head + decoder.decode(self._tail, final=True)
+        decoder.reset()
+        marker = _TRUNCATED_MARKER.decode()
+        return head + marker + decoder.decode(self._tail, final=True)
+
+
+def _tar_single_file(name: str, data: bytes) -> bytes:
+    """put_archive 用に 1 ファイルだけを含む tar をメモリ上に作成。"""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        info = tarfile.TarInfo(name=name)
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
@@ -4,40 +4,164 @@
 """
 from core.logging_config import logger
 import asyncio
+import ast
+import atexit
+import functools
+import hashlib
+import importlib.util
+import io
+import multiprocessing
 import os
+import threading
+import tokenize
+from concurrent.futures import ProcessPoolExecutor
 import json
 import re
 from typing import Optional, Union, Dict, Any, List, Tuple
-from urllib.parse import urlparse
-from sandbox.sandbox import get_sandbox
+from sandbox.sandbox import get_sandbox, release_at_exit
 from tools.tool_registry import tool
+from tools.pdf_worker import extract_pages_pypdf2, extract_pages_pymupdf, ocr_image_files, ocr_image_files_batched
 from playwright.async_api import async_playwright, Page
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+# 任意依存: libuv ベースの高速イベントループ (無ければ標準の asyncio ループ)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# 任意依存: C 実装の HTML パーサ (あれば Markdown 抽出をブラウザ外で行う)。
+# selectolax 1.x では Modest バックエンド (selectolax.parser) が削除されたので Lexbor を使う
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# 任意依存: PDF テキスト抽出 (PyPDF2 -> PyMuPDF -> OCR の順に、使えるものを試す)
+try:
+    import PyPDF2
+except ImportError:
+    PyPDF2 = None
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+try:
+    import pdf2image
+except ImportError:
+    pdf2image = None
+try:
+    import pytesseract  # tesserocr が無いワーカーでのフォールバック
+except ImportError:
+    pytesseract = None
+# EasyOCR があればバッチ推論で OCR する (torch を読み込むので import は初回利用時まで遅らせる)
+_HAS_EASYOCR = importlib.util.find_spec("easyocr") is not None
 
 
 
 # グローバル変数
+_playwright = None
+_browser = None
 _browser_context = None
 _current_page = None
+# 初期化の競合で Playwright が二重に起動しないようにする
+_browser_lock = asyncio.Lock()
+
+_VIEWPORT = {"width": 1280, "height": 800}
+_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36"
+
+# ---------------------------------------------------------------------------
+# 同期ラッパ用の常駐イベントループ
+# ---------------------------------------------------------------------------
+# ツール呼び出しごとにループを作り直さず、専用スレッドの 1 つのループで全コルーチンを実行する。
+# Playwright のオブジェクト (_browser_context など) もこのループに紐づいたまま再利用できる。
+# uvloop はこのループにだけ使い、プロセス全体のイベントループポリシーは変更しない。
+_RUN_LOOP = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+_loop_thread = threading.Thread(target=_RUN_LOOP.run_forever, name="browser-loop", daemon=True)
+_loop_thread.start()
+
+def _run(coro):
+    """コルーチンを常駐ループで実行し、結果を同期的に返す"""
+    if threading.current_thread() is _loop_thread:
+        # ループスレッド内から待つとデッドロックし、実行中のループの中で別のループも回せない
+        coro.close()
+        raise RuntimeError("ブラウザツールの同期 API は常駐ループ内から呼び出せません (コルーチンを直接 await してください)")
+    return asyncio.run_coroutine_threadsafe(coro, _RUN_LOOP).result()
+
+# ヘッドレス実行で不要な GPU・拡張機能・バックグラウンド処理を止める起動オプション
+_CHROMIUM_ARGS = [
+    "--disable-gpu",
+    "--no-sandbox",
+    "--disable-dev-shm-usage",  # コンテナの小さい /dev/shm ではなく /tmp を使う
+    "--disable-background-networking",
+    "--disable-extensions",
+    "--disable-renderer-backgrounding",
+    "--disable-ipc-flooding-protection",
+    "--no-zygote",
+    "--disable-features=Translate,BackForwardCache",
+]
 
 async def _ensure_browser(headless: bool = True):
     """ブラウザセッションが存在することを確認し、必要に応じて初期化する"""
-    global _browser_context, _current_page
+    global _playwright, _browser, _browser_context, _current_page
     
     if _browser_context is not None:
         return _browser_context, _current_page
     
-    p = await async_playwright().start()
-    browser = await p.chromium.launch(headless=headless)
-    context = await browser.new_context(
-        viewport={"width": 1280, "height": 800},
-        user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36"
-    )
-    
-    _browser_context = context
-    _current_page = await context.new_page()
+    async with _browser_lock:
+        # ロック待ちの間に他の呼び出しが初期化を終えていればそれを使う
+        if _browser_context is not None:
+            return _browser_context, _current_page
+        
+        _playwright = await async_playwright().start()
+        _browser = await _playwright.chromium.launch(headless=headless, args=_CHROMIUM_ARGS)
+        context = await _browser.new_context(
+            viewport=_VIEWPORT,
+            bypass_csp=True,  # CSP のあるページでも browser_run_javascript 等の注入を妨げない
+            user_agent=_USER_AGENT
+        )
+        # Markdown 抽出関数を各ドキュメントに一度だけ定義しておき、抽出時は呼び出すだけにする
+        # (selectolax があれば抽出はブラウザ外で行うので不要)
+        if HTMLParser is None:
+            await context.add_init_script(f"window.__extractMarkdown = {_CONTENT_MARKDOWN_JS};")
+        
+        _current_page = await context.new_page()
+        _browser_context = context
     
     return context, _current_page
 
+async def _shutdown_browser():
+    """ブラウザと Playwright ドライバを終了する"""
+    global _playwright, _browser, _browser_context, _current_page
+    
+    _browser_context = _current_page = None
+    if _browser is not None:
+        await _browser.close()
+        _browser = None
+    if _playwright is not None:
+        await _playwright.stop()
+        _playwright = None
+
+async def _shutdown():
+    """ブラウザと共有 HTTP セッションを閉じる"""
+    global _http_session
+    
+    await _shutdown_browser()
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+def _close_browser_at_exit():
+    """終了時にブラウザを閉じる (ドライバが残って終了が待たされるのを防ぐ)"""
+    if (_browser is None and _http_session is None) or not _loop_thread.is_alive():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_shutdown(), _RUN_LOOP).result(timeout=10)
+    except Exception as e:
+        logger.warning(f"ブラウザの終了に失敗しました: {str(e)}")
+
+atexit.register(_close_browser_at_exit)
+
 @tool(
     name="browser_navigate",
     description="Playwrightで指定URLにアクセスする",
@@ -60,26 +184,71 @@ def browser_navigate(url: str):
         ページの内容とタイトルを含む文字列
     """
     # 同期関数として実行
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_navigate_async(url))
-    loop.close()
+    res = _run(_navigate_async(url))
     return res
 
+# DOM の変更が quiet ミリ秒途切れるまで (最長 max ミリ秒) 待つ。SPA の描画や無限スクロールの追加読み込み用
+_DOM_QUIET_JS = """(args) => new Promise(resolve => {
+    const target = document.body || document.documentElement;
+    if (!target) { resolve(); return; }
+    let timer = null;
+    let cap = null;
+    const observer = new MutationObserver(() => {
+        clearTimeout(timer);
+        timer = setTimeout(done, args.quiet);
+    });
+    function done() {
+        observer.disconnect();
+        clearTimeout(timer);
+        clearTimeout(cap);
+        resolve();
+    }
+    observer.observe(target, {childList: true, subtree: true, characterData: true});
+    timer = setTimeout(done, args.quiet);
+    cap = setTimeout(done, args.max);
+})"""
+
+async def _wait_for_load(page: Page, state: str, timeout: int):
+    """ロード状態を待つ。タイムアウトしてもそのまま続行する"""
+    try:
+        await page.wait_for_load_state(state, timeout=timeout)
+    except PlaywrightTimeoutError:
+        logger.debug(f"ロード待機がタイムアウトしました: {state}")
+
+async def _wait_for_settle(page: Page, quiet: int = 200, max_wait: int = 1000):
+    """DOM の変更が落ち着くまで待つ (変化が無ければ quiet ミリ秒で戻る)"""
+    try:
+        await page.evaluate(_DOM_QUIET_JS, {"quiet": quiet, "max": max_wait})
+    except Exception as e:
+        # 待機中にナビゲーションが起きると実行コンテキストが破棄される
+        logger.debug(f"DOM 待機を中断しました: {str(e)}")
+
+async def _after_action(page: Page):
+    """クリック・Enter 後の待機。遷移すれば読み込みを、しなければ DOM の更新を待つ"""
+    await _wait_for_load(page, "domcontentloaded", 3000)
+    await _wait_for_settle(page)
+
+# http / https のスキーム (大文字小文字を区別しない)
+_URL_SCHEME_RE = re.compile(r"https?://", re.I)
+
+def _normalize_url(url: str) -> str:
+    """前後の空白を除き、スキームが無ければ https:// を補う"""
+    url = url.strip()
+    return url if _URL_SCHEME_RE.match(url) else "https://" + url
+
 async def _navigate_async(url: str):
     """非同期でURLにアクセスし、ページ内容を取得"""
     context, page = await _ensure_browser(headless=True)
     
     try:
         # URLにプロトコルがなければ追加
-        if not url.startswith(('http://', 'https://')):
-            url = f"https://{url}"
+        url = _normalize_url(url)
         
         # ページにアクセス
         await page.goto(url, timeout=30000, wait_until="domcontentloaded")
         
-        # ページが完全に読み込まれるまで少し待機
-        await asyncio.sleep(2)
+        # ネットワークが落ち着くまで待機 (固定待ちの代わり。最長は従来と同じ 2 秒)
+        await _wait_for_load(page, "networkidle", 2000)
         
         # ページのタイトルとURLを取得
         title = await page.title()
@@ -104,77 +273,187 @@ async def _navigate_async(url: str):
         logger.error(error_message)
         return error_message
 
+# 可視テキストを Markdown 風に連結する。断片は配列に積み、最後に 1 回だけ join する
+# (再帰ごとの文字列連結は DOM サイズに対して二乗のコピーになるため)。
+# 走査は TreeWalker による反復で行い (再帰しないので深くネストした DOM でもスタックを消費しない)、
+# 表示判定は offsetParent で済ませる
+# (getComputedStyle は offsetParent が無い要素 = 非表示か position:fixed の確認にだけ使う)。
+# 切り詰めもブラウザ内で行い、上限 (空行の圧縮分の余裕を見て 2 倍) を超えたら走査を打ち切る。
+_CONTENT_MARKDOWN_JS = """(args) => {
+    const root = document.body;
+    if (!root) return '';
+    const parts = [];
+    let size = 0;
+    const push = (...items) => { for (const s of items) { parts.push(s); size += s.length; } };
+    const finish = () => {
+        const text = parts.join('').replace(/\\n\\s*\\n\\s*\\n/g, '\\n\\n').trim();
+        return text.length > args.limit ? text.slice(0, args.limit) + args.suffix : text;
+    };
+    const walker = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT | NodeFilter.SHOW_TEXT);
+    
+    const isHidden = (el) => el !== root && el.offsetParent === null
+        && window.getComputedStyle(el).position !== 'fixed';
+    
+    // ノードに入る時の出力。子を辿る場合は true を返す
+    function enter(node) {
+        // テキストノードの場合
+        if (node.nodeType === Node.TEXT_NODE) {
+            const text = node.textContent.trim();
+            if (text) push(text, ' ');
+            return false;
+        }
+        // 非表示要素をスキップ
+        if (isHidden(node)) return false;
+        
+        // 要素の種類に基づいてマークダウン形式に変換
+        const tagName = node.tagName.toLowerCase();
+        if (/^h[1-6]$/.test(tagName)) {
+            push('\\n' + '#'.repeat(parseInt(tagName.charAt(1))) + ' ');  // 見出し
+        } else if (tagName === 'p') {
+            push('\\n\\n');  // 段落
+        } else if (tagName === 'li') {
+            push('\\n- ');  // リスト項目
+        } else if (tagName === 'tr') {
+            push('\\n|');  // テーブル行
+        } else if (tagName === 'td' || tagName === 'th') {
+            push(' ');  // テーブルデータ
+        }
+        return true;
+    }
+    
+    // 子を辿り終えて要素から出る時の出力
+    function leave(node) {
+        const tagName = node.tagName.toLowerCase();
+        if (tagName === 'div' || tagName === 'section' || tagName === 'article') {
+            push('\\n');
+        } else if (tagName === 'td' || tagName === 'th') {
+            push(' |');
+        }
+    }
+    
+    let expand = enter(root);
+    for (;;) {
+        if (size > args.limit * 2) return finish();
+        if (expand && walker.firstChild()) {
+            expand = enter(walker.currentNode);
+            continue;
+        }
+        if (expand) leave(walker.currentNode);
+        // 次の兄弟へ。無ければ親に戻りながら親から出る
+        for (;;) {
+            if (walker.currentNode === root) return finish();
+            if (walker.nextSibling()) {
+                expand = enter(walker.currentNode);
+                break;
+            }
+            walker.parentNode();
+            leave(walker.currentNode);
+        }
+    }
+}"""
+
+# 抽出する Markdown の最大文字数
+_MAX_MARKDOWN_CHARS = 10000
+_TRUNCATED_SUFFIX = "...\n\n(コンテンツが長すぎるため切り詰められました)"
+
+# テキストを出力しない要素
+_SKIP_TAGS = frozenset({"script", "style", "noscript", "template", "head", "svg", "iframe"})
+# インライン style による非表示指定
+_HIDDEN_STYLE_RE = re.compile(r"(?:display\s*:\s*none|visibility\s*:\s*hidden)", re.I)
+# 3 行以上続く空行
+_BLANK_LINES_RE = re.compile(r"\n\s*\n\s*\n")
+
+def _is_hidden_node(node) -> bool:
+    """ブラウザ外で判定できる範囲の非表示要素 (JS で付与された display:none は判定できない)"""
+    if node.tag in _SKIP_TAGS:
+        return True
+    attrs = node.attributes
+    if "hidden" in attrs or attrs.get("aria-hidden") == "true":
+        return True
+    if attrs.get("type") == "hidden":
+        return True
+    style = attrs.get("style")
+    return bool(style) and _HIDDEN_STYLE_RE.search(style) is not None
+
+def _iter_markdown_parts(root):
+    """_CONTENT_MARKDOWN_JS と同じ規則で Markdown の断片を順に返す (明示スタックによる反復走査)"""
+    # スタックの要素は (ノード, 子から戻った後か)
+    stack = [(root, False)]
+    while stack:
+        node, leaving = stack.pop()
+        tag = node.tag
+        if leaving:
+            if tag in ("div", "section", "article"):
+                yield "\n"
+            elif tag in ("td", "th"):
+                yield " |"
+            continue
+        
+        # テキストノードの場合
+        if tag == "-text":
+            text = node.text(deep=False).strip()
+            if text:
+                yield text
+                yield " "
+            continue
+        # コメント等と非表示要素をスキップ
+        if tag.startswith("-") or (node is not root and _is_hidden_node(node)):
+            continue
+        
+        # 要素の種類に基づいてマークダウン形式に変換
+        if len(tag) == 2 and tag[0] == "h" and tag[1] in "123456":
+            yield "\n" + "#" * int(tag[1]) + " "  # 見出し
+        elif tag == "p":
+            yield "\n\n"  # 段落
+        elif tag == "li":
+            yield "\n- "  # リスト項目
+        elif tag == "tr":
+            yield "\n|"  # テーブル行
+        elif tag in ("td", "th"):
+            yield " "  # テーブルデータ
+        
+        stack.append((node, True))
+        children = []
+        child = node.child
+        while child is not None:
+            children.append(child)
+            child = child.next
+        stack.extend((c, False) for c in reversed(children))
+
+def _html_to_markdown(html: str, limit: int = _MAX_MARKDOWN_CHARS) -> str:
+    """HTML を selectolax で解析し、Markdown 形式のテキストに変換する (limit 文字で切り詰め)"""
+    body = HTMLParser(html).body
+    if body is None:
+        return ""
+    parts = []
+    size = 0
+    for part in _iter_markdown_parts(body):
+        parts.append(part)
+        size += len(part)
+        # 空行の圧縮で縮む分の余裕を見て、上限の 2 倍を超えたら走査を打ち切る
+        if size > limit * 2:
+            break
+    markdown = _BLANK_LINES_RE.sub("\n\n", "".join(parts)).strip()
+    if len(markdown) > limit:
+        markdown = markdown[:limit] + _TRUNCATED_SUFFIX
+    return markdown
+
 async def _extract_content_as_markdown(page: Page) -> str:
     """ページの内容をMarkdown形式で抽出"""
     try:
-        # ページからテキストコンテンツを抽出するJavaScriptを実行
-        markdown = await page.evaluate("""() => {
-            function getVisibleText(element, depth = 0) {
-                if (!element) return '';
-                
-                // 非表示要素をスキップ
-                const style = window.getComputedStyle(element);
-                if (style.display === 'none' || style.visibility === 'hidden' || style.opacity === '0') {
-                    return '';
-                }
-                
-                // テキストノードの場合
-                if (element.nodeType === Node.TEXT_NODE) {
-                    return element.textContent.trim() ? element.textContent.trim() + ' ' : '';
-                }
-                
-                // 要素の種類に基づいてマークダウン形式に変換
-                let md = '';
-                const tagName = element.tagName ? element.tagName.toLowerCase() : '';
-                
-                // 見出し
-                if (tagName.match(/^h[1-6]$/)) {
-                    const level = tagName.charAt(1);
-                    let prefix = '';
-                    for (let i = 0; i < parseInt(level); i++) {
-                        prefix += '#';
-                    }
-                    md += `\\n${prefix} `;
-                }
-                // 段落
-                else if (tagName === 'p') {
-                    md += '\\n\\n';
-                }
-                // リスト項目
-                else if (tagName === 'li') {
-                    md += '\\n- ';
-                }
-                // テーブル行
-                else if (tagName === 'tr') {
-                    md += '\\n|';
-                }
-                // テーブルデータ
-                else if (tagName === 'td' || tagName === 'th') {
-                    md += ' ';
-                }
-                
-                // 子要素を再帰的に処理
-                for (const child of element.childNodes) {
-                    md += getVisibleText(child, depth + 1);
-                }
-                
-                // 特定の要素の後に改行を追加
-                if (tagName === 'div' || tagName === 'section' || tagName === 'article') {
-                    md += '\\n';
-                }
-                else if (tagName === 'td' || tagName === 'th') {
-                    md += ' |';
-                }
-                
-                return md;
-            }
-            
-            return getVisibleText(document.body).replace(/\\n\\s*\\n\\s*\\n/g, '\\n\\n').trim();
-        }""")
-        
-        # 長すぎる場合は切り詰める
-        if len(markdown) > 10000:
-            markdown = markdown[:10000] + "...\n\n(コンテンツが長すぎるため切り詰められました)"
+        if HTMLParser is not None:
+            # HTML を一度だけ取得し、解析と走査はブラウザ外 (スレッド) で行う
+            html = await page.content()
+            markdown = await asyncio.get_running_loop().run_in_executor(None, _html_to_markdown, html)
+        else:
+            # ページからテキストコンテンツを抽出するJavaScriptを実行 (切り詰めはブラウザ内で済ませる)
+            # (init script 適用前に開かれたドキュメントでは関数が無いので、その場合のみ全文を送る)
+            args = {"limit": _MAX_MARKDOWN_CHARS, "suffix": _TRUNCATED_SUFFIX}
+            markdown = await page.evaluate(
+                "(args) => window.__extractMarkdown ? window.__extractMarkdown(args) : null", args
+            )
+            if markdown is None:
+                markdown = await page.evaluate(_CONTENT_MARKDOWN_JS, args)
         
         return markdown
     except Exception as e:
@@ -204,37 +483,44 @@ def browser_extract_elements(selector: str, attribute: Optional[str] = None):
     Returns:
         抽出された要素のリストを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_extract_elements_async(selector, attribute))
-    loop.close()
+    res = _run(_extract_elements_async(selector, attribute))
     return res
 
-async def _extract_elements_async(selector: str, attribute: Optional[str] = None):
-    """非同期で要素を抽出"""
+# 要素・行・フィールドの抽出件数の上限 (巨大なページで CDP の転送量と処理量を抑える)
+_MAX_EXTRACT_ITEMS = 200
+
+# 一致した要素の属性値 (attr 未指定時はテキスト内容) を配列で返す (Locator.evaluate_all 用)
+_EXTRACT_ELEMENTS_JS = """(els, args) => ({
+    values: els.slice(0, args.limit).map(
+        e => args.attr ? e.getAttribute(args.attr) : (e.textContent || '').trim()
+    ),
+    total: els.length,
+})"""
+
+async def _extract_elements_async(selector: str, attribute: Optional[str] = None, limit: int = _MAX_EXTRACT_ITEMS):
+    """非同期で要素を抽出 (先頭 limit 件まで)"""
     if _browser_context is None or _current_page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
-        # セレクタに一致する要素を取得
-        elements = await _current_page.query_selector_all(selector)
+        # 一致する全要素の属性 (またはテキスト内容) を 1 回の evaluate_all でまとめて取得
+        data = await _current_page.locator(selector).evaluate_all(
+            _EXTRACT_ELEMENTS_JS, {"attr": attribute, "limit": limit}
+        )
+        values, total = data["values"], data["total"]
         
-        if not elements:
+        if not values:
             return f"セレクタ '{selector}' に一致する要素が見つかりませんでした。"
         
-        results = []
-        
-        for i, element in enumerate(elements):
-            if attribute:
-                # 特定の属性を抽出
-                value = await element.get_attribute(attribute)
-                results.append(f"{i+1}. [{attribute}] {value}")
-            else:
-                # テキスト内容を抽出
-                text = await element.text_content()
-                results.append(f"{i+1}. {text.strip()}")
+        if attribute:
+            results = [f"{i}. [{attribute}] {value}" for i, value in enumerate(values, 1)]
+        else:
+            results = [f"{i}. {text}" for i, text in enumerate(values, 1)]
         
-        return f"抽出された要素 (合計: {len(results)}件):\n\n" + "\n".join(results)
+        header = f"抽出された要素 (合計: {total}件"
+        if total > len(results):
+            header += f"、先頭 {len(results)} 件を表示"
+        return header + "):\n\n" + "\n".join(results)
     
     except Exception as e:
         error_message = f"要素抽出エラー: {str(e)}"
@@ -266,12 +552,63 @@ def browser_extract_structured_data(data_type: str):
     Returns:
         抽出された構造化データを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_extract_structured_data_async(data_type))
-    loop.close()
+    res = _run(_extract_structured_data_async(data_type))
     return res
 
+# テーブルごとの行データ (セル文字列の配列) と総行数。行は先頭 limit 件まで
+_EXTRACT_TABLES_JS = """(limit) => Array.from(document.querySelectorAll('table')).map(table => {
+    const rows = table.querySelectorAll('tr');
+    return {
+        rows: Array.from(rows).slice(0, limit).map(
+            row => Array.from(row.querySelectorAll('th, td')).map(cell => cell.textContent.trim())
+        ),
+        total: rows.length,
+    };
+})"""
+
+# フォームごとの action / method と各フィールドの属性をまとめて返す (select の選択肢は先頭 5 件)
+_EXTRACT_FORMS_JS = """(limit) => Array.from(document.querySelectorAll('form')).map(f => ({
+    action: f.getAttribute('action'),
+    method: f.getAttribute('method'),
+    fields: Array.from(f.querySelectorAll('input, select, textarea, button')).slice(0, limit).map(el => ({
+        tag: el.tagName.toLowerCase(),
+        type: el.getAttribute('type'),
+        name: el.getAttribute('name'),
+        placeholder: el.getAttribute('placeholder'),
+        text: el.tagName === 'BUTTON' ? (el.textContent || '').trim() : '',
+        options: el.tagName === 'SELECT'
+            ? Array.prototype.slice.call(el.options, 0, 5).map(o => ({t: (o.textContent || '').trim(), v: o.getAttribute('value')}))
+            : null,
+        n_options: el.tagName === 'SELECT' ? el.options.length : 0,
+    })),
+}))"""
+
+# リストごとの種類と項目テキスト (項目は先頭 limit 件まで)
+_EXTRACT_LISTS_JS = """(lists, limit) => lists.map(list => {
+    const items = list.querySelectorAll('li');
+    return {
+        ordered: list.tagName === 'OL',
+        items: Array.from(items).slice(0, limit).map(li => (li.textContent || '').trim()),
+        total: items.length,
+    };
+})"""
+
+# リンクを重複排除して先頭 50 件を返す (a.href はブラウザが絶対 URL に解決済み)
+_EXTRACT_LINKS_JS = """() => {
+    const anchors = document.querySelectorAll('a[href]');
+    const seen = new Set();
+    const links = [];
+    for (const a of anchors) {
+        const href = a.href;
+        if (!href || href.startsWith('javascript:') || seen.has(href)) continue;
+        seen.add(href);
+        if (links.length < 50) {
+            links.push({text: (a.textContent || '').trim() || '[画像/アイコン]', href: href});
+        }
+    }
+    return {links: links, unique: seen.size, total: anchors.length};
+}"""
+
 async def _extract_structured_data_async(data_type: str):
     """非同期で構造化データを抽出"""
     if _browser_context is None or _current_page is None:
@@ -279,8 +616,8 @@ async def _extract_structured_data_async(data_type: str):
     
     try:
         if data_type == "table":
-            # テーブルデータを抽出
-            tables = await _current_page.query_selector_all("table")
+            # 全テーブルの行データを 1 回の evaluate で取得 (各テーブル先頭の行のみ)
+            tables = await _current_page.evaluate(_EXTRACT_TABLES_JS, _MAX_EXTRACT_ITEMS)
             
             if not tables:
                 return "ページ内にテーブルが見つかりませんでした。"
@@ -288,13 +625,7 @@ async def _extract_structured_data_async(data_type: str):
             results = []
             
             for i, table in enumerate(tables):
-                table_data = await _current_page.evaluate("""(table) => {
-                    const rows = Array.from(table.querySelectorAll('tr'));
-                    return rows.map(row => {
-                        const cells = Array.from(row.querySelectorAll('th, td'));
-                        return cells.map(cell => cell.textContent.trim());
-                    });
-                }""", table)
+                table_data = table["rows"]
                 
                 if table_data and table_data[0]:
                     results.append(f"テーブル {i+1}:\n")
@@ -311,39 +642,42 @@ async def _extract_structured_data_async(data_type: str):
                     for row in data_rows:
                         results.append("| " + " | ".join(row) + " |")
                     
+                    if table["total"] > len(table_data):
+                        results.append(f"\n(全 {table['total']} 行のうち先頭 {len(table_data)} 行を表示)")
+                    
                     results.append("\n")
             
             return "\n".join(results)
         
         elif data_type == "list":
-            # リストデータを抽出
-            lists = await _current_page.query_selector_all("ul, ol")
+            # 全リストの項目を 1 回の evaluate_all でまとめて取得
+            lists = await _current_page.locator("ul, ol").evaluate_all(_EXTRACT_LISTS_JS, _MAX_EXTRACT_ITEMS)
             
             if not lists:
                 return "ページ内にリストが見つかりませんでした。"
             
             results = []
             
-            for i, list_element in enumerate(lists):
-                list_type = await list_element.get_attribute("type")
-                is_ordered = await list_element.evaluate("element => element.tagName.toLowerCase() === 'ol'")
-                
-                list_items = await list_element.query_selector_all("li")
+            for i, list_data in enumerate(lists):
+                is_ordered = list_data["ordered"]
+                list_items = list_data["items"]
                 if not list_items:
                     continue
                 
                 results.append(f"\nリスト {i+1} ({('順序付き' if is_ordered else '順序なし')}):")
                 
-                for j, item in enumerate(list_items):
-                    text = await item.text_content()
+                for j, text in enumerate(list_items):
                     prefix = f"{j+1}." if is_ordered else "-"
-                    results.append(f"{prefix} {text.strip()}")
+                    results.append(f"{prefix} {text}")
+                
+                if list_data["total"] > len(list_items):
+                    results.append(f"(全 {list_data['total']} 項目のうち先頭 {len(list_items)} 項目を表示)")
             
             return "\n".join(results)
         
         elif data_type == "form":
-            # フォーム要素を抽出
-            forms = await _current_page.query_selector_all("form")
+            # 全フォームとフィールドの情報を 1 回の evaluate でまとめて取得
+            forms = await _current_page.evaluate(_EXTRACT_FORMS_JS, _MAX_EXTRACT_ITEMS)
             
             if not forms:
                 return "ページ内にフォームが見つかりませんでした。"
@@ -351,94 +685,48 @@ async def _extract_structured_data_async(data_type: str):
             results = []
             
             for i, form in enumerate(forms):
-                form_action = await form.get_attribute("action") or "未指定"
-                form_method = await form.get_attribute("method") or "GET"
-                
                 results.append(f"\nフォーム {i+1}:")
-                results.append(f"アクション: {form_action}")
-                results.append(f"メソッド: {form_method}")
+                results.append(f"アクション: {form['action'] or '未指定'}")
+                results.append(f"メソッド: {form['method'] or 'GET'}")
                 results.append("フィールド:")
                 
-                input_elements = await form.query_selector_all("input, select, textarea, button")
-                
-                for input_elem in input_elements:
-                    elem_type = await input_elem.evaluate("element => element.tagName.toLowerCase()")
+                for field in form["fields"]:
+                    elem_type = field["tag"]
+                    name = field["name"] or "未指定"
                     
                     if elem_type == "input":
-                        input_type = await input_elem.get_attribute("type") or "text"
-                        name = await input_elem.get_attribute("name") or "未指定"
-                        placeholder = await input_elem.get_attribute("placeholder") or ""
-                        
+                        input_type = field["type"] or "text"
+                        placeholder = field["placeholder"] or ""
                         results.append(f"- Input: type={input_type}, name={name}" + (f", placeholder=\"{placeholder}\"" if placeholder else ""))
                     
                     elif elem_type == "select":
-                        name = await input_elem.get_attribute("name") or "未指定"
-                        options = await input_elem.query_selector_all("option")
-                        option_values = []
-                        
-                        for option in options:
-                            text = await option.text_content()
-                            value = await option.get_attribute("value")
-                            option_values.append(f"{text.strip()}={value}")
-                        
-                        results.append(f"- Select: name={name}, options=[{', '.join(option_values[:5])}]" + ("..." if len(option_values) > 5 else ""))
+                        option_values = [f"{o['t']}={o['v']}" for o in field["options"]]
+                        results.append(f"- Select: name={name}, options=[{', '.join(option_values)}]" + ("..." if field["n_options"] > 5 else ""))
                     
                     elif elem_type == "textarea":
-                        name = await input_elem.get_attribute("name") or "未指定"
                         results.append(f"- Textarea: name={name}")
                     
                     elif elem_type == "button":
-                        button_type = await input_elem.get_attribute("type") or "button"
-                        text = await input_elem.text_content()
-                        results.append(f"- Button: type={button_type}, text=\"{text.strip()}\"")
+                        button_type = field["type"] or "button"
+                        results.append(f"- Button: type={button_type}, text=\"{field['text']}\"")
             
             return "\n".join(results)
         
         elif data_type == "links":
-            # リンクを抽出
-            links = await _current_page.query_selector_all("a[href]")
+            # リンクの取得・絶対 URL 化・重複排除を 1 回の evaluate で行う
+            data = await _current_page.evaluate(_EXTRACT_LINKS_JS)
             
-            if not links:
+            if not data["total"]:
                 return "ページ内にリンクが見つかりませんでした。"
             
             results = ["抽出されたリンク:"]
             
-            current_url = _current_page.url
-            parsed_current = urlparse(current_url)
-            current_base = f"{parsed_current.scheme}://{parsed_current.netloc}"
-            
-            link_data = []
-            
-            for link in links:
-                text = await link.text_content()
-                href = await link.get_attribute("href")
-                
-                if not href or href.startswith("javascript:"):
-                    continue
-                
-                # 相対URLを絶対URLに変換
-                if href.startswith("/"):
-                    href = f"{current_base}{href}"
-                elif not href.startswith(("http://", "https://")):
-                    href = f"{current_base}/{href}"
-                
-                link_data.append({"text": text.strip() or "[画像/アイコン]", "href": href})
-            
-            # リンクを重複排除して表示
-            unique_links = []
-            seen_hrefs = set()
-            
-            for link in link_data:
-                if link["href"] not in seen_hrefs and link["text"]:
-                    unique_links.append(link)
-                    seen_hrefs.add(link["href"])
-            
             # リンクの表示（上位50件まで）
-            for i, link in enumerate(unique_links[:50]):
+            for i, link in enumerate(data["links"]):
                 results.append(f"{i+1}. [{link['text']}]({link['href']})")
             
-            if len(unique_links) > 50:
-                results.append(f"\n...さらに {len(unique_links) - 50} 件のリンクがあります。")
+            if data["unique"] > 50:
+                results.append(f"\n...さらに {data['unique'] - 50} 件のリンクがあります。")
             
             return "\n".join(results)
         
@@ -465,10 +753,7 @@ def browser_view():
     Returns:
         ページの内容とタイトルを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_view_async())
-    loop.close()
+    res = _run(_view_async())
     return res
 
 async def _view_async():
@@ -522,10 +807,7 @@ def browser_click(selector: str, index: int = 0):
     Returns:
         クリック結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_click_async(selector, index))
-    loop.close()
+    res = _run(_click_async(selector, index))
     return res
 
 async def _click_async(selector: str, index: int = 0):
@@ -534,22 +816,23 @@ async def _click_async(selector: str, index: int = 0):
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
-        # セレクタに一致する要素を取得
-        elements = await _current_page.query_selector_all(selector)
+        # 一致件数だけを取得し、全要素のハンドルは作らない
+        locator = _current_page.locator(selector)
+        count = await locator.count()
         
-        if not elements:
+        if not count:
             return f"セレクタ '{selector}' に一致する要素が見つかりませんでした。"
         
-        if index >= len(elements):
-            return f"指定されたインデックス {index} が範囲外です（要素数: {len(elements)}）。"
+        if index >= count:
+            return f"指定されたインデックス {index} が範囲外です（要素数: {count}）。"
         
         # 対象の要素をクリック
-        element = elements[index]
+        element = locator.nth(index)
         await element.scroll_into_view_if_needed()
         await element.click()
         
-        # クリック後にページが変わる可能性があるので少し待機
-        await asyncio.sleep(2)
+        # クリック後にページが変わる可能性があるので、読み込みか DOM の更新を待つ
+        await _after_action(_current_page)
         
         # 新しいページ情報を取得
         title = await _current_page.title()
@@ -587,10 +870,7 @@ def browser_input(selector: str, text: str, press_enter: bool = False):
     Returns:
         入力結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_input_async(selector, text, press_enter))
-    loop.close()
+    res = _run(_input_async(selector, text, press_enter))
     return res
 
 async def _input_async(selector: str, text: str, press_enter: bool = False):
@@ -615,8 +895,8 @@ async def _input_async(selector: str, text: str, press_enter: bool = False):
         # Enterキーを押す（オプション）
         if press_enter:
             await input_element.press("Enter")
-            # ページが変わる可能性があるので少し待機
-            await asyncio.sleep(2)
+            # ページが変わる可能性があるので、読み込みか DOM の更新を待つ
+            await _after_action(_current_page)
         
         return f"テキスト「{text}」を入力しました。" + (" Enterキーを押しました。" if press_enter else "")
     
@@ -647,10 +927,7 @@ def browser_scroll_down(amount: int = 500, to_bottom: bool = False):
     Returns:
         スクロール結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_scroll_down_async(amount, to_bottom))
-    loop.close()
+    res = _run(_scroll_down_async(amount, to_bottom))
     return res
 
 async def _scroll_down_async(amount: int = 500, to_bottom: bool = False):
@@ -668,8 +945,8 @@ async def _scroll_down_async(amount: int = 500, to_bottom: bool = False):
             await _current_page.evaluate(f"window.scrollBy(0, {amount})")
             result = f"{amount}ピクセル下にスクロールしました。"
         
-        # スクロール後に少し待機して、動的コンテンツがロードされる時間を確保
-        await asyncio.sleep(1)
+        # 動的コンテンツの追加が落ち着くまで待機 (変化が無ければすぐ戻る)
+        await _wait_for_settle(_current_page)
         
         return result
     
@@ -700,10 +977,7 @@ def browser_scroll_up(amount: int = 500, to_top: bool = False):
     Returns:
         スクロール結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_scroll_up_async(amount, to_top))
-    loop.close()
+    res = _run(_scroll_up_async(amount, to_top))
     return res
 
 async def _scroll_up_async(amount: int = 500, to_top: bool = False):
@@ -751,10 +1025,7 @@ def browser_screenshot(save_path: str, selector: Optional[str] = None):
     Returns:
         スクリーンショット結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_screenshot_async(save_path, selector))
-    loop.close()
+    res = _run(_screenshot_async(save_path, selector))
     return res
 
 async def _screenshot_async(save_path: str, selector: Optional[str] = None):
@@ -811,10 +1082,7 @@ def browser_run_javascript(code: str):
     Returns:
         実行結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_run_javascript_async(code))
-    loop.close()
+    res = _run(_run_javascript_async(code))
     return res
 
 async def _run_javascript_async(code: str):
@@ -864,34 +1132,322 @@ def browser_extract_pdf(url: str, pages: str = ""):
     Returns:
         抽出されたテキストを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_extract_pdf_async(url, pages))
-    loop.close()
+    res = _run(_extract_pdf_async(url, pages))
     return res
 
+# PDF ダウンロード時の読み込み単位
+_PDF_CHUNK_SIZE = 64 * 1024
+# これ未満のページ数ならプロセスプールを使わず 1 スレッドで抽出する (起動・転送コストの方が大きい)
+_PDF_PARALLEL_MIN_PAGES = 8
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+# ループスレッド (PyMuPDF) と OCR の executor スレッドから同時に初回呼び出しされても 1 つだけ作る
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """PDF のページ抽出用プロセスプール (初回利用時に作成)"""
+    global _pdf_pool
+    if _pdf_pool is not None:
+        return _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # ブラウザ用スレッドを持つ親プロセスを fork しないよう spawn で起動する
+            _pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_pool
+
+async def _extract_pages_parallel(path: str, page_nums: List[int], worker=extract_pages_pypdf2) -> List[Tuple[int, str]]:
+    """ページ抽出 (tools.pdf_worker の関数) をワーカーに分配し、ページ順の (ページ番号, テキスト) を返す"""
+    loop = asyncio.get_running_loop()
+    if len(page_nums) < _PDF_PARALLEL_MIN_PAGES:
+        # 少数ページでもイベントループはブロックしない
+        return await loop.run_in_executor(None, worker, path, page_nums)
+    
+    n_workers = os.cpu_count() or 1
+    size = -(-len(page_nums) // n_workers)
+    chunks = [page_nums[i:i + size] for i in range(0, len(page_nums), size)]
+    pool = _get_pdf_pool()
+    parts = await asyncio.gather(
+        *(loop.run_in_executor(pool, worker, path, chunk) for chunk in chunks)
+    )
+    return [item for part in parts for item in part]
+
+# PDF ダウンロード用の共有 HTTP セッション (コネクタ・TLS 設定を呼び出し間で使い回す)
+_http_session = None
+_HTTP_CONNECTION_LIMIT = 20
+
+def _get_http_session():
+    """常駐ループに紐づいた共有 aiohttp セッションを返す (閉じられていれば作り直す)"""
+    global _http_session
+    import aiohttp
+    
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=_HTTP_CONNECTION_LIMIT)
+        )
+    return _http_session
+
+async def _try_pymupdf(path: str, page_ranges) -> Optional[List[Tuple[int, str]]]:
+    """PyMuPDF で (ページ番号, テキスト) を抽出する。未インストールなら None"""
+    if fitz is None:
+        return None
+    
+    with fitz.open(path) as doc:
+        num_pages = len(doc)
+    
+    if not page_ranges:  # 全ページ抽出
+        page_ranges = range(1, num_pages + 1)
+    
+    # MuPDF は Document のスレッド共有ができず GIL も保持したままなので、
+    # PyPDF2 と同じくページを分割してプロセスプールで抽出する
+    target_pages = [n for n in page_ranges if 1 <= n <= num_pages]
+    return await _extract_pages_parallel(path, target_pages, extract_pages_pymupdf)
+
+async def _try_ocr(path: str, page_ranges, cancel: Optional[threading.Event] = None) -> Optional[List[Tuple[int, str]]]:
+    """OCR による抽出をイベントループ外で実行する (結果に収まる文字数を超えたら残りのページは OCR しない)"""
+    # タスクが取り消されてもスレッドは止まらないので、イベントで OCR の打ち切りを伝える
+    if cancel is None:
+        cancel = threading.Event()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _ocr_pages, path, page_ranges, _PDF_MAX_RESULT_CHARS, cancel
+        )
+    except asyncio.CancelledError:
+        cancel.set()
+        raise
+
+# OCR 前のラスタライズ (pdftoppm) に使うスレッド数
+_OCR_RASTER_THREADS = max(1, (os.cpu_count() or 2) - 1)
+# 1 回にラスタライズして OCR するページ数。ラスタライズと OCR をこの単位で交互に行い、
+# 単位ごとに打ち切り (文字数の上限・取り消し) を確認する
+_OCR_RASTER_CHUNK_PAGES = 8
+# プロセスプールに 1 回で渡すページ数
+_OCR_CHUNK_PAGES = 2
+# EasyOCR の 1 回のバッチ推論にまとめるページ数
+_EASYOCR_BATCH_SIZE = 8
+
+def _rasterize_pages(path: str, page_nums: List[int], out_dir: str) -> Tuple[List[int], List[str]]:
+    """指定ページを PNG にラスタライズし、(ページ番号, 画像パス) の列を返す"""
+    # 連続するページは 1 回の pdftoppm にまとめる
+    runs: List[Tuple[int, int]] = []
+    for page_num in page_nums:
+        if runs and runs[-1][1] == page_num - 1:
+            runs[-1] = (runs[-1][0], page_num)
+        else:
+            runs.append((page_num, page_num))
+    
+    rendered: List[int] = []
+    image_paths: List[str] = []
+    for first_page, last_page in runs:
+        paths = pdf2image.convert_from_path(
+            path,
+            thread_count=_OCR_RASTER_THREADS,
+            output_folder=out_dir,
+            fmt="png",
+            first_page=first_page,
+            last_page=last_page,
+            paths_only=True,
+        )
+        rendered.extend(range(first_page, first_page + len(paths)))
+        image_paths.extend(paths)
+    return rendered, image_paths
+
+def _ocr_pages(path: str, page_ranges, max_chars: Optional[int] = None,
+               cancel: Optional[threading.Event] = None) -> Optional[List[Tuple[int, str]]]:
+    """
+    PDF を画像に変換して OCR で (ページ番号, テキスト) を抽出する。未インストールなら None。
+    ラスタライズと OCR は _OCR_RASTER_CHUNK_PAGES ページずつ行い、
+    抽出済みテキストが max_chars を超えた時点、または cancel がセットされた時点で以降のページを処理しない。
+    """
+    if pdf2image is None or (pytesseract is None and not _HAS_EASYOCR):
+        # PDF2Image or Tesseractがインストールされていない
+        return None
+    
+    import tempfile
+    
+    def _should_stop(total: int) -> bool:
+        return (max_chars is not None and total > max_chars) or (cancel is not None and cancel.is_set())
+    
+    if page_ranges:
+        page_nums = sorted({n for n in page_ranges if n >= 1})
+    else:
+        # 全ページ指定は総ページ数を調べて明示的なページ列にする (一括でラスタライズしない)
+        page_nums = list(range(1, pdf2image.pdfinfo_from_path(path)["Pages"] + 1))
+    # Tesseract はページ数が多いときだけプロセスプールで並列に OCR する
+    use_pool = not _HAS_EASYOCR and len(page_nums) >= _PDF_PARALLEL_MIN_PAGES
+    
+    results: List[Tuple[int, str]] = []
+    total = 0
+    # 画像はメモリに溜めず一時ディレクトリに書き出し、OCR が済んだら削除する
+    with tempfile.TemporaryDirectory() as out_dir:
+        for start in range(0, len(page_nums), _OCR_RASTER_CHUNK_PAGES):
+            if _should_stop(total):
+                break
+            rendered, image_paths = _rasterize_pages(
+                path, page_nums[start:start + _OCR_RASTER_CHUNK_PAGES], out_dir
+            )
+            if _HAS_EASYOCR:
+                texts = ocr_image_files_batched(image_paths, _EASYOCR_BATCH_SIZE)
+            elif use_pool:
+                # 各プロセスは Tesseract API を 1 度だけ初期化する
+                pool = _get_pdf_pool()
+                texts = []
+                for part in pool.map(ocr_image_files, [
+                    image_paths[i:i + _OCR_CHUNK_PAGES] for i in range(0, len(image_paths), _OCR_CHUNK_PAGES)
+                ]):
+                    texts.extend(part)
+            else:
+                texts = ocr_image_files(image_paths)
+            for image_path in image_paths:
+                os.remove(image_path)
+            
+            results.extend(zip(rendered, texts))
+            total += sum(len(t) for t in texts)
+    
+    # 打ち切った場合は OCR したページまでを返す
+    return results
+
+# 抽出結果として返すテキストの最大文字数
+_PDF_MAX_RESULT_CHARS = 15000
+
+def _join_pages(pages_text: List[Tuple[int, str]], limit: int = _PDF_MAX_RESULT_CHARS) -> Tuple[int, str, int]:
+    """
+    (ページ番号, テキスト) の列を見出し付きで連結する。
+    連結は limit 文字を超えた時点でやめ、(テキストのあるページ数, 連結結果, 全体の文字数) を返す。
+    """
+    parts = []
+    page_count = 0
+    total = 0
+    for page_num, extracted_text in pages_text:
+        if not extracted_text:
+            continue
+        part = f"// ページ {page_num}\n{extracted_text}\n\n"
+        page_count += 1
+        if total <= limit:
+            parts.append(part)
+        total += len(part)
+    return page_count, "".join(parts), total
+
+async def _extract_pdf_text(temp_file_path: str, page_ranges) -> Tuple[int, str, int]:
+    """一時ファイルの PDF からテキストを抽出し、(抽出ページ数, テキスト (上限付き), 全体の文字数) を返す"""
+    page_count, text_content, total_chars = 0, "", 0
+    
+    # PyPDF2でテキスト抽出
+    if PyPDF2 is not None:
+        with open(temp_file_path, 'rb') as f:
+            num_pages = len(PyPDF2.PdfReader(f).pages)
+        
+        if not page_ranges:  # 全ページ抽出
+            page_ranges = range(1, num_pages + 1)
+        
+        target_pages = [n for n in page_ranges if 1 <= n <= num_pages]
+        page_count, text_content, total_chars = _join_pages(
+            await _extract_pages_parallel(temp_file_path, target_pages)
+        )
+    
+    if text_content.strip() and page_count > 0:
+        return page_count, text_content, total_chars
+    
+    # より高度な抽出を試みる。スキャン PDF で PyMuPDF の空振りを待ってから OCR を始めないよう、
+    # 両方を同時に走らせて先に中身のある結果を返したほうを採用し、もう一方は取り消す
+    # (どちらも CPU を使う処理なのでイベントループ外で実行される)
+    # OCR のスレッドにはタスクの取り消しを待たずに打ち切りを伝え、
+    # 呼び出し側が一時ファイルを削除した後に次のページのラスタライズを始めないようにする
+    ocr_cancel = threading.Event()
+    pending = {
+        asyncio.create_task(_try_pymupdf(temp_file_path, page_ranges)),
+        asyncio.create_task(_try_ocr(temp_file_path, page_ranges, ocr_cancel)),
+    }
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    pages_text = task.result()
+                except Exception as e:
+                    # 一方の失敗で、もう一方 (成功するかもしれない抽出) を取り消さない
+                    logger.warning(f"PDF の代替抽出に失敗しました: {str(e)}")
+                    continue
+                if pages_text is None:
+                    # ライブラリがインストールされていない
+                    continue
+                
+                page_count, text_content, total_chars = _join_pages(pages_text)
+                if text_content.strip() and page_count > 0:
+                    return page_count, text_content, total_chars
+    finally:
+        ocr_cancel.set()
+        for task in pending:
+            task.cancel()
+    
+    return page_count, text_content, total_chars
+
+# ---------------------------------------------------------------------------
+# ディスク上の JSON キャッシュ (PDF 抽出結果・LLM のデバッグ応答)
+# ---------------------------------------------------------------------------
+_CACHE_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "manus")
+
+# PDF 抽出結果のキャッシュ (PDF の内容とページ指定のハッシュをキーにする)
+_PDF_CACHE_DIR = os.path.join(_CACHE_ROOT, "pdf")
+_PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def _cache_load(cache_dir: str, key: str) -> Optional[Dict[str, Any]]:
+    """キャッシュのエントリを読む。無ければ None"""
+    path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        # 最近使ったものを残すため mtime を更新する
+        os.utime(path)
+        return entry
+    except (OSError, ValueError):
+        return None
+
+def _cache_store(cache_dir: str, key: str, entry: Dict[str, Any], max_bytes: int):
+    """エントリをキャッシュに書く (一時ファイル経由で置き換え、max_bytes を超えたら古いものから削除)"""
+    import tempfile
+    
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(f.name, os.path.join(cache_dir, f"{key}.json"))
+        
+        entries = []
+        for dir_entry in os.scandir(cache_dir):
+            if dir_entry.name.endswith(".json"):
+                st = dir_entry.stat()
+                entries.append((st.st_mtime, st.st_size, dir_entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+    except OSError as e:
+        logger.warning(f"キャッシュの保存に失敗しました ({cache_dir}): {str(e)}")
+
 async def _extract_pdf_async(url: str, pages: str = ""):
     """非同期でPDFテキスト抽出"""
     if not url.lower().endswith('.pdf'):
         return "PDFファイルのURLではありません。.pdfで終わるURLを提供してください。"
     
+    temp_file_path = None
     try:
         import tempfile
-        import PyPDF2
-        import aiohttp
         
-        # PDFファイルをダウンロード
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
+        # PDFファイルをダウンロードし、全体をメモリに溜めずに一時ファイルへ書き出す
+        # (各抽出方法はこの一時ファイルを共用し、最後に削除する)
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
+            temp_file_path = temp_file.name
+            async with _get_http_session().get(url) as response:
                 if response.status != 200:
                     return f"PDFダウンロード失敗: ステータスコード {response.status}"
                 
-                pdf_content = await response.read()
-        
-        # 一時ファイルに保存
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
-            temp_file_path = temp_file.name
-            temp_file.write(pdf_content)
+                # キャッシュのキーにするため、書き込みながら内容のハッシュを取る
+                digest = hashlib.sha256()
+                async for chunk in response.content.iter_chunked(_PDF_CHUNK_SIZE):
+                    temp_file.write(chunk)
+                    digest.update(chunk)
         
         # ページ範囲を解析
         page_ranges = []
@@ -903,103 +1459,19 @@ async def _extract_pdf_async(url: str, pages: str = ""):
                 else:
                     page_ranges.append(int(part))
         
-        # PyPDF2でテキスト抽出
-        text_content = ""
-        page_count = 0
-        
-        with open(temp_file_path, 'rb') as f:
-            pdf_reader = PyPDF2.PdfReader(f)
-            num_pages = len(pdf_reader.pages)
-            
-            if not page_ranges:  # 全ページ抽出
-                page_ranges = range(1, num_pages + 1)
-            
-            for page_num in page_ranges:
-                if page_num < 1 or page_num > num_pages:
-                    continue
-                
-                # PyPDF2はゼロベースのインデックス
-                page = pdf_reader.pages[page_num - 1]
-                extracted_text = page.extract_text()
-                
-                if extracted_text:
-                    page_count += 1
-                    text_content += f"// ページ {page_num}\n{extracted_text}\n\n"
-        
-        # 一時ファイルを削除
-        os.unlink(temp_file_path)
-        
-        # より高度な抽出を試みる
-        if not text_content.strip() or page_count == 0:
-            # PyMuPDFを試す
-            try:
-                import fitz  # PyMuPDF
-                
-                # 一時ファイルに再度保存
-                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
-                    temp_file_path = temp_file.name
-                    temp_file.write(pdf_content)
-                
-                text_content = ""
-                page_count = 0
-                
-                with fitz.open(temp_file_path) as doc:
-                    num_pages = len(doc)
-                    
-                    if not page_ranges:  # 全ページ抽出
-                        page_ranges = range(1, num_pages + 1)
-                    
-                    for page_num in page_ranges:
-                        if page_num < 1 or page_num > num_pages:
-                            continue
-                        
-                        # PyMuPDFはゼロベースのインデックス
-                        page = doc[page_num - 1]
-                        extracted_text = page.get_text()
-                        
-                        if extracted_text:
-                            page_count += 1
-                            text_content += f"// ページ {page_num}\n{extracted_text}\n\n"
-                
-                # 一時ファイルを削除
-                os.unlink(temp_file_path)
-            except ImportError:
-                # PyMuPDFがインストールされていない
-                pass
-        
-        # それでも失敗した場合、OCRを試みる
-        if not text_content.strip() or page_count == 0:
-            try:
-                import pytesseract
-                from PIL import Image
-                import pdf2image
-                
-                # 一時ファイルに再度保存
-                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
-                    temp_file_path = temp_file.name
-                    temp_file.write(pdf_content)
-                
-                text_content = ""
-                page_count = 0
-                
-                # PDFを画像に変換して、OCRでテキスト抽出
-                images = pdf2image.convert_from_path(temp_file_path)
-                
-                for i, image in enumerate(images):
-                    page_num = i + 1
-                    if page_ranges and page_num not in page_ranges:
-                        continue
-                    
-                    extracted_text = pytesseract.image_to_string(image, lang='jpn+eng')
-                    if extracted_text:
-                        page_count += 1
-                        text_content += f"// ページ {page_num}\n{extracted_text}\n\n"
-                
-                # 一時ファイルを削除
-                os.unlink(temp_file_path)
-            except ImportError:
-                # PDF2Image or Tesseractがインストールされていない
-                pass
+        # 同じ内容・同じページ指定の抽出結果がキャッシュにあればそれを使う
+        cache_key = hashlib.sha256(
+            f"{digest.hexdigest()}:{json.dumps(page_ranges)}".encode()
+        ).hexdigest()
+        cached = _cache_load(_PDF_CACHE_DIR, cache_key)
+        if cached is not None and "text" in cached:
+            page_count, text_content = cached["page_count"], cached["text"]
+            total_chars = cached.get("total_chars", len(text_content))
+        else:
+            page_count, text_content, total_chars = await _extract_pdf_text(temp_file_path, page_ranges)
+            if text_content.strip() and page_count > 0:
+                entry = {"page_count": page_count, "text": text_content, "total_chars": total_chars}
+                _cache_store(_PDF_CACHE_DIR, cache_key, entry, _PDF_CACHE_MAX_BYTES)
         
         # 結果をフォーマット
         if not text_content.strip() or page_count == 0:
@@ -1013,15 +1485,26 @@ async def _extract_pdf_async(url: str, pages: str = ""):
         result += text_content
         
         # 長すぎる場合は切り詰める
-        max_length = 15000
+        # (text_content は上限を少し超えたところで連結を止めてある)
+        max_length = _PDF_MAX_RESULT_CHARS
         if len(result) > max_length:
-            result = result[:max_length] + f"\n\n... (抽出されたテキストが長すぎるため切り詰められました。全体で{len(text_content)}文字)"
+            result = result[:max_length] + f"\n\n... (抽出されたテキストが長すぎるため切り詰められました。全体で{total_chars}文字)"
         
         return result
     
     except Exception as e:
         return f"PDFテキスト抽出中にエラー: {str(e)}"
+    finally:
+        # 一時ファイルを削除
+        if temp_file_path is not None:
+            try:
+                os.unlink(temp_file_path)
+            except OSError:
+                pass
     
+# container_id 未指定時のデバッグ用セッション (codeact_tools と共用し、release_at_exit で終了時に解放する)
+_DEBUG_SESSION = "codeact-debug"
+
 @tool(
     name="codeact_auto_debug",
     description="コードの自動デバッグと修正",
@@ -1057,24 +1540,9 @@ def codeact_auto_debug(code: str, error_message: str, container_id: Optional[str
     fixes_applied = []
     
     # エラータイプの判別と修正の適用
-    if "SyntaxError" in error_message:
-        code, comments, fixes = _fix_syntax_errors(code, error_message)
-        debug_comments.extend(comments)
-        fixes_applied.extend(fixes)
-    elif "NameError" in error_message:
-        code, comments, fixes = _fix_name_errors(code, error_message)
-        debug_comments.extend(comments)
-        fixes_applied.extend(fixes)
-    elif "ImportError" in error_message or "ModuleNotFoundError" in error_message:
-        code, comments, fixes = _fix_import_errors(code, error_message)
-        debug_comments.extend(comments)
-        fixes_applied.extend(fixes)
-    elif "TypeError" in error_message:
-        code, comments, fixes = _fix_type_errors(code, error_message)
-        debug_comments.extend(comments)
-        fixes_applied.extend(fixes)
-    elif "IndexError" in error_message or "KeyError" in error_message:
-        code, comments, fixes = _fix_index_key_errors(code, error_message)
+    fixer = _select_fixer(error_message)
+    if fixer is not None:
+        code, comments, fixes = fixer(code, error_message)
         debug_comments.extend(comments)
         fixes_applied.extend(fixes)
     
@@ -1084,9 +1552,9 @@ def codeact_auto_debug(code: str, error_message: str, container_id: Optional[str
         debug_comments_str = "\n".join(debug_comments)
         code_with_comments = f"{debug_comments_str}\n\n{code}"
         
-        # 修正したコードを実行
+        # 修正したコードを実行 (指定が無ければ常駐のデバッグ用セッションを使う)
         sandbox = get_sandbox()
-        stdout, stderr, exit_code = sandbox.execute_python(container_id or "codeact-debug", code)
+        stdout, stderr, exit_code = sandbox.execute_python(container_id or release_at_exit(_DEBUG_SESSION), code)
         
         if exit_code == 0:
             return f"コード修正成功！\n\n適用した修正: {', '.join(fixes_applied)}\n\n修正後のコード:\n{code_with_comments}\n\n実行結果:\n{stdout}"
@@ -1099,6 +1567,140 @@ def codeact_auto_debug(code: str, error_message: str, container_id: Optional[str
     
     return f"コード分析完了しましたが、自動修正できません。エラーメッセージを確認してください:\n{error_message}"
 
+# エラーメッセージ解析用の正規表現 (長いメッセージでのバックトラックを避けるため非貪欲にする)
+_LINE_RE = re.compile(r"line (\d+)")
+_NAME_UNDEFINED_RE = re.compile(r"name '(.+?)' is not defined")
+_NO_MODULE_RE = re.compile(r"No module named '(.+?)'")
+_CANNOT_IMPORT_RE = re.compile(r"cannot import name '(.+?)' from '(.+?)'")
+_NOT_CALLABLE_RE = re.compile(r"'(.+?)' object is not callable")
+_NOT_SUBSCRIPTABLE_RE = re.compile(r"'(.+?)' object is not subscriptable")
+_CONCAT_RE = re.compile(r"can only concatenate (.+?) \(not \"(.+?)\"\) to (.+)")
+_KEY_ERROR_RE = re.compile(r"KeyError: '(.+?)'")
+
+@functools.lru_cache(maxsize=256)
+def _assign_re(name: str) -> "re.Pattern":
+    """name への代入 (name = ...) に一致する正規表現"""
+    return re.compile(rf"{re.escape(name)}\s*=")
+
+@functools.lru_cache(maxsize=256)
+def _from_import_re(module: str, name: str) -> "re.Pattern":
+    """from module import ...name に一致する正規表現"""
+    return re.compile(rf"from\s+{re.escape(module)}\s+import\s+.*{re.escape(name)}")
+
+# 組み込み関数/定数のよくある誤字 (小文字化した名前 -> 正しい名前)
+_COMMON_BUILTINS = {
+    'prit': 'print',
+    'lne': 'len',
+    'ragne': 'range',
+    'iput': 'input',
+    'mian': 'main',
+    'strig': 'string',
+    'flase': 'False',
+    'ture': 'True',
+    'noe': 'None'
+}
+
+# よく使う別名と、それを定義するインポート文
+_COMMON_MODULES = {
+    'pd': 'import pandas as pd',
+    'np': 'import numpy as np',
+    'plt': 'import matplotlib.pyplot as plt',
+    'os': 'import os',
+    're': 'import re',
+    'json': 'import json',
+    'requests': 'import requests',
+    'math': 'import math',
+    'datetime': 'from datetime import datetime'
+}
+
+# モジュール名のよくある誤字
+_COMMON_MODULE_TYPOS = {
+    'padas': 'pandas',
+    'nummpy': 'numpy',
+    'matplolib': 'matplotlib',
+    'sicpy': 'scipy',
+    'sklearn': 'scikit-learn',
+    'beautifulsop': 'beautifulsoup4',
+    'requets': 'requests'
+}
+
+# import / from 文のモジュール名が誤字表のいずれかに一致する正規表現 (表全体を 1 回の走査で置換する)
+_MODULE_TYPO_RE = re.compile(
+    r'\b((?:import|from)\s+)(' + '|'.join(map(re.escape, _COMMON_MODULE_TYPOS)) + r')\b'
+)
+
+def _fix_builtin_typos(code: str, undefined_name: str) -> Tuple[str, Dict[str, str]]:
+    """
+    誤字表にある名前の参照 (ast.Name) をまとめて修正し、(修正後のコード, 誤字 -> 修正後の名前) を返す。
+    文字列リテラル・コメント・属性名は変更せず、コード内で定義されている名前も誤字とみなさない
+    (NameError になった undefined_name は常に修正する)。構文解析できなければ undefined_name だけを置換する。
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        correct_name = _COMMON_BUILTINS[undefined_name.lower()]
+        pattern = re.compile(r'\b' + re.escape(undefined_name) + r'\b')
+        return pattern.sub(correct_name, code), {undefined_name: correct_name}
+    
+    bound = set()
+    typos = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if not isinstance(node.ctx, ast.Load):
+                bound.add(node.id)
+            elif node.id.lower() in _COMMON_BUILTINS:
+                typos.append(node)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.alias):
+            bound.add((node.asname or node.name).split('.')[0])
+    bound.discard(undefined_name)
+    
+    lines = code.split('\n')
+    replaced = {}
+    # 列位置は UTF-8 のバイト単位なので、行ごとにバイト列上で右から置換する
+    for node in sorted(typos, key=lambda n: (n.lineno, n.col_offset), reverse=True):
+        if node.id in bound:
+            continue
+        correct_name = replaced[node.id] = _COMMON_BUILTINS[node.id.lower()]
+        line = lines[node.lineno - 1].encode('utf-8')
+        line = line[:node.col_offset] + correct_name.encode('utf-8') + line[node.end_col_offset:]
+        lines[node.lineno - 1] = line.decode('utf-8')
+    return '\n'.join(lines), replaced
+
+# (名前, モジュール) -> 正しいインポート文
+_COMMON_IMPORT_FIXES = {
+    ('pyplot', 'matplotlib'): 'from matplotlib import pyplot',
+    ('DataFrame', 'pandas'): 'from pandas import DataFrame',
+    ('train_test_split', 'sklearn'): 'from sklearn.model_selection import train_test_split'
+}
+
+# 括弧以外の文字
+_NON_BRACKET_RE = re.compile(r"[^()\[\]{}]+")
+
+def _bracket_counts(code: str) -> Dict[str, int]:
+    """
+    括弧ごとの出現数を返す。
+    文字列リテラルやコメント中の括弧を数えないよう tokenize で 1 回走査し、
+    字句解析できないコード (閉じていない文字列など) では括弧だけを抜き出して数える。
+    """
+    counts = dict.fromkeys("()[]{}", 0)
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+            if tok.type == tokenize.OP and tok.string in counts:
+                counts[tok.string] += 1
+        return counts
+    except tokenize.TokenError as e:
+        # 括弧が閉じていないまま EOF に達した場合は、それまでのトークンを数え終わっている
+        if "multi-line statement" in str(e.args[0]):
+            return counts
+    except SyntaxError:
+        pass
+    brackets = _NON_BRACKET_RE.sub("", code)
+    return {ch: brackets.count(ch) for ch in "()[]{}"}
+
 def _fix_syntax_errors(code: str, error_message: str) -> Tuple[str, List[str], List[str]]:
     """
     構文エラーを修正する
@@ -1118,7 +1720,7 @@ def _fix_syntax_errors(code: str, error_message: str) -> Tuple[str, List[str], L
         debug_comments.append("# 文字列リテラルが閉じられていません")
         
         # 行番号を取得
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_RE.search(error_message)
         if line_match:
             line_num = int(line_match.group(1))
             lines = code.split('\n')
@@ -1140,7 +1742,7 @@ def _fix_syntax_errors(code: str, error_message: str) -> Tuple[str, List[str], L
     elif "unexpected indent" in error_message or "expected an indented block" in error_message:
         debug_comments.append("# インデントエラーがあります")
         
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_RE.search(error_message)
         if line_match:
             line_num = int(line_match.group(1))
             lines = code.split('\n')
@@ -1176,12 +1778,13 @@ def _fix_syntax_errors(code: str, error_message: str) -> Tuple[str, List[str], L
         debug_comments.append("# 括弧が閉じられていない可能性があります")
         
         # 括弧カウントを確認
-        open_parentheses = code.count('(')
-        close_parentheses = code.count(')')
-        open_brackets = code.count('[')
-        close_brackets = code.count(']')
-        open_braces = code.count('{')
-        close_braces = code.count('}')
+        counts = _bracket_counts(code)
+        open_parentheses = counts['(']
+        close_parentheses = counts[')']
+        open_brackets = counts['[']
+        close_brackets = counts[']']
+        open_braces = counts['{']
+        close_braces = counts['}']
         
         # 括弧不足を追加
         if open_parentheses > close_parentheses:
@@ -1211,46 +1814,21 @@ def _fix_name_errors(code: str, error_message: str) -> Tuple[str, List[str], Lis
     fixes_applied = []
     
     # 'X' is not defined エラーの修正
-    name_match = re.search(r"name '(.+)' is not defined", error_message)
+    name_match = _NAME_UNDEFINED_RE.search(error_message)
     if name_match:
         var_name = name_match.group(1)
         debug_comments.append(f"# 変数 '{var_name}' が定義されていません")
         
-        # 組み込み関数/モジュールの誤字修正
-        common_builtins = {
-            'prit': 'print',
-            'lne': 'len',
-            'ragne': 'range',
-            'iput': 'input',
-            'mian': 'main',
-            'strig': 'string',
-            'flase': 'False',
-            'ture': 'True',
-            'noe': 'None'
-        }
-        
-        # 変数名が誤字の場合、修正
-        if var_name.lower() in common_builtins:
-            correct_name = common_builtins[var_name.lower()]
-            code = re.sub(r'\b' + re.escape(var_name) + r'\b', correct_name, code)
-            fixes_applied.append(f"誤字を修正: {var_name} → {correct_name}")
+        # 変数名が組み込み関数/モジュールの誤字の場合、表にある誤字の参照をまとめて修正
+        if var_name.lower() in _COMMON_BUILTINS:
+            code, replaced = _fix_builtin_typos(code, var_name)
+            for typo, correct_name in replaced.items():
+                fixes_applied.append(f"誤字を修正: {typo} → {correct_name}")
             return code, debug_comments, fixes_applied
         
         # インポートの追加
-        common_modules = {
-            'pd': 'import pandas as pd',
-            'np': 'import numpy as np',
-            'plt': 'import matplotlib.pyplot as plt',
-            'os': 'import os',
-            're': 'import re',
-            'json': 'import json',
-            'requests': 'import requests',
-            'math': 'import math',
-            'datetime': 'from datetime import datetime'
-        }
-        
-        if var_name in common_modules:
-            import_line = common_modules[var_name]
+        if var_name in _COMMON_MODULES:
+            import_line = _COMMON_MODULES[var_name]
             code = import_line + '\n\n' + code
             fixes_applied.append(f"インポート追加: {import_line}")
             return code, debug_comments, fixes_applied
@@ -1290,26 +1868,24 @@ def _fix_import_errors(code: str, error_message: str) -> Tuple[str, List[str], L
     fixes_applied = []
     
     # モジュールインポートエラーの修正
-    module_match = re.search(r"No module named '(.+)'", error_message)
+    module_match = _NO_MODULE_RE.search(error_message)
     if module_match:
         module_name = module_match.group(1)
         debug_comments.append(f"# モジュール '{module_name}' がインストールされていません")
         
         # 誤字修正
-        common_typos = {
-            'padas': 'pandas',
-            'nummpy': 'numpy',
-            'matplolib': 'matplotlib',
-            'sicpy': 'scipy',
-            'sklearn': 'scikit-learn',
-            'beautifulsop': 'beautifulsoup4',
-            'requets': 'requests'
-        }
-        
-        if module_name in common_typos:
-            correct_name = common_typos[module_name]
-            code = code.replace(f"import {module_name}", f"import {correct_name}")
-            code = code.replace(f"from {module_name}", f"from {correct_name}")
+        if module_name in _COMMON_MODULE_TYPOS:
+            correct_name = _COMMON_MODULE_TYPOS[module_name]
+            # import / from 文中のモジュール名の誤字を 1 回の走査でまとめて修正。
+            # 表の値には pip のパッケージ名 (scikit-learn など) もあり、インポート名として使えないので、
+            # そうした項目はエラーになったモジュール自身のときだけ置換する
+            def _replace_module(m):
+                typo = m.group(2)
+                fixed = _COMMON_MODULE_TYPOS[typo]
+                if typo != module_name and not fixed.isidentifier():
+                    return m.group(0)
+                return f"{m.group(1)}{fixed}"
+            code = _MODULE_TYPO_RE.sub(_replace_module, code)
             fixes_applied.append(f"モジュール名の誤字を修正: {module_name} → {correct_name}")
             
             # pip installコメントを追加
@@ -1330,26 +1906,20 @@ def _fix_import_errors(code: str, error_message: str) -> Tuple[str, List[str], L
                 fixes_applied.append("matplotlibの代わりに標準出力を提案")
     
     # 名前インポートエラーの修正
-    import_name_match = re.search(r"cannot import name '(.+)' from '(.+)'", error_message)
+    import_name_match = _CANNOT_IMPORT_RE.search(error_message)
     if import_name_match:
         name = import_name_match.group(1)
         module = import_name_match.group(2)
         debug_comments.append(f"# モジュール '{module}' から '{name}' をインポートできません")
         
         # 一般的な修正
-        common_fixes = {
-            ('pyplot', 'matplotlib'): 'from matplotlib import pyplot',
-            ('DataFrame', 'pandas'): 'from pandas import DataFrame',
-            ('train_test_split', 'sklearn'): 'from sklearn.model_selection import train_test_split'
-        }
-        
         fix_key = (name, module)
-        if fix_key in common_fixes:
-            correct_import = common_fixes[fix_key]
+        if fix_key in _COMMON_IMPORT_FIXES:
+            correct_import = _COMMON_IMPORT_FIXES[fix_key]
             # 元のインポート文を探して置き換え
-            import_pattern = rf"from\s+{re.escape(module)}\s+import\s+.*{re.escape(name)}"
-            if re.search(import_pattern, code):
-                code = re.sub(import_pattern, correct_import, code)
+            import_pattern = _from_import_re(module, name)
+            if import_pattern.search(code):
+                code = import_pattern.sub(correct_import, code)
             else:
                 code = correct_import + '\n' + code
             fixes_applied.append(f"インポート文を修正: {correct_import}")
@@ -1371,7 +1941,7 @@ def _fix_type_errors(code: str, error_message: str) -> Tuple[str, List[str], Lis
     fixes_applied = []
     
     # 'X' is not callable エラーの修正
-    not_callable_match = re.search(r"'(.+)' object is not callable", error_message)
+    not_callable_match = _NOT_CALLABLE_RE.search(error_message)
     if not_callable_match:
         obj_name = not_callable_match.group(1)
         debug_comments.append(f"# '{obj_name}' オブジェクトは呼び出し可能ではありません")
@@ -1380,14 +1950,14 @@ def _fix_type_errors(code: str, error_message: str) -> Tuple[str, List[str], Lis
         # 例: `list = [1, 2, 3]` の後に `list(x)` を呼ぶ
         if obj_name in ['list', 'dict', 'int', 'str', 'set', 'tuple']:
             # 変数名を変更
-            var_pattern = rf"{obj_name}\s*="
-            if re.search(var_pattern, code):
+            var_pattern = _assign_re(obj_name)
+            if var_pattern.search(code):
                 new_var_name = f"my_{obj_name}"
-                code = re.sub(var_pattern, f"{new_var_name} =", code)
+                code = var_pattern.sub(f"{new_var_name} =", code)
                 fixes_applied.append(f"組み込み型名の変数を改名: {obj_name} → {new_var_name}")
     
     # 'X' is not subscriptable エラーの修正
-    not_subscriptable_match = re.search(r"'(.+)' object is not subscriptable", error_message)
+    not_subscriptable_match = _NOT_SUBSCRIPTABLE_RE.search(error_message)
     if not_subscriptable_match:
         obj_name = not_subscriptable_match.group(1)
         debug_comments.append(f"# '{obj_name}' オブジェクトはインデックス付け可能ではありません")
@@ -1401,7 +1971,7 @@ def _fix_type_errors(code: str, error_message: str) -> Tuple[str, List[str], Lis
             fixes_applied.append("None型へのインデックス付けを特定")
     
     # シーケンス結合エラーの修正
-    concat_match = re.search(r"can only concatenate (.+) \(not \"(.+)\"\) to (.+)", error_message)
+    concat_match = _CONCAT_RE.search(error_message)
     if concat_match:
         type1 = concat_match.group(1)
         type2 = concat_match.group(2)
@@ -1439,7 +2009,7 @@ def _fix_index_key_errors(code: str, error_message: str) -> Tuple[str, List[str]
         fixes_applied.append("インデックスチェックを提案")
     
     # キーエラーを修正
-    key_match = re.search(r"KeyError: '(.+)'", error_message)
+    key_match = _KEY_ERROR_RE.search(error_message)
     if key_match:
         key_name = key_match.group(1)
         debug_comments.append(f"# 辞書にキー '{key_name}' が存在しません")
@@ -1450,6 +2020,32 @@ def _fix_index_key_errors(code: str, error_message: str) -> Tuple[str, List[str]
     
     return code, debug_comments, fixes_applied
 
+# エラー種別 -> 修正関数 (複数の種別がメッセージに含まれる場合は先に書いたものを優先する)
+_ERROR_FIXERS = {
+    "SyntaxError": _fix_syntax_errors,
+    "NameError": _fix_name_errors,
+    "ImportError": _fix_import_errors,
+    "ModuleNotFoundError": _fix_import_errors,
+    "TypeError": _fix_type_errors,
+    "IndexError": _fix_index_key_errors,
+    "KeyError": _fix_index_key_errors,
+}
+_ERROR_TYPE_RE = re.compile("|".join(_ERROR_FIXERS))
+
+def _select_fixer(error_message: str):
+    """エラーメッセージを 1 回だけ走査し、対応する修正関数を返す (該当なしなら None)"""
+    found = set(_ERROR_TYPE_RE.findall(error_message))
+    for error_type, fixer in _ERROR_FIXERS.items():
+        if error_type in found:
+            return fixer
+    return None
+
+# LLM によるコード修正の呼び出しパラメータと応答キャッシュ
+_LLM_FIX_TEMPERATURE = 0.2
+_LLM_FIX_MAX_TOKENS = 2000
+_LLM_FIX_CACHE_DIR = os.path.join(_CACHE_ROOT, "llm-debug")
+_LLM_FIX_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
 def _request_llm_code_fix(code: str, error_message: str, container_id: Optional[str] = None) -> str:
     """
     LLMにコード修正を依頼する
@@ -1465,10 +2061,6 @@ def _request_llm_code_fix(code: str, error_message: str, container_id: Optional[
     from config import CONFIG
     
     try:
-        # LLMクライアントを取得
-        from llm.azure_openai_client import AzureOpenAIClient
-        llm_client = AzureOpenAIClient()
-        
         # 構造化出力を要求するシステムプロンプト
         system_prompt = """あなたはPythonデバッグの専門家です。エラーの原因を分析し、修正したコードを提供してください。
 以下の形式で応答してください:
@@ -1492,47 +2084,60 @@ def _request_llm_code_fix(code: str, error_message: str, container_id: Optional[
 {error_message}
 """
         
-        # LLMの応答を取得
-        response_text = llm_client.call_azure_openai(
-            prompt=prompt,
-            system_prompt=system_prompt,
-            model=CONFIG["llm"]["model"],
-            temperature=0.2,  # デバッグは低温度が適切
-            max_tokens=2000
-        )
+        # 同じモデル・プロンプト・パラメータの応答がキャッシュにあれば LLM を呼ばない
+        # (モデル名は OpenAIClient と同じく LLM_MODEL 環境変数を優先する)
+        model = os.getenv("LLM_MODEL", CONFIG["llm"]["model"])
+        cache_key = hashlib.sha256(
+            json.dumps([model, system_prompt, prompt, _LLM_FIX_TEMPERATURE, _LLM_FIX_MAX_TOKENS]).encode()
+        ).hexdigest()
+        response_data = _cache_load(_LLM_FIX_CACHE_DIR, cache_key)
+        
+        if response_data is None:
+            # LLMの応答を取得 (JSON モードで応答させ、クライアントが解析済みの辞書を返す)
+            from llm.openai_client import OpenAIClient
+            llm_client = OpenAIClient()
+            response = llm_client.call_openai(
+                prompt=prompt,
+                system_prompt=system_prompt,
+                model=model,
+                temperature=_LLM_FIX_TEMPERATURE,  # デバッグは低温度が適切
+                max_tokens=_LLM_FIX_MAX_TOKENS,
+                force_json=True
+            )
+            
+            # クライアントが解析済みの辞書を返す場合はそのまま使う
+            if isinstance(response, dict):
+                response_data = response
+            else:
+                try:
+                    response_data = json.loads(response)
+                except json.JSONDecodeError:
+                    response_data = None
+            # (クライアントは解析に失敗すると {"error": ..., "content": ...} を返す)
+            if not isinstance(response_data, dict) or ("error" in response_data and "fixed_code" not in response_data):
+                return f"LLMの応答をJSONとして解析できませんでした。生の応答:\n\n{response}"
+            
+            # 解析できた応答だけをキャッシュする
+            _cache_store(_LLM_FIX_CACHE_DIR, cache_key, response_data, _LLM_FIX_CACHE_MAX_BYTES)
         
-        # JSONを抽出して解析
-        import re
-        import json
+        analysis = response_data.get("analysis", "分析情報なし")
+        fixed_code = response_data.get("fixed_code", "")
+        changes = response_data.get("changes", "変更点の説明なし")
         
-        # 応答からJSONを抽出
-        json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
-        if not json_match:
-            return f"LLMは構造化された応答を返しませんでした。生の応答:\n\n{response_text}"
+        if not fixed_code:
+            return f"LLMは修正コードを提供できませんでした。分析結果:\n\n{analysis}"
         
-        try:
-            response_data = json.loads(json_match.group(0))
-            analysis = response_data.get("analysis", "分析情報なし")
-            fixed_code = response_data.get("fixed_code", "")
-            changes = response_data.get("changes", "変更点の説明なし")
+        # 修正されたコードをテスト実行
+        if container_id:
+            sandbox = get_sandbox()
+            stdout, stderr, exit_code = sandbox.execute_python(container_id, fixed_code)
             
-            if not fixed_code:
-                return f"LLMは修正コードを提供できませんでした。分析結果:\n\n{analysis}"
-            
-            # 修正されたコードをテスト実行
-            if container_id:
-                sandbox = get_sandbox()
-                stdout, stderr, exit_code = sandbox.execute_python(container_id, fixed_code)
-                
-                if exit_code == 0:
-                    return f"LLMによる修正が成功しました！\n\n【分析】\n{analysis}\n\n【変更点】\n{changes}\n\n【修正コード】\n{fixed_code}\n\n【実行結果】\n{stdout}"
-                else:
-                    return f"LLMは修正を試みましたが、まだエラーがあります:\n\n【エラー】\n{stderr}\n\n【分析】\n{analysis}\n\n【変更点】\n{changes}\n\n【提案されたコード】\n{fixed_code}"
-            
-            return f"LLMによる修正提案:\n\n【分析】\n{analysis}\n\n【変更点】\n{changes}\n\n【修正コード】\n{fixed_code}"
-            
-        except json.JSONDecodeError:
-            return f"LLMの応答をJSONとして解析できませんでした。生の応答:\n\n{response_text}"
+            if exit_code == 0:
+                return f"LLMによる修正が成功しました！\n\n【分析】\n{analysis}\n\n【変更点】\n{changes}\n\n【修正コード】\n{fixed_code}\n\n【実行結果】\n{stdout}"
+            else:
+                return f"LLMは修正を試みましたが、まだエラーがあります:\n\n【エラー】\n{stderr}\n\n【分析】\n{analysis}\n\n【変更点】\n{changes}\n\n【提案されたコード】\n{fixed_code}"
+        
+        return f"LLMによる修正提案:\n\n【分析】\n{analysis}\n\n【変更点】\n{changes}\n\n【修正コード】\n{fixed_code}"
     
     except Exception as e:
         logger.error(f"LLMコード修正中にエラー: {str(e)}")
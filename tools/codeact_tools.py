@@ -5,19 +5,50 @@ Manusのようなエージェントシステムで、コードをアクション
 本番環境向けに強化された実装。
 """
 from core.logging_config import logger
-from typing import Optional, Dict, Any, List, Union
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple, Union
+import ast
+import functools
+import io
+import itertools
 import json
 import time
 import os
 import tempfile
 import re
+import string
+import tokenize
 from tools.tool_registry import tool
-from sandbox.sandbox import get_sandbox
+from sandbox.sandbox import get_sandbox, release_at_exit
 
 # 環境設定
 ALLOWED_MODULES = os.getenv("CODEACT_ALLOWED_MODULES", "os,pandas,numpy,matplotlib,requests,bs4,json,csv,re,math,datetime,time").split(",")
 MAX_CODE_SIZE = int(os.getenv("CODEACT_MAX_CODE_SIZE", "50000"))  # 最大コードサイズ（文字数）
 EXECUTION_TIMEOUT = int(os.getenv("CODEACT_EXECUTION_TIMEOUT", "300"))  # 最大実行時間（秒）
+# 結果に含める stdout / stderr それぞれの最大文字数
+_MAX_OUTPUT_CHARS = 256 * 1024
+
+# container_id 未指定時に使う既定のセッション (release_at_exit でプロセス終了時に解放する)
+_DEFAULT_SESSION = "codeact-session"
+_DEBUG_SESSION = "codeact-debug"
+_ANALYSIS_SESSION = "codeact-analysis"
+
+# 許可モジュールの判定用 (サブモジュールは "親." の前方一致で許可)
+_ALLOWED_MODULES_SET = frozenset(ALLOWED_MODULES)
+_ALLOWED_MODULE_PREFIXES = tuple(f"{module}." for module in ALLOWED_MODULES)
+
+# コードの検査・自動修正で使う正規表現 (呼び出しごとにパターンを引かないよう事前にコンパイルしておく)
+_IMPORT_RE = re.compile(r'(?:import|from)\s+([a-zA-Z0-9_]+)(?:\s+import|\s*$)', re.M)
+_DANGEROUS_RES = [
+    re.compile(r'(__import__\s*\(\s*["\']os["\'].*system)'),  # OSコマンド実行の迂回方法
+    re.compile(r'(eval\s*\(\s*input\s*\()'),  # 入力のeval
+    re.compile(r'(subprocess\..*?(?:call|Popen|run).*?shell\s*=\s*True)'),  # シェルを有効にしたサブプロセス
+    re.compile(r'(open\s*\(.+?["\']w["\'])'),  # ファイル書き込み (codeact_tools内では許可しない)
+]
+_MODULE_NOT_FOUND_RE = re.compile(r"No module named '([^']+)'")
+_LINE_NUM_RE = re.compile(r'line (\d+)')
+_NAME_ERR_RE = re.compile(r"name '([^']+)' is not defined")
+# if, for, while, def, class, with, try, except, finally, else, elif の行で末尾の : が欠けているもの
+_MISSING_COLON_RE = re.compile(r'^(\s*(?:if|for|while|def|class|with|try|except|finally|else|elif).*[^\s:])$')
 
 @tool(
     name="code_execute",
@@ -54,23 +85,16 @@ def code_execute(
     Returns:
         実行結果を含む文字列
     """
-    # コードサイズチェック
-    if len(code) > MAX_CODE_SIZE:
-        return f"エラー: コードが大きすぎます({len(code)}文字)。最大{MAX_CODE_SIZE}文字まで。"
-    
-    # 禁止モジュールのチェック
-    if _has_forbidden_modules(code):
-        return "エラー: 許可されていないモジュールをインポートしようとしています。"
-    
-    # セキュリティチェック
-    if _has_security_issues(code):
-        return "エラー: コードにセキュリティリスクがあります。禁止されている操作が含まれています。"
+    # コードサイズ・禁止モジュール・セキュリティのチェック
+    error = _validate_code(code)
+    if error:
+        return error
     
     description_text = f"目的: {description}" if description else "コード実行"
     logger.info(f"{description_text} - コード実行開始")
     
     # コード実行の準備
-    container = container_id or "codeact-session"
+    container = container_id or release_at_exit(_DEFAULT_SESSION)
     
     # ファイル出力設定
     output_capture = ""
@@ -112,6 +136,9 @@ finally:
         # 実行時間の計算
         execution_time = time.time() - start_time
         
+        # 結果に埋め込む前に出力を切り詰める
+        stdout, stderr = _truncate_output(stdout), _truncate_output(stderr)
+        
         # 結果の整形
         if stderr:
             logger.warning(f"コード実行でエラー発生 (終了コード: {exit_code}): {stderr[:100]}...")
@@ -129,10 +156,10 @@ finally:
         
         # 出力ファイルが作成された場合は通知
         if save_output and output_file:
-            if os.path.exists(output_file):
-                file_size = os.path.getsize(output_file)
+            try:
+                file_size = os.stat(output_file).st_size
                 result += f"\n\n出力をファイル '{output_file}' に保存しました（サイズ: {file_size} バイト）"
-            else:
+            except FileNotFoundError:
                 result += f"\n\n警告: 出力ファイル '{output_file}' が作成されませんでした。"
         
         return result
@@ -141,6 +168,13 @@ finally:
         logger.error(f"コード実行中に例外発生: {str(e)}")
         return f"コード実行中にシステムエラーが発生しました: {str(e)}"
 
+def _truncate_output(text: str, limit: int = _MAX_OUTPUT_CHARS) -> str:
+    """出力が limit 文字を超える場合は先頭と末尾を残して中間を省略する (末尾のエラーを残すため)"""
+    if len(text) <= limit:
+        return text
+    half = limit // 2
+    return f"{text[:half]}\n...({len(text) - 2 * half} 文字省略)...\n{text[-half:]}"
+
 def _has_forbidden_modules(code: str) -> bool:
     """
     コードに禁止されているモジュールがあるかチェックします。
@@ -152,12 +186,11 @@ def _has_forbidden_modules(code: str) -> bool:
         禁止モジュールがある場合はTrue
     """
     # インポート文を検索
-    import_pattern = r'(?:import|from)\s+([a-zA-Z0-9_]+)(?:\s+import|\s*$)'
-    imports = re.findall(import_pattern, code)
+    imports = _IMPORT_RE.findall(code)
     
     # 許可されているモジュールリスト
     for module in imports:
-        if module not in ALLOWED_MODULES and not any(module.startswith(f"{allowed}.") for allowed in ALLOWED_MODULES):
+        if module not in _ALLOWED_MODULES_SET and not module.startswith(_ALLOWED_MODULE_PREFIXES):
             logger.warning(f"禁止モジュール検出: {module}")
             return True
     
@@ -173,22 +206,147 @@ def _has_security_issues(code: str) -> bool:
     Returns:
         セキュリティ問題がある場合はTrue
     """
-    # 危険なパターンのリスト
-    dangerous_patterns = [
-        r'(__import__\s*\(\s*["\']os["\'].*system)',  # OSコマンド実行の迂回方法
-        r'(eval\s*\(\s*input\s*\()',  # 入力のeval
-        r'(subprocess\..*?(?:call|Popen|run).*?shell\s*=\s*True)',  # シェルを有効にしたサブプロセス
-        r'(open\s*\(.+?["\']w["\'])',  # ファイル書き込み (codeact_tools内では許可しない)
-    ]
-    
-    for pattern in dangerous_patterns:
-        if re.search(pattern, code):
+    # 危険なパターンのいずれかに一致するか
+    for pattern in _DANGEROUS_RES:
+        if pattern.search(code):
             return True
     
     return False
 
+_FORBIDDEN_MODULE_MESSAGE = "エラー: 許可されていないモジュールをインポートしようとしています。"
+_SECURITY_ISSUE_MESSAGE = "エラー: コードにセキュリティリスクがあります。禁止されている操作が含まれています。"
+
+# シェル経由でコマンドを実行できる subprocess の関数
+_SUBPROCESS_CALLS = frozenset({"call", "check_call", "check_output", "Popen", "run"})
+
+@functools.lru_cache(maxsize=32)
+def _parse_code(code: str) -> Optional[ast.Module]:
+    """コードを構文解析した AST を返す (同じコードは使い回す)。構文エラーなら None"""
+    try:
+        return ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+
+def _syntax_error(code: str) -> Optional[SyntaxError]:
+    """コードをローカルで構文解析し、構文エラーならその例外 (行・位置付き) を返す"""
+    if _parse_code(code) is not None:
+        return None
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        return e
+    except ValueError:
+        pass
+    return None
+
+def _describe_syntax_error(error: SyntaxError) -> str:
+    """構文エラーを修正関数が解析できる形式 (line N) のメッセージにする"""
+    return f"{type(error).__name__}: {error.msg} (line {error.lineno})"
+
+def _is_allowed_module(module: str) -> bool:
+    """トップレベルのモジュール名が許可リストにあるか"""
+    return module.split(".")[0] in _ALLOWED_MODULES_SET
+
+def _is_name(node: ast.AST, name: str) -> bool:
+    return isinstance(node, ast.Name) and node.id == name
+
+def _analyze_code_safety(code: str) -> Tuple[bool, str]:
+    """
+    コードを 1 度だけ構文解析し、禁止モジュールと危険な操作をまとめてチェックします。
+    
+    Args:
+        code: チェックするPythonコード
+        
+    Returns:
+        (安全か, 安全でない場合のエラーメッセージ)
+    """
+    tree = _parse_code(code)
+    if tree is None:
+        # 構文解析できないコードは従来の正規表現でチェックする
+        if _has_forbidden_modules(code):
+            return False, _FORBIDDEN_MODULE_MESSAGE
+        if _has_security_issues(code):
+            return False, _SECURITY_ISSUE_MESSAGE
+        return True, ""
+    
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if not _is_allowed_module(alias.name):
+                    logger.warning(f"禁止モジュール検出: {alias.name}")
+                    return False, _FORBIDDEN_MODULE_MESSAGE
+        
+        elif isinstance(node, ast.ImportFrom):
+            # 相対インポートは対象外
+            if node.level == 0 and node.module and not _is_allowed_module(node.module):
+                logger.warning(f"禁止モジュール検出: {node.module}")
+                return False, _FORBIDDEN_MODULE_MESSAGE
+        
+        elif isinstance(node, ast.Call):
+            func = node.func
+            
+            # __import__("x") による動的インポート
+            if _is_name(func, "__import__") and node.args:
+                arg = node.args[0]
+                if isinstance(arg, ast.Constant) and isinstance(arg.value, str) and not _is_allowed_module(arg.value):
+                    logger.warning(f"禁止モジュール検出: {arg.value}")
+                    return False, _FORBIDDEN_MODULE_MESSAGE
+            
+            # 入力のeval
+            elif _is_name(func, "eval") and node.args:
+                arg = node.args[0]
+                if isinstance(arg, ast.Call) and _is_name(arg.func, "input"):
+                    return False, _SECURITY_ISSUE_MESSAGE
+            
+            # ファイル書き込み (codeact_tools内では許可しない)
+            elif _is_name(func, "open"):
+                mode = node.args[1] if len(node.args) > 1 else next(
+                    (kw.value for kw in node.keywords if kw.arg == "mode"), None
+                )
+                if isinstance(mode, ast.Constant) and isinstance(mode.value, str) and "w" in mode.value:
+                    return False, _SECURITY_ISSUE_MESSAGE
+            
+            elif isinstance(func, ast.Attribute):
+                # os.system / __import__("os").system によるOSコマンド実行
+                if func.attr == "system" and (
+                    _is_name(func.value, "os")
+                    or (isinstance(func.value, ast.Call) and _is_name(func.value.func, "__import__"))
+                ):
+                    return False, _SECURITY_ISSUE_MESSAGE
+                
+                # シェルを有効にしたサブプロセス
+                if func.attr in _SUBPROCESS_CALLS and _is_name(func.value, "subprocess") and any(
+                    kw.arg == "shell" and isinstance(kw.value, ast.Constant) and kw.value.value is True
+                    for kw in node.keywords
+                ):
+                    return False, _SECURITY_ISSUE_MESSAGE
+    
+    return True, ""
+
+def _validate_code(code: str) -> Optional[str]:
+    """
+    実行前のチェックをまとめて行い、最初に見つかった問題のエラーメッセージを返します。
+    
+    Args:
+        code: チェックするPythonコード
+        
+    Returns:
+        問題がある場合はエラーメッセージ、無ければNone
+    """
+    # サイズ超過のコードは解析せずに弾く
+    if len(code) > MAX_CODE_SIZE:
+        return f"エラー: コードが大きすぎます({len(code)}文字)。最大{MAX_CODE_SIZE}文字まで。"
+    
+    # 禁止モジュールと危険な操作は 1 回の AST 走査で調べる
+    is_safe, reason = _analyze_code_safety(code)
+    return None if is_safe else reason
+
 def _indent_code(code: str, spaces: int) -> str:
-    """コードをインデントします"""
+    """
+    コードの各行 (1 行目と空行を含む) をインデントします。
+    先頭に付けてから改行を 1 回の置換で増やすのが、行ごとに処理する textwrap.indent より速い。
+    呼び出し側は結果を行頭 (0 桁目) に埋め込むこと。
+    """
     indent = " " * spaces
     return indent + code.replace("\n", f"\n{indent}")
 
@@ -204,16 +362,19 @@ def _try_fix_code(code: str, error_message: str, container_id: str) -> Optional[
     Returns:
         修正結果またはNone
     """
+    # 各修正で同じサンドボックスを使う
+    sandbox = get_sandbox()
+    
+    # エラーメッセージは 1 度だけ解析する
+    error_info = _parse_error_message(error_message)
+    
     # ここに簡単な自動修正ロジックを実装
     # モジュールのインポートエラー修正
-    if "ModuleNotFoundError" in error_message:
-        match = re.search(r"No module named '([^']+)'", error_message)
-        if match:
-            module_name = match.group(1)
-            
+    if error_info.error_type == "ModuleNotFoundError":
+        module_name = error_info.module
+        if module_name:
             # コンテナ内でパッケージをインストール
             logger.info(f"必要なモジュール {module_name} をインストール中...")
-            sandbox = get_sandbox()
             cmd = f"pip install {module_name} --user"
             stdout, stderr, exit_code = sandbox.execute_command(container_id, cmd)
             
@@ -226,30 +387,16 @@ def _try_fix_code(code: str, error_message: str, container_id: str) -> Optional[
                 else:
                     return f"モジュール {module_name} をインストールしましたが、まだエラーがあります：\n\n{new_stderr}"
     
-    # インデントエラー修正
-    if "IndentationError" in error_message:
-        # サンドボックスで修正ツールを実行
-        fix_code = f"""
-import re
-
-code = '''{code}'''
-lines = code.split('\\n')
-fixed_lines = []
-
-for line in lines:
-    # タブをスペースに変換
-    fixed_line = line.replace('\\t', '    ')
-    fixed_lines.append(fixed_line)
-
-fixed_code = '\\n'.join(fixed_lines)
-print(fixed_code)
-"""
-        sandbox = get_sandbox()
-        stdout, stderr, exit_code = sandbox.execute_python(container_id, fix_code)
-        
-        if exit_code == 0 and stdout:
+    # 構文エラーかどうかはエラーメッセージの文字列ではなく、ローカルでの構文解析で判定する
+    syntax_err = _syntax_error(code)
+    
+    # インデントエラー修正 (文字列の置換だけなのでローカルで行い、検証の実行だけをサンドボックスで行う)
+    if isinstance(syntax_err, IndentationError):
+        # タブをスペースに変換
+        fixed_code = code.replace('\t', '    ')
+        if fixed_code != code:
             # 修正コードを再実行
-            new_stdout, new_stderr, new_exit_code = sandbox.execute_python(container_id, stdout)
+            new_stdout, new_stderr, new_exit_code = sandbox.execute_python(container_id, fixed_code)
             
             if new_exit_code == 0:
                 return f"インデントを修正して実行しました！\n\n[stdout]\n{new_stdout}"
@@ -257,39 +404,12 @@ print(fixed_code)
                 return f"インデントを修正しましたが、まだエラーがあります：\n\n{new_stderr}"
     
     # 一般的な構文エラー修正を試みる
-    if "SyntaxError" in error_message:
+    if syntax_err is not None:
         # バランスの取れていない括弧を修正
-        fix_code = f"""
-code = '''{code}'''
-
-# 括弧のバランスチェックと修正
-brackets = {{'(': ')', '[': ']', '{{': '}}'}}
-bracket_stack = []
-lines = code.split('\\n')
-
-for i, line in enumerate(lines):
-    for char in line:
-        if char in brackets.keys():
-            bracket_stack.append((char, i))
-        elif char in brackets.values():
-            if bracket_stack and char == brackets[bracket_stack[-1][0]]:
-                bracket_stack.pop()
-
-# 閉じられていない括弧を修正
-fixed_code = code
-if bracket_stack:
-    print(f"未閉じの括弧を修正します...")
-    for bracket, _ in reversed(bracket_stack):
-        fixed_code += brackets[bracket]
-
-print(fixed_code)
-"""
-        sandbox = get_sandbox()
-        stdout, stderr, exit_code = sandbox.execute_python(container_id, fix_code)
-        
-        if exit_code == 0 and stdout and stdout != code:
+        fixed_code = _close_open_brackets(code)
+        if fixed_code != code:
             # 修正コードを再実行
-            new_stdout, new_stderr, new_exit_code = sandbox.execute_python(container_id, stdout)
+            new_stdout, new_stderr, new_exit_code = sandbox.execute_python(container_id, fixed_code)
             
             if new_exit_code == 0:
                 return f"構文エラーを修正して実行しました！\n\n[stdout]\n{new_stdout}"
@@ -348,19 +468,16 @@ def codeact_data_analysis(
         image_path = os.path.join(image_dir, image_filename)
     
     # 出力形式に応じたコード拡張
-    if output_format == "json":
-        enhanced_code = _prepare_json_output_code(code, data_file, image_path, generate_visualization)
-    elif output_format == "csv":
-        enhanced_code = _prepare_csv_output_code(code, data_file, image_path, generate_visualization)
-    else:
-        enhanced_code = _prepare_text_output_code(code, data_file, image_path, generate_visualization)
+    enhanced_code = _prepare_output_code(code, data_file, image_path, generate_visualization, output_format)
     
     # 分析実行のログ記録
     logger.info(f"データ分析を実行: {data_file}")
     
     # Dockerサンドボックスでコードを実行
     sandbox = get_sandbox()
-    stdout, stderr, exit_code = sandbox.execute_python(container_id or "codeact-session", enhanced_code)
+    stdout, stderr, exit_code = sandbox.execute_python(container_id or release_at_exit(_DEFAULT_SESSION), enhanced_code)
+    
+    stdout, stderr = _truncate_output(stdout), _truncate_output(stderr)
     
     # エラー処理
     if stderr and exit_code != 0:
@@ -376,18 +493,9 @@ def codeact_data_analysis(
     
     return result
 
-def _prepare_text_output_code(code: str, data_file: str, image_path: str, generate_visualization: bool) -> str:
-    """テキスト出力用のコードを準備"""
-    visualization_code = ""
-    if generate_visualization and image_path:
-        visualization_code = f"""
-# プロットを画像ファイルに保存
-import matplotlib.pyplot as plt
-plt.savefig('{image_path}', dpi=300, bbox_inches='tight')
-print(f"可視化を '{image_path}' に保存しました")
-"""
-
-    return f"""
+# データ分析コードの共通テンプレート。出力形式ごとに異なる部分 ($preamble など) は
+# モジュール読み込み時に埋めておき、呼び出し時はデータファイル・ユーザーコード・可視化だけを差し込む
+_ANALYSIS_TEMPLATE = string.Template("""
 # 必要なライブラリをインポート
 import pandas as pd
 import numpy as np
@@ -397,13 +505,14 @@ import os
 import json
 import sys
 import traceback
-
+import io
+$preamble
 # データファイルパスを設定
-DATA_FILE = "{data_file}"
+DATA_FILE = "$$data_file"
 
 # データ形式を自動判定
 data_ext = os.path.splitext(DATA_FILE)[1].lower()
-
+$setup
 # 分析メイン処理
 try:
     # データ読み込み
@@ -416,174 +525,134 @@ try:
     elif data_ext == '.tsv' or data_ext == '.txt':
         df = pd.read_csv(DATA_FILE, sep='\\t')
     else:
-        print(f"未対応のファイル形式: {{data_ext}}")
+        print(f"未対応のファイル形式: {data_ext}")
         df = pd.read_csv(DATA_FILE, sep=None, engine='python')  # 区切り文字自動検出
-    
-    # データファイル情報
-    print(f"データファイル: {{DATA_FILE}}")
-    print(f"行数: {{len(df)}}, 列数: {{len(df.columns)}}")
-    print(f"列名: {{list(df.columns)}}")
-    print("\\n基本統計情報:")
-    print(df.describe())
-    
+
+$file_info
     # ユーザーコードを実行
-    print("\\n分析実行:")
-    {_indent_code(code, 4)}
-    
-    {visualization_code}
-    
+$$user_code
+
+$$visualization
+$result
 except Exception as e:
-    print(f"エラーが発生しました: {{str(e)}}")
+$on_error
+$postamble""")
+
+# 可視化の保存 (text / csv 形式)
+_PRINT_VISUALIZATION = string.Template("""\
+    # プロットを画像ファイルに保存
+    plt.savefig('$image_path', dpi=300, bbox_inches='tight')
+    print("可視化を '$image_path' に保存しました")
+""")
+
+_PRINT_ERROR = """\
+    print(f"エラーが発生しました: {str(e)}")
     traceback.print_exc()
 """
 
-def _prepare_json_output_code(code: str, data_file: str, image_path: str, generate_visualization: bool) -> str:
-    """JSON出力用のコードを準備"""
-    visualization_code = ""
-    if generate_visualization and image_path:
-        visualization_code = f"""
-# プロットを画像ファイルに保存
-import matplotlib.pyplot as plt
-plt.savefig('{image_path}', dpi=300, bbox_inches='tight')
-viz_saved_path = '{image_path}'
-"""
-
-    return f"""
-# 必要なライブラリをインポート
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-from pathlib import Path
-import os
-import json
-import sys
-import traceback
-import io
-
+# 出力形式ごとの (テンプレート, 可視化の保存コード)
+_ANALYSIS_TEMPLATES = {
+    "text": (
+        string.Template(_ANALYSIS_TEMPLATE.substitute(
+            preamble="",
+            setup="",
+            file_info="""\
+    # データファイル情報
+    print(f"データファイル: {DATA_FILE}")
+    print(f"行数: {len(df)}, 列数: {len(df.columns)}")
+    print(f"列名: {list(df.columns)}")
+    print("\\n基本統計情報:")
+    print(df.describe())
+    print("\\n分析実行:")
+""",
+            result="",
+            on_error=_PRINT_ERROR,
+            postamble="",
+        )),
+        _PRINT_VISUALIZATION,
+    ),
+    "json": (
+        string.Template(_ANALYSIS_TEMPLATE.substitute(
+            preamble="""
 # キャプチャ用の文字列バッファを作成
 output_buffer = io.StringIO()
 sys.stdout = output_buffer
-
-# データファイルパスを設定
-DATA_FILE = "{data_file}"
-
-# データ形式を自動判定
-data_ext = os.path.splitext(DATA_FILE)[1].lower()
-
+""",
+            setup="""
 # 分析結果
-result = {{"success": False, "data": {{}}, "visualization": None, "error": None}}
-
-# 分析メイン処理
-try:
-    # データ読み込み
-    if data_ext == '.csv':
-        df = pd.read_csv(DATA_FILE)
-    elif data_ext in ['.xlsx', '.xls']:
-        df = pd.read_excel(DATA_FILE)
-    elif data_ext == '.json':
-        df = pd.read_json(DATA_FILE)
-    elif data_ext == '.tsv' or data_ext == '.txt':
-        df = pd.read_csv(DATA_FILE, sep='\\t')
-    else:
-        df = pd.read_csv(DATA_FILE, sep=None, engine='python')  # 区切り文字自動検出
-    
+result = {"success": False, "data": {}, "visualization": None, "error": None}
+""",
+            file_info="""\
     # データファイル情報
-    result["data"]["file_info"] = {{
+    result["data"]["file_info"] = {
         "path": DATA_FILE,
         "rows": len(df),
         "columns": len(df.columns),
         "column_names": list(df.columns)
-    }}
-    
+    }
+
     # 基本統計情報
     result["data"]["summary"] = json.loads(df.describe().to_json())
-    
-    # ユーザーコードを実行
-    {_indent_code(code, 4)}
-    
-    {visualization_code}
-    if 'viz_saved_path' in locals():
-        result["visualization"] = viz_saved_path
-    
+""",
+            result="""\
     result["success"] = True
-    
-except Exception as e:
-    result["error"] = {{"message": str(e), "traceback": traceback.format_exc()}}
-
+""",
+            on_error="""\
+    result["error"] = {"message": str(e), "traceback": traceback.format_exc()}
+""",
+            postamble="""
 # 標準出力を元に戻す
 sys.stdout = sys.__stdout__
 
 # 結果をJSON形式で出力
 result["output"] = output_buffer.getvalue()
 print(json.dumps(result, indent=2))
-"""
-
-def _prepare_csv_output_code(code: str, data_file: str, image_path: str, generate_visualization: bool) -> str:
-    """CSV出力用のコードを準備"""
-    visualization_code = ""
-    if generate_visualization and image_path:
-        visualization_code = f"""
-# プロットを画像ファイルに保存
-import matplotlib.pyplot as plt
-plt.savefig('{image_path}', dpi=300, bbox_inches='tight')
-print(f"可視化を '{image_path}' に保存しました")
-"""
-
-    return f"""
-# 必要なライブラリをインポート
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-from pathlib import Path
-import os
-import json
-import sys
-import traceback
-import io
-
-# データファイルパスを設定
-DATA_FILE = "{data_file}"
-
-# データ形式を自動判定
-data_ext = os.path.splitext(DATA_FILE)[1].lower()
-
-# 分析メイン処理
-try:
-    # データ読み込み
-    if data_ext == '.csv':
-        df = pd.read_csv(DATA_FILE)
-    elif data_ext in ['.xlsx', '.xls']:
-        df = pd.read_excel(DATA_FILE)
-    elif data_ext == '.json':
-        df = pd.read_json(DATA_FILE)
-    elif data_ext == '.tsv' or data_ext == '.txt':
-        df = pd.read_csv(DATA_FILE, sep='\\t')
-    else:
-        print(f"未対応のファイル形式: data_ext")
-        df = pd.read_csv(DATA_FILE, sep=None, engine='python')  # 区切り文字自動検出
-    
+""",
+        )),
+        string.Template("""\
+    # プロットを画像ファイルに保存
+    plt.savefig('$image_path', dpi=300, bbox_inches='tight')
+    result["visualization"] = '$image_path'
+"""),
+    ),
+    "csv": (
+        string.Template(_ANALYSIS_TEMPLATE.substitute(
+            preamble="",
+            setup="",
+            file_info="""\
     # データファイル情報
-    print(f"# データファイル: {{DATA_FILE}}")
-    print(f"# 行数: {{len(df)}}, 列数: {{len(df.columns)}}")
-    print(f"# 列名: {{list(df.columns)}}")
-    
-    # ユーザーコードを実行
-    {{_indent_code(code, 4)}}
-    
-    {{visualization_code}}
-    
-    # もし分析結果がデータフレームの場合、CSV形式で出力
-    result_vars = [var for var in dir() if not var.startswith('_') and var not in ['df', 'DATA_FILE', 'data_ext', 'Path', 'os', 'json', 'sys', 'traceback', 'io', 'pd', 'np', 'plt']]
-    for var_name in result_vars:
-        var = locals()[var_name]
+    print(f"# データファイル: {DATA_FILE}")
+    print(f"# 行数: {len(df)}, 列数: {len(df.columns)}")
+    print(f"# 列名: {list(df.columns)}")
+
+    # ユーザーコードが新しく定義した変数を後で見分けるため、実行前の名前を控えておく
+    _pre_vars = set(globals())
+""",
+            result="""\
+    # ユーザーコードで新しく定義された変数のうち、データフレームをCSV形式で出力
+    for var_name in sorted(set(globals()) - _pre_vars):
+        var = globals()[var_name]
         if isinstance(var, pd.DataFrame):
-            print(f"\\n# 分析結果: {{var_name}}")
+            print(f"\\n# 分析結果: {var_name}")
             print(var.to_csv(index=True))
-    
-except Exception as e:
-    print(f"エラーが発生しました: {{str(e)}}")
-    traceback.print_exc()
-"""
+""",
+            on_error=_PRINT_ERROR,
+            postamble="",
+        )),
+        _PRINT_VISUALIZATION,
+    ),
+}
+
+def _prepare_output_code(code: str, data_file: str, image_path: str, generate_visualization: bool,
+                         output_format: str = "text") -> str:
+    """出力形式 (text, json, csv) に応じてユーザーコードを分析用コードで包む"""
+    template, visualization = _ANALYSIS_TEMPLATES.get(output_format, _ANALYSIS_TEMPLATES["text"])
+    return template.substitute(
+        data_file=data_file,
+        user_code=_indent_code(code, 4),
+        visualization=visualization.substitute(image_path=image_path)
+        if generate_visualization and image_path else "",
+    )
 
 @tool(
     name="codeact_auto_debug",
@@ -623,109 +692,159 @@ def codeact_auto_debug(
     original_code = code
     
     # コンテナID設定
-    container = container_id or "codeact-debug"
+    container = container_id or release_at_exit(_DEBUG_SESSION)
     
-    # エラータイプの解析
-    error_type = _analyze_error_type(error_message)
-    logger.info(f"エラータイプ: {error_type}")
-    
-    # エラータイプ別の修正関数マッピング
-    error_fixers = {
-        "SyntaxError": _fix_syntax_error,
-        "IndentationError": _fix_indentation_error,
-        "NameError": _fix_name_error,
-        "ImportError": _fix_import_error,
-        "ModuleNotFoundError": _fix_module_not_found,
-        "TypeError": _fix_type_error,
-        "IndexError": _fix_index_error,
-        "KeyError": _fix_key_error,
-        "AttributeError": _fix_attribute_error,
-        "FileNotFoundError": _fix_file_not_found,
-        "ZeroDivisionError": _fix_zero_division,
-        "ValueError": _fix_value_error,
-        "UnboundLocalError": _fix_unbound_local_error
-    }
+    sandbox = get_sandbox()
     
-    # 該当するエラー修正機能を使用
-    if error_type in error_fixers:
-        fixed_code, success = error_fixers[error_type](code, error_message, container)
-        if success:
-            # 修正コードをテスト
-            sandbox = get_sandbox()
-            stdout, stderr, exit_code = sandbox.execute_python(container, fixed_code)
-            
-            if exit_code == 0:
-                # 修正成功
-                return f"エラータイプ {error_type} を自動修正しました！\n\n修正後のコード:\n{fixed_code}\n\n実行結果:\n{stdout}"
-            else:
-                # まだエラーがある場合は再帰的に修正を試みる
-                if max_attempts > 1:
-                    return codeact_auto_debug(fixed_code, stderr, container, max_attempts - 1)
-                else:
-                    return
-                
+    # 修正 → 再実行を、成功するか修正できなくなるまで最大 max_attempts 回繰り返す
+    while max_attempts > 0:
+        # エラータイプの解析。構文エラーは実行せずに特定でき、行・位置も例外から正確に分かる
+        syntax_err = _syntax_error(code)
+        if syntax_err is not None:
+            error_type = "IndentationError" if isinstance(syntax_err, IndentationError) else "SyntaxError"
+            error_message = _describe_syntax_error(syntax_err)
+        else:
+            error_type = _analyze_error_type(error_message)
+            if error_type in _SYNTAX_ERROR_TYPES:
+                # コード自体は構文解析できるので、構文の修正では直らない
+                return
+        logger.info(f"エラータイプ: {error_type}")
+        
+        # 該当するエラー修正機能を使用
+        fixer = _ERROR_FIXERS.get(error_type)
+        if fixer is None:
+            return
+        fixed_code, success = fixer(code, error_message, container)
+        if not success:
+            return
+        
+        # 修正コードをテスト
+        stdout, stderr, exit_code = sandbox.execute_python(container, fixed_code)
+        if exit_code == 0:
+            # 修正成功
+            return f"エラータイプ {error_type} を自動修正しました！\n\n修正後のコード:\n{fixed_code}\n\n実行結果:\n{stdout}"
+        
+        # まだエラーがある場合は修正後のコードと新しいエラーで続ける
+        code, error_message = fixed_code, stderr
+        max_attempts -= 1
+
+# 一般的なエラータイプ (複数含まれる場合は先にあるものを優先する)
+_ERROR_TYPES = (
+    "SyntaxError", "IndentationError", "TabError", "NameError", "TypeError",
+    "ValueError", "AttributeError", "ImportError", "ModuleNotFoundError",
+    "IndexError", "KeyError", "FileNotFoundError", "ZeroDivisionError",
+    "PermissionError", "OSError", "IOError", "RuntimeError", "UnboundLocalError"
+)
+_ERROR_TYPE_RE = re.compile("|".join(_ERROR_TYPES))
+# これより長いエラーメッセージはキャッシュしない
+_ERROR_TYPE_CACHE_MAX_LEN = 512
 
 def _analyze_error_type(error_message: str) -> str:
     """エラーメッセージからエラータイプを抽出"""
-    # 一般的なエラータイプのパターン
-    error_patterns = [
-        "SyntaxError", "IndentationError", "TabError", "NameError", "TypeError",
-        "ValueError", "AttributeError", "ImportError", "ModuleNotFoundError",
-        "IndexError", "KeyError", "FileNotFoundError", "ZeroDivisionError",
-        "PermissionError", "OSError", "IOError", "RuntimeError", "UnboundLocalError"
-    ]
-    
-    for error_type in error_patterns:
-        if error_type in error_message:
+    if len(error_message) <= _ERROR_TYPE_CACHE_MAX_LEN:
+        # 再試行では同じ短いメッセージが繰り返し渡されるのでキャッシュする
+        return _analyze_error_type_cached(error_message)
+    return _find_error_type(error_message)
+
+@functools.lru_cache(maxsize=512)
+def _analyze_error_type_cached(error_message: str) -> str:
+    return _find_error_type(error_message)
+
+class _ErrorInfo(NamedTuple):
+    """エラーメッセージから取り出した情報"""
+    error_type: str
+    module: Optional[str]  # ModuleNotFoundError の場合の見つからないモジュール名
+
+def _parse_error_message(error_message: str) -> _ErrorInfo:
+    """エラータイプと、必要な場合だけ見つからないモジュール名を取り出す"""
+    error_type = _analyze_error_type(error_message)
+    module_match = _MODULE_NOT_FOUND_RE.search(error_message) if error_type == "ModuleNotFoundError" else None
+    return _ErrorInfo(error_type, module_match.group(1) if module_match else None)
+
+def _find_error_type(error_message: str) -> str:
+    """エラーメッセージを 1 回だけ走査し、含まれるエラータイプのうち優先度の高いものを返す"""
+    found = set(_ERROR_TYPE_RE.findall(error_message))
+    for error_type in _ERROR_TYPES:
+        if error_type in found:
             return error_type
     
     return "Unknown"
 
+def _line_starts(lines: List[str]) -> List[int]:
+    """各行の先頭の文字位置 (末尾に全体の長さ + 1 を含む) を返す"""
+    return list(itertools.accumulate((len(line) + 1 for line in lines), initial=0))
+
+_CLOSING_BRACKETS = {'(': ')', '[': ']', '{': '}'}
+_BRACKET_RE = re.compile(r'[()\[\]{}]')
+# "closing parenthesis ')' does not match opening parenthesis '['" の開き括弧
+_BRACKET_MISMATCH_RE = re.compile(r"does not match opening parenthesis '([(\[{])'")
+
+def _bracket_positions(code: str) -> List[Tuple[int, str]]:
+    """
+    コード中の括弧の (文字位置, 括弧) を出現順に返す。
+    文字列リテラルやコメント中の括弧を拾わないよう tokenize で 1 回走査し、
+    字句解析できないコード (閉じていない文字列など) では正規表現で括弧だけを抜き出す。
+    """
+    # tokenize の (行, 列) を通し位置に変換する
+    line_starts = _line_starts(code.split('\n'))
+    
+    positions = []
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+            if tok.type == tokenize.OP and tok.string in '()[]{}':
+                row, col = tok.start
+                positions.append((line_starts[row - 1] + col, tok.string))
+        return positions
+    except tokenize.TokenError as e:
+        # 括弧が閉じていないまま EOF に達した場合は、それまでの括弧を拾い終わっている
+        if "multi-line statement" in str(e.args[0]):
+            return positions
+    except SyntaxError:
+        pass
+    return [(m.start(), m.group()) for m in _BRACKET_RE.finditer(code)]
+
+def _close_open_brackets(code: str) -> str:
+    """閉じられていない括弧に対応する閉じ括弧をコード末尾に追加する"""
+    stack = []
+    for _, char in _bracket_positions(code):
+        if char in _CLOSING_BRACKETS:
+            stack.append(char)
+        elif stack and _CLOSING_BRACKETS[stack[-1]] == char:
+            stack.pop()
+    return code + "".join(_CLOSING_BRACKETS[char] for char in reversed(stack))
+
 def _fix_syntax_error(code: str, error_message: str, container_id: str):
     """構文エラーの修正を試みる"""
-    # 括弧のバランスをチェック・修正
+    # 構文解析できるコードには直すべき構文エラーが無い
+    if _syntax_error(code) is None:
+        return code, False
+    
+    # 括弧のバランスをチェック・修正 (括弧の対応は Python のパーサーに調べさせ、報告された位置だけを直す)
     def fix_brackets(code):
-        stack = []
-        bracket_pairs = {')': '(', '}': '{', ']': '['}
-        fixed_code = ""
-        error_pos = -1
+        error = _syntax_error(code)
+        if error is None or not error.lineno:
+            return code
         
-        # エラー行と位置を抽出
-        match = re.search(r'line (\d+)', error_message)
-        if match:
-            error_line = int(match.group(1))
-            lines = code.split('\n')
-            line_pos = 0
-            for i in range(error_line - 1):
-                if i < len(lines):
-                    line_pos += len(lines[i]) + 1
-            
-            pos_match = re.search(r'position (\d+)', error_message)
-            if pos_match:
-                error_pos = line_pos + int(pos_match.group(1))
+        # 閉じ忘れ括弧の追加
+        if "was never closed" in error.msg:
+            return _close_open_brackets(code)
         
-        # 括弧のバランスを修正
-        for i, char in enumerate(code):
-            fixed_code += char
-            if char in '({[':
-                stack.append(char)
-            elif char in ')}]':
-                if not stack:  # 閉じ括弧が余分
-                    if i == error_pos:
-                        fixed_code = fixed_code[:-1]  # 余分な閉じ括弧を削除
-                elif stack[-1] == bracket_pairs[char]:
-                    stack.pop()
-                else:  # 括弧の不一致
-                    if i == error_pos:
-                        fixed_code = fixed_code[:-1] + bracket_pairs[char]
+        # エラー位置 (offset は 1 始まりの列)
+        line_starts = _line_starts(code.split('\n'))
+        if error.lineno >= len(line_starts):
+            return code
+        pos = line_starts[error.lineno - 1] + max((error.offset or 1) - 1, 0)
+        if pos >= len(code) or code[pos] not in ')]}':
+            return code
         
-        # 閉じ忘れ括弧の追加
-        for char in reversed(stack):
-            if char == '(': fixed_code += ')'
-            elif char == '{': fixed_code += '}'
-            elif char == '[': fixed_code += ']'
+        if error.msg.startswith("unmatched"):  # 閉じ括弧が余分
+            return code[:pos] + code[pos + 1:]
+        
+        match = _BRACKET_MISMATCH_RE.search(error.msg)
+        if match:  # 括弧の不一致: 開き括弧に対応する閉じ括弧に置換
+            return code[:pos] + _CLOSING_BRACKETS[match.group(1)] + code[pos + 1:]
         
-        return fixed_code
+        return code
     
     # 文字列リテラルの閉じ忘れを修正
     def fix_string_literals(code):
@@ -754,20 +873,15 @@ def _fix_syntax_error(code: str, error_message: str, container_id: str):
         fixed_lines = []
         
         # エラー行を特定
-        line_match = re.search(r'line (\d+)', error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         if line_match:
             error_line = int(line_match.group(1)) - 1
             if 0 <= error_line < len(lines):
                 # if, for, while, def, class, with, try, except, finally, else, elif
                 # に対応する行で、:が欠けている場合は追加
-                patterns = [
-                    r'^(\s*(?:if|for|while|def|class|with|try|except|finally|else|elif).*[^\s:])$'
-                ]
-                for pattern in patterns:
-                    match = re.match(pattern, lines[error_line])
-                    if match:
-                        lines[error_line] = match.group(1) + ':'
-                        break
+                match = _MISSING_COLON_RE.match(lines[error_line])
+                if match:
+                    lines[error_line] = match.group(1) + ':'
         
         return '\n'.join(lines)
     
@@ -790,7 +904,7 @@ def _fix_syntax_error(code: str, error_message: str, container_id: str):
         pass  # すでに処理済み
     elif "invalid syntax" in error_message:
         # 一般的な構文エラー
-        line_match = re.search(r'line (\d+)', error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         if line_match:
             line_num = int(line_match.group(1))
             # より複雑な構文修正ロジックをここに実装
@@ -804,7 +918,7 @@ def _fix_indentation_error(code: str, error_message: str, container_id: str):
     fixed_lines = []
     
     # エラー行を特定
-    line_match = re.search(r'line (\d+)', error_message)
+    line_match = _LINE_NUM_RE.search(error_message)
     error_line = int(line_match.group(1)) - 1 if line_match else -1
     
     # タブとスペースの混在を修正
@@ -837,73 +951,129 @@ def _fix_indentation_error(code: str, error_message: str, container_id: str):
     fixed_code = '\n'.join(fixed_lines)
     return fixed_code, fixed_code != code
 
+# NameError の自動修正用テーブル (キーは小文字化した名前で引く)
+_NAME_TYPOS = {
+    'pint': 'print',
+    'printt': 'print',
+    'lenght': 'len',
+    'legnth': 'len',
+    'flase': 'False',
+    'fasle': 'False',
+    'ture': 'True',
+    'defualt': 'default',
+    'imoprt': 'import',
+    'null': 'None',
+    'nulll': 'None',
+    'nil': 'None',
+    'flaot': 'float',
+    'boolen': 'bool',
+    'booleen': 'bool',
+    'booleean': 'bool',
+    'liste': 'list',
+}
+
+def _fix_name_typos(code: str, undefined_name: str) -> Optional[str]:
+    """コード中の未定義の名前のうち、よくあるタイプミスを全て直す (構文解析できなければ None)。
+
+    置換は名前の参照 (ast.Name) の位置だけに行い、文字列リテラルやコメント、属性名は変更しない。
+    コード内で代入・定義・インポートされている名前はタイプミスとみなさない
+    (NameError になった undefined_name は別のスコープで定義されていても直す)。
+    """
+    parsed = _parsed_code(code)
+    if parsed.tree is None:
+        return None
+    bound = set()
+    for node in ast.walk(parsed.tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bound.add(node.id)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.alias):
+            bound.add((node.asname or node.name).split('.')[0])
+    bound.discard(undefined_name)
+    lines = code.split('\n')
+    for line_num, nodes in parsed.nodes_by_line.items():
+        typos = [
+            node for node in nodes
+            if isinstance(node, ast.Name) and node.id not in bound and node.id.lower() in _NAME_TYPOS
+        ]
+        if not typos:
+            continue
+        # 列位置は UTF-8 のバイト単位なので、バイト列上で右から置換する
+        line = lines[line_num - 1].encode('utf-8')
+        for node in reversed(typos):
+            correct_name = _NAME_TYPOS[node.id.lower()].encode('utf-8')
+            line = line[:node.col_offset] + correct_name + line[node.end_col_offset:]
+        lines[line_num - 1] = line.decode('utf-8')
+    return '\n'.join(lines)
+
+# インポート忘れの可能性がある名前と追加するインポート文
+_MISSING_IMPORTS = {
+    'np': 'import numpy as np',
+    'pd': 'import pandas as pd',
+    'plt': 'import matplotlib.pyplot as plt',
+    're': 'import re',
+    'os': 'import os',
+    'sys': 'import sys',
+    'json': 'import json',
+    'math': 'import math',
+    'datetime': 'from datetime import datetime',
+    'time': 'import time',
+    'random': 'import random'
+}
+
+# 変数名に含まれる語から推測する初期値
+_VAR_TYPE_HINTS = {
+    'i': '0',
+    'j': '0',
+    'k': '0',
+    'index': '0',
+    'count': '0',
+    'sum': '0',
+    'total': '0',
+    'result': '0',
+    'lst': '[]',
+    'arr': '[]',
+    'array': '[]',
+    'data': '[]',
+    'items': '[]',
+    'dict': '{}',
+    'map': '{}',
+    'results': '[]',
+    'text': '""',
+    'name': '""',
+    'string': '""',
+    'str': '""',
+    'flag': 'False',
+    'done': 'False'
+}
+
 def _fix_name_error(code: str, error_message: str, container_id: str):
     """名前エラー（未定義変数）の修正"""
     # エラーメッセージから変数名を抽出
-    match = re.search(r"name '([^']+)' is not defined", error_message)
+    match = _NAME_ERR_RE.search(error_message)
     if not match:
         return code, False
     
     var_name = match.group(1)
     fixed_code = code
+    var_re = re.compile(r'\b' + re.escape(var_name) + r'\b')
     
     # よくある間違いを修正
-    common_typos = {
-        'pint': 'print',
-        'lenght': 'length',
-        'lenght': 'len',
-        'legnth': 'length',
-        'legnth': 'len',
-        'flase': 'False',
-        'ture': 'True',
-        'Ture': 'True',
-        'Flase': 'False',
-        'defualt': 'default',
-        'Flase': 'False',
-        'imoprt': 'import',
-        'Fasle': 'False',
-        'Ture': 'True',
-        'nulll': 'null',
-        'Nulll': 'None',
-        'null': 'None',
-        'Null': 'None',
-        'nil': 'None',
-        'Nil': 'None',
-        'flaot': 'float',
-        'boolen': 'bool',
-        'booleen': 'bool',
-        'booleean': 'bool',
-        'Liste': 'List',
-        'liste': 'list',
-        'printt': 'print',
-        'Flase': 'False',
-        'fasle': 'False'
-    }
-    
-    if var_name.lower() in common_typos:
-        # よくあるタイプミスを修正
-        correct_name = common_typos[var_name.lower()]
-        fixed_code = re.sub(r'\b' + re.escape(var_name) + r'\b', correct_name, code)
+    if var_name.lower() in _NAME_TYPOS:
+        # よくあるタイプミスを修正 (次の NameError を待たず、コード中の他のタイプミスの参照もまとめて直す)
+        fixed_code = _fix_name_typos(code, var_name)
+        if fixed_code is None:
+            # 構文解析できない場合はエラーの名前だけを置換する
+            fixed_code = var_re.sub(_NAME_TYPOS[var_name.lower()], code)
         return fixed_code, True
     
     # モジュールのインポート忘れの可能性をチェック
-    common_modules = {
-        'np': 'import numpy as np',
-        'pd': 'import pandas as pd',
-        'plt': 'import matplotlib.pyplot as plt',
-        're': 'import re',
-        'os': 'import os',
-        'sys': 'import sys',
-        'json': 'import json',
-        'math': 'import math',
-        'datetime': 'from datetime import datetime',
-        'time': 'import time',
-        'random': 'import random'
-    }
-    
-    if var_name in common_modules:
+    if var_name in _MISSING_IMPORTS:
         # モジュールのインポート文を追加
-        import_statement = common_modules[var_name]
+        import_statement = _MISSING_IMPORTS[var_name]
         lines = fixed_code.split('\n')
         
         # 最初のインポート文の後に追加するか、ファイルの先頭に追加
@@ -926,11 +1096,10 @@ def _fix_name_error(code: str, error_message: str, container_id: str):
     
     # 他の一般的なエラーを修正
     lines = code.split('\n')
-    pattern = re.compile(r'\b' + re.escape(var_name) + r'\b')
     
     # 初期化忘れの変数を検出して修正
     for i, line in enumerate(lines):
-        if re.search(pattern, line) and "=" in line:
+        if var_re.search(line) and "=" in line:
             # 変数への代入がある行を見つけた
             parts = line.split("=", 1)
             assigned_var = parts[0].strip()
@@ -938,40 +1107,15 @@ def _fix_name_error(code: str, error_message: str, container_id: str):
             # 変数名が似ている場合、タイプミスの可能性
             if (var_name in assigned_var or assigned_var in var_name) and var_name != assigned_var:
                 # タイプミスを修正
-                fixed_line = re.sub(r'\b' + re.escape(var_name) + r'\b', assigned_var, line)
+                fixed_line = var_re.sub(assigned_var, line)
                 lines[i] = fixed_line
                 fixed_code = '\n'.join(lines)
                 return fixed_code, True
     
     # 変数の宣言が見つからない場合、適切な初期化を追加
-    var_type_hints = {
-        'i': '0',
-        'j': '0',
-        'k': '0',
-        'index': '0',
-        'count': '0',
-        'sum': '0',
-        'total': '0',
-        'result': '0',
-        'lst': '[]',
-        'arr': '[]',
-        'array': '[]',
-        'data': '[]',
-        'items': '[]',
-        'dict': '{}',
-        'map': '{}',
-        'results': '[]',
-        'text': '""',
-        'name': '""',
-        'string': '""',
-        'str': '""',
-        'flag': 'False',
-        'done': 'False'
-    }
-    
     # 変数名に基づいて適切な初期化を推測
     default_value = None
-    for pattern, value in var_type_hints.items():
+    for pattern, value in _VAR_TYPE_HINTS.items():
         if pattern in var_name.lower():
             default_value = value
             break
@@ -991,7 +1135,7 @@ def _fix_name_error(code: str, error_message: str, container_id: str):
             default_value = 'None'
     
     # エラー行の直前に変数初期化を追加
-    line_match = re.search(r'line (\d+)', error_message)
+    line_match = _LINE_NUM_RE.search(error_message)
     if line_match:
         error_line = int(line_match.group(1)) - 1
         if 0 <= error_line < len(lines):
@@ -1012,6 +1156,141 @@ def _fix_name_error(code: str, error_message: str, container_id: str):
     
     return code, False
 
+# ---------------------------------------------------------------------------
+# 実行時エラーの修正関数で共有するコード解析
+# (コードを 1 度だけ構文解析し、行番号ごとのノードから修正対象を探す。解析できなければ正規表現で探す)
+# ---------------------------------------------------------------------------
+_SUBSCRIPT_RE = re.compile(r'(\w+)\[(.*?)\]')
+_DIVISION_RE = re.compile(r'(.*?)/(.*)')
+_ASSIGNMENT_RE = re.compile(r'(.*?)=')
+_CONVERSION_RE = re.compile(r'(int|float)\((.*?)\)')
+
+class _ParsedCode(NamedTuple):
+    """修正対象のコードの解析結果"""
+    tree: Optional[ast.Module]
+    nodes_by_line: Dict[int, List[ast.AST]]  # 1 行に収まるノードを行番号ごとに左から並べたもの
+
+@functools.lru_cache(maxsize=8)
+def _parsed_code(code: str) -> _ParsedCode:
+    """コードを解析し、行番号ごとのノードの索引を作る (同じコードへの修正関数の呼び出しで使い回す)"""
+    tree = _parse_code(code)
+    nodes_by_line: Dict[int, List[ast.AST]] = {}
+    if tree is not None:
+        for node in ast.walk(tree):
+            lineno = getattr(node, "lineno", None)
+            if lineno is not None and node.end_lineno == lineno:
+                nodes_by_line.setdefault(lineno, []).append(node)
+        for nodes in nodes_by_line.values():
+            nodes.sort(key=lambda node: node.col_offset)
+    return _ParsedCode(tree, nodes_by_line)
+
+def _segment(line: str, node: ast.AST) -> str:
+    """1 行に収まるノードのソースを行から切り出す (列位置は UTF-8 のバイト単位)"""
+    return line.encode("utf-8")[node.col_offset:node.end_col_offset].decode("utf-8")
+
+def _subscripts_at(code: str, line_num: int, line: str) -> List[Tuple[str, str]]:
+    """行にある変数への添字アクセスの (変数名, 添字の式) を左から順に返す"""
+    parsed = _parsed_code(code)
+    if parsed.tree is None:
+        return _SUBSCRIPT_RE.findall(line)
+    return [
+        (node.value.id, _segment(line, node.slice))
+        for node in parsed.nodes_by_line.get(line_num, ())
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and isinstance(node.ctx, ast.Load)
+    ]
+
+def _assignment_target_at(code: str, line_num: int, line: str) -> Optional[str]:
+    """行が代入文なら左辺を返す"""
+    parsed = _parsed_code(code)
+    if parsed.tree is None:
+        match = _ASSIGNMENT_RE.search(line)
+        return match.group(1).strip() if match else None
+    for node in parsed.nodes_by_line.get(line_num, ()):
+        if isinstance(node, ast.Assign):
+            return _segment(line, node.targets[0])
+        if isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            return _segment(line, node.target)
+    return None
+
+def _denominator_at(code: str, line_num: int, line: str) -> Optional[str]:
+    """行にある除算 (/, //, %) の除数の式を返す"""
+    parsed = _parsed_code(code)
+    if parsed.tree is None:
+        match = _DIVISION_RE.search(line)
+        return match.group(2).strip() if match else None
+    for node in parsed.nodes_by_line.get(line_num, ()):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod)):
+            denominator = _segment(line, node.right)
+            # 括弧はノードの範囲に含まれないので、比較式に埋め込めるよう単純な式以外は括弧で囲む
+            if isinstance(node.right, (ast.Name, ast.Constant, ast.Attribute, ast.Subscript, ast.Call)):
+                return denominator
+            return f"({denominator})"
+    return None
+
+def _conversion_at(code: str, line_num: int, line: str) -> Optional[Tuple[str, str]]:
+    """行にある int() / float() 呼び出しの (関数名, 引数の式) を返す"""
+    parsed = _parsed_code(code)
+    if parsed.tree is None:
+        match = _CONVERSION_RE.search(line)
+        return (match.group(1), match.group(2).strip()) if match else None
+    for node in parsed.nodes_by_line.get(line_num, ()):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ("int", "float") and node.args:
+            return node.func.id, _segment(line, node.args[0])
+    return None
+
+def _attribute_owner_at(code: str, line_num: int, line: str, attr_name: str) -> Optional[str]:
+    """行にある .attr_name へのアクセスについて、属性を持つ側の式を返す"""
+    parsed = _parsed_code(code)
+    if parsed.tree is None:
+        match = re.search(r'(\w+)\.' + re.escape(attr_name), line)
+        return match.group(1) if match else None
+    for node in parsed.nodes_by_line.get(line_num, ()):
+        if isinstance(node, ast.Attribute) and node.attr == attr_name:
+            return _segment(line, node.value)
+    return None
+
+def _enclosing_function_body(code: str, line_num: int) -> Optional[int]:
+    """行を含む最も内側の関数について、本体の最初の文の行番号を返す (関数外なら None)"""
+    tree = _parsed_code(code).tree
+    if tree is None:
+        return None
+    body_line = None
+    innermost = 0
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+            and node.lineno <= line_num <= node.end_lineno
+            and node.lineno > innermost
+        ):
+            innermost = node.lineno
+            body_line = node.body[0].lineno
+    return body_line
+
+# インポート名と pip のパッケージ名の対応
+_PIP_PACKAGE_NAMES = {
+    'numpy': 'numpy',
+    'np': 'numpy',
+    'pd': 'pandas',
+    'pandas': 'pandas',
+    'matplotlib.pylab': 'matplotlib',
+    'sklearn': 'scikit-learn',
+    'bs4': 'beautifulsoup4',
+    'beautifulsoup': 'beautifulsoup4',
+    'bs': 'beautifulsoup4',
+    'PIL': 'pillow',
+    'Image': 'pillow',
+    'cv2': 'opencv-python',
+    'opencv': 'opencv-python',
+    'tf': 'tensorflow',
+    'torch': 'torch',
+    'plt': 'matplotlib',
+    'sns': 'seaborn',
+    'requests': 'requests',
+    'django': 'django',
+    'flask': 'flask',
+    'scipy': 'scipy'
+}
+
 def _fix_import_error(code: str, error_message: str, container_id: str):
     """インポートエラーの修正"""
     # エラーメッセージから必要な情報を抽出
@@ -1032,32 +1311,8 @@ def _fix_import_error(code: str, error_message: str, container_id: str):
             return code, True
         else:
             # インストール失敗 - 一般的なモジュール名の間違いを修正
-            common_typos = {
-                'numpy': 'numpy',
-                'np': 'numpy',
-                'pd': 'pandas',
-                'pandas': 'pandas',
-                'matplotlib.pylab': 'matplotlib',
-                'sklearn': 'scikit-learn',
-                'bs4': 'beautifulsoup4',
-                'beautifulsoup': 'beautifulsoup4',
-                'bs': 'beautifulsoup4',
-                'PIL': 'pillow',
-                'Image': 'pillow',
-                'cv2': 'opencv-python',
-                'opencv': 'opencv-python',
-                'tf': 'tensorflow',
-                'torch': 'torch',
-                'plt': 'matplotlib',
-                'sns': 'seaborn',
-                'requests': 'requests',
-                'django': 'django',
-                'flask': 'flask',
-                'scipy': 'scipy'
-            }
-            
-            if module_name in common_typos:
-                correct_name = common_typos[module_name]
+            if module_name in _PIP_PACKAGE_NAMES:
+                correct_name = _PIP_PACKAGE_NAMES[module_name]
                 install_cmd = f"pip install {correct_name} --user"
                 stdout, stderr, exit_code = sandbox.execute_command(container_id, install_cmd)
                 
@@ -1076,7 +1331,7 @@ def _fix_import_error(code: str, error_message: str, container_id: str):
     
     if import_match:
         # モジュールの特定の機能をインポートできない場合
-        name = import_match.module_name
+        name = import_match.group(1)
         
         # よくあるインポートエラーの修正
         common_fixes = {
@@ -1112,7 +1367,7 @@ def _fix_import_error(code: str, error_message: str, container_id: str):
 def _fix_module_not_found(code: str, error_message: str, container_id: str):
     """モジュールが見つからないエラーの修正"""
     # モジュール名を抽出
-    match = re.search(r"No module named '([^']+)'", error_message)
+    match = _MODULE_NOT_FOUND_RE.search(error_message)
     if not match:
         return code, False
     
@@ -1194,7 +1449,7 @@ def _fix_type_error(code: str, error_message: str, container_id: str):
     # 数値と文字列の混合操作
     if "unsupported operand type(s) for" in error_message and "str" in error_message:
         # 行番号を抽出
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         if line_match:
             line_num = int(line_match.group(1))
             lines = code.split('\n')
@@ -1226,7 +1481,7 @@ def _fix_type_error(code: str, error_message: str, container_id: str):
     
     # リストやタプルのインデックスが整数でない
     if "sequence index must be integer" in error_message:
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         if line_match:
             line_num = int(line_match.group(1))
             lines = code.split('\n')
@@ -1235,10 +1490,9 @@ def _fix_type_error(code: str, error_message: str, container_id: str):
                 line = lines[line_num - 1]
                 
                 # インデックスを検出 (例: arr[1.5] -> arr[int(1.5)])
-                index_match = re.search(r'(\w+)\[(.*?)\]', line)
-                if index_match:
-                    var_name = index_match.group(1)
-                    index_expr = index_match.group(2)
+                subscripts = _subscripts_at(code, line_num, line)
+                if subscripts:
+                    var_name, index_expr = subscripts[0]
                     
                     # 数値か数値っぽい変数の場合
                     if re.match(r'^[\d\.]+$', index_expr) or re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', index_expr):
@@ -1258,7 +1512,7 @@ def _fix_index_error(code: str, error_message: str, container_id: str):
     """インデックスエラーの修正"""
     # "index out of range" などのエラーメッセージを検出
     if "index out of range" in error_message or "list index out of range" in error_message:
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         if line_match:
             line_num = int(line_match.group(1))
             lines = code.split('\n')
@@ -1267,10 +1521,9 @@ def _fix_index_error(code: str, error_message: str, container_id: str):
                 line = lines[line_num - 1]
                 
                 # インデックスアクセスを検出
-                index_match = re.search(r'(\w+)\[([^\]]+)\]', line)
-                if index_match:
-                    var_name = index_match.group(1)
-                    index_expr = index_match.group(2)
+                subscripts = _subscripts_at(code, line_num, line)
+                if subscripts:
+                    var_name, index_expr = subscripts[0]
                     
                     # 簡単な修正: 範囲チェックを追加
                     indent = len(line) - len(line.lstrip())
@@ -1280,7 +1533,7 @@ def _fix_index_error(code: str, error_message: str, container_id: str):
                     check_line = f"{indent_str}if {index_expr} < len({var_name}):"
                     fixed_line = f"{' ' * (indent + 4)}{line.strip()}"
                     else_line = f"{indent_str}else:"
-                    warning_line = f"{' ' * (indent + 4)}print(f\"警告: インデックス {{{index_expr}}} が範囲外です (配列の長さ: {{{len(var_name)}}})\")"
+                    warning_line = f"{' ' * (indent + 4)}print(f\"警告: インデックス {{{index_expr}}} が範囲外です (配列の長さ: {{len({var_name})}})\")"
                     
                     lines[line_num - 1] = check_line
                     lines.insert(line_num, fixed_line)
@@ -1298,7 +1551,7 @@ def _fix_key_error(code: str, error_message: str, container_id: str):
     key_match = re.search(r"KeyError: ['\"]([^'\"]+)['\"]", error_message)
     if key_match:
         key_name = key_match.group(1)
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         
         if line_match:
             line_num = int(line_match.group(1))
@@ -1308,26 +1561,17 @@ def _fix_key_error(code: str, error_message: str, container_id: str):
                 line = lines[line_num - 1]
                 
                 # 辞書アクセスを検出
-                dict_match = re.search(r'(\w+)\[(.*?)\]', line)
-                if dict_match:
-                    dict_name = dict_match.group(1)
-                    
-                    # get()メソッドを使用するように変更
-                    indent = len(line) - len(line.lstrip())
-                    indent_str = ' ' * indent
-                    
-                    # 行全体を置換するのではなく、特定の部分だけを置換
-                    fixed_line = line.replace(
-                        f"{dict_name}['{key_name}']", 
-                        f"{dict_name}.get('{key_name}')"
-                    ).replace(
-                        f'{dict_name}["{key_name}"]', 
-                        f'{dict_name}.get("{key_name}")'
-                    ).replace(
-                        f"{dict_name}[{key_name}]", 
-                        f"{dict_name}.get({key_name})"
+                subscripts = _subscripts_at(code, line_num, line)
+                if subscripts:
+                    # エラーのキーを添字に持つアクセスを優先 (見つからなければ行の最初のアクセス)
+                    dict_name, key_expr = next(
+                        (s for s in subscripts if s[1].strip("'\"") == key_name),
+                        subscripts[0],
                     )
                     
+                    # 行全体を置換するのではなく、特定の部分だけを get() に置換
+                    fixed_line = line.replace(f"{dict_name}[{key_expr}]", f"{dict_name}.get({key_expr})")
+                    
                     # コメントを追加
                     fixed_line += "  # KeyErrorを避けるためにget()メソッドを使用"
                     
@@ -1337,6 +1581,25 @@ def _fix_key_error(code: str, error_message: str, container_id: str):
     
     return code, False
 
+# よくある属性名の間違い (正しい属性名 -> 間違えやすい名前)
+_ATTRIBUTE_TYPOS = {
+    'append': ['add', 'insert', 'push'],
+    'extend': ['concat', 'merge', 'join'],
+    'items': ['keys', 'values', 'elements'],
+    'shape': ['size', 'dimensions', 'dim'],
+    'columns': ['cols', 'column_names', 'fields'],
+    'index': ['indices', 'indexes', 'keys'],
+    'iloc': ['loc', 'ix', 'at'],
+    'imread': ['read', 'load_image', 'open_image'],
+    'savefig': ['save', 'save_plot', 'save_figure']
+}
+# 間違えやすい名前 -> 正しい属性名
+_ATTRIBUTE_FIXES = {
+    variant: correct
+    for correct, variants in _ATTRIBUTE_TYPOS.items()
+    for variant in variants
+}
+
 def _fix_attribute_error(code: str, error_message: str, container_id: str):
     """属性エラーの修正"""
     # 'module' has no attribute 'X' パターンを検出
@@ -1346,7 +1609,7 @@ def _fix_attribute_error(code: str, error_message: str, container_id: str):
     if attr_match:
         obj_type = attr_match.group(1)
         attr_name = attr_match.group(2)
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         
         if line_match:
             line_num = int(line_match.group(1))
@@ -1356,31 +1619,12 @@ def _fix_attribute_error(code: str, error_message: str, container_id: str):
                 line = lines[line_num - 1]
                 
                 # よくある属性の間違いを修正
-                common_typos = {
-                    'append': ['add', 'insert', 'push'],
-                    'extend': ['concat', 'merge', 'join'],
-                    'items': ['keys', 'values', 'elements'],
-                    'shape': ['size', 'dimensions', 'dim'],
-                    'columns': ['cols', 'column_names', 'fields'],
-                    'index': ['indices', 'indexes', 'keys'],
-                    'iloc': ['loc', 'ix', 'at'],
-                    'imread': ['read', 'load_image', 'open_image'],
-                    'savefig': ['save', 'save_plot', 'save_figure']
-                }
-                
-                # 逆方向のマッピングを作成
-                reverse_map = {}
-                for correct, variants in common_typos.items():
-                    for variant in variants:
-                        reverse_map[variant] = correct
-                
                 # 属性名の修正
-                if attr_name in reverse_map:
-                    correct_attr = reverse_map[attr_name]
+                if attr_name in _ATTRIBUTE_FIXES:
+                    correct_attr = _ATTRIBUTE_FIXES[attr_name]
                     # 属性アクセスパターン検出
-                    obj_match = re.search(r'(\w+)\.' + re.escape(attr_name), line)
-                    if obj_match:
-                        obj_name = obj_match.group(1)
+                    obj_name = _attribute_owner_at(code, line_num, line, attr_name)
+                    if obj_name:
                         fixed_line = line.replace(f"{obj_name}.{attr_name}", f"{obj_name}.{correct_attr}")
                         lines[line_num - 1] = fixed_line + f"  # 属性名を修正: {attr_name} -> {correct_attr}"
                         fixed_code = '\n'.join(lines)
@@ -1414,7 +1658,7 @@ def _fix_attribute_error(code: str, error_message: str, container_id: str):
             # 大文字小文字の違いを修正
             for correct_attr in module_attrs[module_name]:
                 if attr_name.lower() == correct_attr.lower():
-                    line_match = re.search(r"line (\d+)", error_message)
+                    line_match = _LINE_NUM_RE.search(error_message)
                     if line_match:
                         line_num = int(line_match.group(1))
                         lines = code.split('\n')
@@ -1434,7 +1678,7 @@ def _fix_file_not_found(code: str, error_message: str, container_id: str):
     file_match = re.search(r"No such file or directory: ['\"](.*?)['\"]", error_message)
     if file_match:
         file_path = file_match.group(1)
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         
         if line_match:
             line_num = int(line_match.group(1))
@@ -1484,7 +1728,7 @@ def _fix_file_not_found(code: str, error_message: str, container_id: str):
 def _fix_zero_division(code: str, error_message: str, container_id: str):
     """ゼロ除算エラーの修正"""
     if "division by zero" in error_message:
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         
         if line_match:
             line_num = int(line_match.group(1))
@@ -1494,10 +1738,8 @@ def _fix_zero_division(code: str, error_message: str, container_id: str):
                 line = lines[line_num - 1]
                 
                 # 除算演算子を検出
-                division_match = re.search(r'(.*?)/(.*)', line)
-                if division_match:
-                    numerator = division_match.group(1).strip()
-                    denominator = division_match.group(2).strip()
+                denominator = _denominator_at(code, line_num, line)
+                if denominator:
                     
                     # インデントを保持
                     indent = len(line) - len(line.lstrip())
@@ -1512,9 +1754,8 @@ def _fix_zero_division(code: str, error_message: str, container_id: str):
                     lines.insert(line_num + 4, f"{indent_str}    # 行の左辺を抽出")
                     
                     # 代入文を解析して左辺を取得
-                    assignment_match = re.search(r'(.*?)=', line)
-                    if assignment_match:
-                        lhs = assignment_match.group(1).strip()
+                    lhs = _assignment_target_at(code, line_num, line)
+                    if lhs:
                         lines.insert(line_num + 5, f"{indent_str}    {lhs} = float('inf')  # または適切なデフォルト値")
                     else:
                         # 代入でない場合はコメントアウト
@@ -1531,7 +1772,7 @@ def _fix_value_error(code: str, error_message: str, container_id: str):
     
     # 数値変換エラー
     if "invalid literal for int()" in error_message or "could not convert string to float" in error_message:
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         
         if line_match:
             line_num = int(line_match.group(1))
@@ -1541,10 +1782,9 @@ def _fix_value_error(code: str, error_message: str, container_id: str):
                 line = lines[line_num - 1]
                 
                 # int() または float() の呼び出しを検出
-                conversion_match = re.search(r'(int|float)\((.*?)\)', line)
-                if conversion_match:
-                    conversion_func = conversion_match.group(1)
-                    arg = conversion_match.group(2).strip()
+                conversion = _conversion_at(code, line_num, line)
+                if conversion:
+                    conversion_func, arg = conversion
                     
                     # 変換エラーを捕捉するように修正
                     indent = len(line) - len(line.lstrip())
@@ -1560,9 +1800,8 @@ def _fix_value_error(code: str, error_message: str, container_id: str):
                     lines.insert(line_num + 2, f"{indent_str}    print(f'変換エラー: {{{{f\"{{arg}}\"}}}}を{conversion_func}に変換できません')")
                     
                     # 代入文の場合はデフォルト値を設定
-                    assignment_match = re.search(r'(.*?)=', original_line)
-                    if assignment_match:
-                        lhs = assignment_match.group(1).strip()
+                    lhs = _assignment_target_at(code, line_num, original_line)
+                    if lhs:
                         default_value = "0" if conversion_func == "int" else "0.0"
                         lines.insert(line_num + 3, f"{indent_str}    {lhs} = {default_value}  # デフォルト値")
                     
@@ -1582,7 +1821,7 @@ def _fix_unbound_local_error(code: str, error_message: str, container_id: str):
     var_match = re.search(r"local variable '([^']+)' referenced before assignment", error_message)
     if var_match:
         var_name = var_match.group(1)
-        line_match = re.search(r"line (\d+)", error_message)
+        line_match = _LINE_NUM_RE.search(error_message)
         
         if line_match:
             line_num = int(line_match.group(1))
@@ -1590,19 +1829,23 @@ def _fix_unbound_local_error(code: str, error_message: str, container_id: str):
             
             if 0 <= line_num - 1 < len(lines):
                 # 関数内でグローバル変数を参照している可能性
-                # 関数定義を探す
-                func_start = line_num - 1
-                while func_start >= 0 and not lines[func_start].strip().startswith("def "):
-                    func_start -= 1
+                # 関数本体の先頭を探す (構文解析できなければ "def " の行を遡って探す)
+                body_start = _enclosing_function_body(code, line_num)
+                if body_start is not None:
+                    body_start -= 1
+                else:
+                    func_start = line_num - 1
+                    while func_start >= 0 and not lines[func_start].strip().startswith("def "):
+                        func_start -= 1
+                    body_start = func_start + 1 if func_start >= 0 else None
                 
-                if func_start >= 0:
+                if body_start is not None and body_start < len(lines):
                     # 関数内でグローバル変数を宣言
-                    func_line = lines[func_start]
-                    indent = len(lines[func_start + 1]) - len(lines[func_start + 1].lstrip())
+                    indent = len(lines[body_start]) - len(lines[body_start].lstrip())
                     indent_str = ' ' * indent
                     
                     # global宣言を追加
-                    lines.insert(func_start + 1, f"{indent_str}global {var_name}  # グローバル変数として宣言")
+                    lines.insert(body_start, f"{indent_str}global {var_name}  # グローバル変数として宣言")
                     
                     fixed_code = '\n'.join(lines)
                     return fixed_code, True
@@ -1633,6 +1876,26 @@ def _fix_unbound_local_error(code: str, error_message: str, container_id: str):
     
     return code, False
 
+# 構文解析の段階で発生するエラータイプ
+_SYNTAX_ERROR_TYPES = frozenset({"SyntaxError", "IndentationError", "TabError"})
+
+# エラータイプ別の修正関数マッピング
+_ERROR_FIXERS = {
+    "SyntaxError": _fix_syntax_error,
+    "IndentationError": _fix_indentation_error,
+    "NameError": _fix_name_error,
+    "ImportError": _fix_import_error,
+    "ModuleNotFoundError": _fix_module_not_found,
+    "TypeError": _fix_type_error,
+    "IndexError": _fix_index_error,
+    "KeyError": _fix_key_error,
+    "AttributeError": _fix_attribute_error,
+    "FileNotFoundError": _fix_file_not_found,
+    "ZeroDivisionError": _fix_zero_division,
+    "ValueError": _fix_value_error,
+    "UnboundLocalError": _fix_unbound_local_error
+}
+
 @tool(
     name="codeact_comprehensive_analysis",
     description="様々なデータファイルに対する包括的な分析を実行",
@@ -1679,7 +1942,9 @@ def codeact_comprehensive_analysis(
     
     # 実行
     sandbox = get_sandbox()
-    stdout, stderr, exit_code = sandbox.execute_python(container_id or "codeact-analysis", analysis_code)
+    stdout, stderr, exit_code = sandbox.execute_python(container_id or release_at_exit(_ANALYSIS_SESSION), analysis_code)
+    
+    stdout, stderr = _truncate_output(stdout), _truncate_output(stderr)
     
     # エラー処理
     if stderr and exit_code != 0:
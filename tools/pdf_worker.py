@@ -0,0 +1,119 @@
+# tools/pdf_worker.py
+"""
+PDF テキスト抽出のワーカー関数。
+ProcessPoolExecutor の子プロセスで実行されるため、重いツールモジュールには依存しない。
+"""
+import threading
+from typing import List, Tuple
+
+
+def extract_pages_pypdf2(path: str, page_nums: List[int]) -> List[Tuple[int, str]]:
+    """
+    PyPDF2 で指定ページ (1 始まり) のテキストを抽出する。
+    
+    Args:
+        path: PDF ファイルのパス
+        page_nums: 抽出するページ番号のリスト
+        
+    Returns:
+        (ページ番号, 抽出テキスト) のリスト
+    """
+    import PyPDF2
+    
+    with open(path, 'rb') as f:
+        pdf_reader = PyPDF2.PdfReader(f)
+        # PyPDF2はゼロベースのインデックス
+        return [(n, pdf_reader.pages[n - 1].extract_text() or "") for n in page_nums]
+
+
+def extract_pages_pymupdf(path: str, page_nums: List[int]) -> List[Tuple[int, str]]:
+    """
+    PyMuPDF で指定ページ (1 始まり) のテキストを抽出する。
+    MuPDF の Document はスレッド間で共有できないため、呼び出しごとに自分で開く。
+    
+    Args:
+        path: PDF ファイルのパス
+        page_nums: 抽出するページ番号のリスト
+        
+    Returns:
+        (ページ番号, 抽出テキスト) のリスト
+    """
+    import fitz  # PyMuPDF
+    
+    with fitz.open(path) as doc:
+        # PyMuPDFはゼロベースのインデックス
+        return [(n, doc.load_page(n - 1).get_text()) for n in page_nums]
+
+
+# プロセスごとに 1 つだけ作る Tesseract API (言語データの読み込みを毎ページ繰り返さない)
+_tess_api = None
+# 親プロセスでは複数のスレッドから呼ばれうるため API の利用を直列化する
+_tess_lock = threading.Lock()
+
+
+def _tesseract_api(lang: str):
+    """tesserocr の常駐 API を返す。tesserocr が無ければ None"""
+    global _tess_api
+    if _tess_api is None:
+        # 初期化の競合は無害 (片方の API が使われずに破棄されるだけ)
+        try:
+            from tesserocr import PyTessBaseAPI, PSM
+        except ImportError:
+            return None
+        _tess_api = PyTessBaseAPI(lang=lang, psm=PSM.AUTO)
+    return _tess_api
+
+
+def ocr_image_files(paths: List[str], lang: str = 'jpn+eng') -> List[str]:
+    """
+    画像ファイルを OCR してテキストを返す。
+    tesserocr があれば常駐 API を使い、無ければ pytesseract (ページごとに tesseract を起動) を使う。
+    
+    Args:
+        paths: 画像ファイルのパスのリスト
+        lang: Tesseract の言語指定
+        
+    Returns:
+        各画像の抽出テキスト (paths と同じ順序)
+    """
+    api = _tesseract_api(lang)
+    if api is None:
+        import pytesseract
+        return [pytesseract.image_to_string(p, lang=lang) for p in paths]
+    
+    texts = []
+    with _tess_lock:
+        for p in paths:
+            api.SetImageFile(p)
+            texts.append(api.GetUTF8Text())
+    return texts
+
+
+# EasyOCR の Reader (モデルの読み込みが重いのでプロセスで 1 つだけ作る)
+_easyocr_reader = None
+_easyocr_lock = threading.Lock()
+
+
+def ocr_image_files_batched(paths: List[str], batch_size: int = 8) -> List[str]:
+    """
+    EasyOCR のバッチ API で画像ファイルを OCR してテキストを返す (GPU があれば GPU を使う)。
+    
+    Args:
+        paths: 画像ファイルのパスのリスト
+        batch_size: 1 回の推論にまとめる画像数
+        
+    Returns:
+        各画像の抽出テキスト (paths と同じ順序)
+    """
+    global _easyocr_reader
+    import easyocr
+    import torch
+    
+    with _easyocr_lock:
+        if _easyocr_reader is None:
+            _easyocr_reader = easyocr.Reader(['ja', 'en'], gpu=torch.cuda.is_available())
+        # バッチ推論では全画像を同じサイズに揃える必要がある
+        results = _easyocr_reader.readtext_batched(
+            paths, n_width=800, n_height=600, batch_size=batch_size, detail=0
+        )
+    return ["\n".join(lines) for lines in results]